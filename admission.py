@@ -0,0 +1,182 @@
+"""Admission control for Blogly: a cap on the requests a worker handles at once.
+
+When the db slows down, requests hold their worker threads and db connections
+longer, new ones keep arriving, and soon every request waits on every other
+one until they all time out. Instead, each worker admits at most
+ADMISSION_READ_LIMIT GET/HEAD requests and ADMISSION_WRITE_LIMIT others (the
+POST routes: create_user, create_post, edit_post, ...) at a time, so writes
+still get through while reads pile up and the other way round. A request over
+its budget waits in a queue of at most ADMISSION_QUEUE_SIZE requests for up to
+ADMISSION_QUEUE_TIMEOUT seconds. When the queue is full, or the request's wait
+runs out, it gets a 503 with a Retry-After header straight away, without
+touching the db.
+
+The /metrics and /status endpoints and static files are always admitted, so
+an overloaded worker can still be watched. A request holds its slot until its
+response is sent, streamed pages included.
+
+Settings, like pool.py's, come from create_app() arguments or the environment:
+
+    ADMISSION_READ_LIMIT     BLOGLY_ADMISSION_READ_LIMIT     concurrent reads, 0 for no limit (default 10)
+    ADMISSION_WRITE_LIMIT    BLOGLY_ADMISSION_WRITE_LIMIT    concurrent writes, 0 for no limit (default 4)
+    ADMISSION_QUEUE_SIZE     BLOGLY_ADMISSION_QUEUE_SIZE     waiting requests per budget (default 32)
+    ADMISSION_QUEUE_TIMEOUT  BLOGLY_ADMISSION_QUEUE_TIMEOUT  seconds a request may wait (default 2)
+    ADMISSION_RETRY_AFTER    BLOGLY_ADMISSION_RETRY_AFTER    seconds sent in Retry-After (default 2)
+
+The defaults keep the two budgets within the default pool (5 connections plus
+10 overflow, see pool.py). Budgets are per process: the prefork server's
+workers handle one request at a time unless --threaded, so they matter for
+threaded workers and the threaded dev server. Queue depth, requests in flight
+and rejections are shown at /status/admission and /metrics.
+"""
+
+import os
+import threading
+import time
+
+from flask import g, request
+
+from pool import parse_setting
+from replicas import READ_METHODS
+
+DEFAULTS = {
+    'ADMISSION_READ_LIMIT': 10,
+    'ADMISSION_WRITE_LIMIT': 4,
+    'ADMISSION_QUEUE_SIZE': 32,
+    'ADMISSION_QUEUE_TIMEOUT': 2.0,
+    'ADMISSION_RETRY_AFTER': 2,
+}
+
+ENV_VARS = {
+    'ADMISSION_READ_LIMIT': 'BLOGLY_ADMISSION_READ_LIMIT',
+    'ADMISSION_WRITE_LIMIT': 'BLOGLY_ADMISSION_WRITE_LIMIT',
+    'ADMISSION_QUEUE_SIZE': 'BLOGLY_ADMISSION_QUEUE_SIZE',
+    'ADMISSION_QUEUE_TIMEOUT': 'BLOGLY_ADMISSION_QUEUE_TIMEOUT',
+    'ADMISSION_RETRY_AFTER': 'BLOGLY_ADMISSION_RETRY_AFTER',
+}
+
+# Always admitted, so an overloaded worker can still be monitored.
+EXEMPT_ENDPOINTS = {'static', 'show_metrics', 'show_pool_stats', 'show_replica_status', 'show_admission_stats'}
+
+
+def admission_settings(**overrides):
+    """Return the ADMISSION_* settings, preferring 'overrides' that aren't None, then the environment."""
+
+    settings = {}
+    for key, default in DEFAULTS.items():
+        value = overrides.get(key)
+        if value is None:
+            value = os.environ.get(ENV_VARS[key], default)
+        settings[key] = parse_setting(value, default)
+
+    return settings
+
+
+class Budget:
+    """At most 'limit' requests at a time, with up to 'queue_size' more waiting up to 'queue_timeout'
+    seconds for a slot. A limit of 0 admits everything."""
+
+    def __init__(self, limit, queue_size, queue_timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+
+        self.lock = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.wait_seconds_total = 0.0
+
+    def acquire(self):
+        """Take a slot, waiting for one if needed. Returns False if the request is turned away."""
+
+        with self.lock:
+            if not self.limit or (self.active < self.limit and not self.waiting):
+                self.active += 1
+                self.admitted += 1
+                return True
+
+            if self.waiting >= self.queue_size:
+                self.rejected_queue_full += 1
+                return False
+
+            start = time.perf_counter()
+            self.waiting += 1
+            try:
+                admitted = self.lock.wait_for(lambda: self.active < self.limit, timeout=self.queue_timeout)
+            finally:
+                self.waiting -= 1
+                self.wait_seconds_total += time.perf_counter() - start
+
+            if not admitted:
+                self.rejected_timeout += 1
+                return False
+
+            self.active += 1
+            self.admitted += 1
+            self.queued += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            self.lock.notify()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'waiting': self.waiting,
+                'queue_size': self.queue_size,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+            }
+
+
+class AdmissionControl:
+    """The read and write budgets for one app."""
+
+    def __init__(self, settings):
+        queue_size, queue_timeout = settings['ADMISSION_QUEUE_SIZE'], settings['ADMISSION_QUEUE_TIMEOUT']
+        self.read = Budget(settings['ADMISSION_READ_LIMIT'], queue_size, queue_timeout)
+        self.write = Budget(settings['ADMISSION_WRITE_LIMIT'], queue_size, queue_timeout)
+        self.retry_after = settings['ADMISSION_RETRY_AFTER']
+
+    def budget_for(self, method):
+        return self.read if method in READ_METHODS else self.write
+
+    def stats(self):
+        return {'read': self.read.stats(), 'write': self.write.stats()}
+
+
+def init_admission(app):
+    """Start admitting the app's requests against its budgets. Returns the app's AdmissionControl."""
+
+    admission = AdmissionControl(app.config)
+    app.extensions['admission'] = admission
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+
+        budget = admission.budget_for(request.method)
+        if not budget.acquire():
+            return ("The server is busy, please try again shortly.", 503,
+                    {"Retry-After": str(admission.retry_after)})
+        g.admission_budget = budget
+
+    @app.teardown_request
+    def release_admission(exc):
+        budget = g.pop('admission_budget', None)
+        if budget is not None:
+            budget.release()
+
+    return admission
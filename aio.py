@@ -0,0 +1,256 @@
+"""Async read path for Blogly, using SQLAlchemy's asyncio extension with asyncpg.
+
+Turned on with create_app(async_reads=True) or BLOGLY_ASYNC_READS=1. The read
+only routes (home, list_users, show_user_detail_page, show_post, list_tags and
+show_tag_detail_page) are replaced by async views that query through an
+AsyncSession, using the same models.py mappings. Write routes stay sync.
+
+Flask runs each async view in its own short-lived event loop, and asyncpg
+connections can't move between loops. So the AsyncEngine and its pool live on
+one long-running loop in a background thread, and the views hand their
+queries over to it with run(). Everything a template touches must be eager
+loaded, because objects are detached once the session closes.
+
+Needs the `asyncpg` and `asgiref` (Flask's async support) packages.
+"""
+
+import asyncio
+import atexit
+import threading
+
+from flask import abort, render_template, request
+from markupsafe import Markup
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload, selectinload, undefer
+from sqlalchemy.pool import NullPool
+
+from cache import (RECENT_POSTS_KEY, post_card_key, post_page_key, post_stamp_keys, stamp_keys, current_stamps,
+                   get_stamped, get_stamped_many, set_stamped, stamps_for, join_stamped)
+from models import User, Post, Tag, PostTag
+from pagination import keyset_select, keyset_page
+from pool import install_statement_timeout
+
+
+def async_engine_options(settings):
+    """Build create_async_engine() options from the DB_* settings in pool.py."""
+
+    options = {'pool_pre_ping': settings['DB_POOL_PRE_PING']}
+    connect_args = {}
+
+    if settings['DB_PGBOUNCER']:
+        options['poolclass'] = NullPool
+        # PgBouncer transaction pooling breaks asyncpg's named prepared statements.
+        connect_args['statement_cache_size'] = 0
+    else:
+        options.update({
+            'pool_size': settings['DB_POOL_SIZE'],
+            'max_overflow': settings['DB_MAX_OVERFLOW'],
+            'pool_timeout': settings['DB_POOL_TIMEOUT'],
+            'pool_recycle': settings['DB_POOL_RECYCLE'],
+        })
+        if settings['DB_STATEMENT_TIMEOUT']:
+            connect_args['server_settings'] = {'statement_timeout': str(settings['DB_STATEMENT_TIMEOUT'])}
+
+    options['connect_args'] = connect_args
+    return options
+
+
+class AsyncDatabase:
+    """An AsyncEngine whose connections all live on one background event loop."""
+
+    def __init__(self, database_uri, settings):
+        url = make_url(database_uri).set(drivername='postgresql+asyncpg')
+        if settings['DB_PGBOUNCER']:
+            url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+
+        self.url = url
+        self.settings = settings
+        self.start()
+
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the loop's thread and the engine. server.py calls it again in each forked
+        worker, after close() in the parent, since threads don't survive a fork."""
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='blogly-async-db', daemon=True)
+        self.thread.start()
+
+        self.engine = create_async_engine(self.url, **async_engine_options(self.settings))
+        install_statement_timeout(self.engine.sync_engine, self.settings)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def run(self, fn):
+        """Run the coroutine function 'fn(session)' on the engine's loop and return its result."""
+
+        async def job():
+            async with self.sessionmaker() as session:
+                return await fn(session)
+
+        future = asyncio.run_coroutine_threadsafe(job(), self.loop)
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+
+        asyncio.run_coroutine_threadsafe(self.engine.dispose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+async def _get_page(session, query, sort_columns, after, before, descending=False):
+    # 'after' and 'before' come from the view: the request isn't visible on the engine's loop.
+    query = keyset_select(query, sort_columns, descending=descending, after=after, before=before)
+    rows = (await session.scalars(query)).all()
+
+    return keyset_page(rows, sort_columns, after=after, before=before)
+
+
+async def _load_stamp_keys(session, post_ids):
+    """Return the stamp keys of the given posts' authors and tags, see Post.get_authors_and_tags()."""
+
+    rows = (await session.execute(Post.authors_and_tags_select(post_ids))).all()
+    return stamp_keys({user_id for user_id, _ in rows if user_id is not None},
+                      {tag_id for _, tag_id in rows if tag_id is not None})
+
+
+def install_async_views(app, fragments):
+    """Replace the app's read only views with async versions."""
+
+    adb = AsyncDatabase(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+    app.extensions['async_db'] = adb
+
+    with_author_and_tags = [joinedload(Post.user), selectinload(Post.tags)]
+
+    async def render_recent_posts():
+        """Render the recent posts block, reusing any post cards that are still cached.
+        Returns the block and the stamps of the users and tags it shows."""
+
+        async def load_recent_post_ids(session):
+            query = select(Post.id).order_by(Post.created_at.desc(), Post.id.desc()).limit(5)
+            return (await session.scalars(query)).all()
+
+        post_ids = await adb.run(load_recent_post_ids)
+        cards = get_stamped_many(fragments, [post_card_key(post_id) for post_id in post_ids])
+        missing_ids = [post_id for post_id, card in zip(post_ids, cards) if card is None]
+
+        if missing_ids:
+            # The stamps are read before the posts, see current_stamps().
+            stamps = current_stamps(fragments, await adb.run(lambda session: _load_stamp_keys(session, missing_ids)))
+
+            async def load_posts(session):
+                query = select(Post).options(*Post.card_options()).where(Post.id.in_(missing_ids))
+                return (await session.scalars(query)).all()
+
+            posts = {post.id: post for post in await adb.run(load_posts)}
+
+            for i, post_id in enumerate(post_ids):
+                if cards[i] is None and post_id in posts:
+                    post = posts[post_id]
+                    cards[i] = set_stamped(fragments, post_card_key(post_id),
+                                           render_template('post-card.html', post=post),
+                                           stamps_for(stamps, post_stamp_keys([post])))
+
+        return join_stamped([card for card in cards if card is not None])
+
+    async def home():
+        """Blogly's home page. Shows the 5 latest posts."""
+
+        recent_posts = get_stamped(fragments, RECENT_POSTS_KEY)
+        if recent_posts is None:
+            block, stamps = await render_recent_posts()
+            recent_posts = set_stamped(fragments, RECENT_POSTS_KEY, block, stamps)
+
+        return render_template('home.html', recent_posts=Markup(recent_posts["value"]))
+
+    async def list_users():
+        """Shows a page of the users in db"""
+
+        after, before = request.args.get("after"), request.args.get("before")
+        users = await adb.run(lambda session: _get_page(session, select(User), User.page_order(),
+                                                        after, before))
+        return render_template('users.html', users=users)
+
+    async def show_user_detail_page(user_id):
+        """Show a page that includes details about a specific user."""
+
+        after, before = request.args.get("after"), request.args.get("before")
+
+        async def load(session):
+            user = await session.get(User, user_id)
+            if user is None:
+                return None, None
+
+            query = select(Post).options(Post.title_options()).where(Post.user_id == user_id)
+            return user, await _get_page(session, query, Post.page_order(), after, before, descending=True)
+
+        user, posts = await adb.run(load)
+        if user is None:
+            abort(404)
+
+        return render_template("user-details.html", user=user, posts=posts)
+
+    async def show_post(post_id):
+        """Show a post page"""
+
+        page = get_stamped(fragments, post_page_key(post_id))
+        if page is None:
+            # The stamps are read before the post, see current_stamps().
+            stamps = current_stamps(fragments, await adb.run(lambda session: _load_stamp_keys(session, [post_id])))
+
+            async def load(session):
+                query = (select(Post).options(undefer(Post.content), *with_author_and_tags)
+                         .where(Post.id == post_id))
+                return (await session.scalars(query)).first()
+
+            post = await adb.run(load)
+            if post is None:
+                abort(404)
+
+            page = set_stamped(fragments, post_page_key(post_id),
+                               {"title": post.title, "body": render_template('post-details.html', post=post)},
+                               stamps_for(stamps, post_stamp_keys([post])))
+
+        page = page["value"]
+
+        return render_template('post.html', title=page["title"], body=Markup(page["body"]))
+
+    async def list_tags():
+        """Shows a page of the tags in db"""
+
+        after, before = request.args.get("after"), request.args.get("before")
+
+        async def load(session):
+            popular_tags = (await session.scalars(Tag.most_popular_select())).all()
+            return await _get_page(session, select(Tag), Tag.page_order(), after, before), popular_tags
+
+        tags, popular_tags = await adb.run(load)
+        return render_template('tags.html', tags=tags, popular_tags=popular_tags)
+
+    async def show_tag_detail_page(tag_id):
+        """Show a page that shows a page of the posts that have the provided tag."""
+
+        after, before = request.args.get("after"), request.args.get("before")
+
+        async def load(session):
+            tag = await session.get(Tag, tag_id)
+            if tag is None:
+                return None, None
+
+            query = (select(Post).options(Post.title_options()).join(PostTag, PostTag.post_id == Post.id)
+                     .where(PostTag.tag_id == tag_id))
+            return tag, await _get_page(session, query, Post.page_order(), after, before, descending=True)
+
+        tag, posts = await adb.run(load)
+        if tag is None:
+            abort(404)
+
+        return render_template("tag-details.html", tag=tag, posts=posts)
+
+    for view in (home, list_users, show_user_detail_page, show_post, list_tags, show_tag_detail_page):
+        app.view_functions[view.__name__] = view
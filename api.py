@@ -0,0 +1,256 @@
+"""JSON API over Blogly's users, posts and tags, mounted at /api/v1.
+
+    GET /api/v1/posts?ids=1,2,3&fields=title,created_at&include=author,tags
+    GET /api/v1/users?after=100&limit=500&fields=first_name,last_name
+    GET /api/v1/tags
+    DELETE /api/v1/users?ids=4,5,6
+
+- `ids` fetches up to MAX_IDS rows by id. Ids that don't exist are listed
+  under "missing".
+- Without `ids`, rows are listed in id order, `limit` at a time (DEFAULT_LIMIT,
+  at most MAX_LIMIT). "next" is the `after` value for the following call.
+- `fields` picks the columns to return (`id` always comes back), and only
+  those columns are selected.
+- `include` (posts only) adds each post's `author` and/or `tags`, fetched
+  with one query per batch of posts rather than one per post.
+
+DELETE with `ids` deletes up to MAX_IDS users, posts or tags in a constant number
+of statements, leaving the db's ON DELETE CASCADE to remove a user's posts and
+the posts_tags rows. It answers with the "deleted" and "missing" ids.
+
+Rows are read from a server side cursor BATCH_SIZE at a time and the JSON is
+streamed out as each batch is serialized, so big responses don't sit in
+memory. Bad parameters get a 400 with a JSON {"error": ...} body.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+
+from cache import post_keys, stamp_keys
+from feeds import post_feed_keys
+from models import db, User, Post, Tag, PostTag
+
+MAX_IDS = 1000
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+BATCH_SIZE = 500
+
+# The fields each resource can return, besides id.
+FIELDS = {
+    'users': (User, ('first_name', 'last_name', 'image_url', 'post_count', 'created_at', 'updated_at')),
+    'posts': (Post, ('title', 'content', 'excerpt', 'created_at', 'updated_at', 'user_id', 'view_count')),
+    'tags': (Tag, ('name', 'post_count', 'created_at', 'updated_at')),
+}
+
+INCLUDES = {
+    'users': (),
+    'posts': ('author', 'tags'),
+    'tags': (),
+}
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+@api.errorhandler(HTTPException)
+def handle_http_error(e):
+    return jsonify(error=e.description), e.code
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't serialize {value!r}")
+
+
+def _parse_list(name, allowed, default):
+    value = request.args.get(name)
+    if value is None:
+        return list(default)
+
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = [item for item in items if item not in allowed and item != 'id']
+    if unknown:
+        abort(400, description=f"Unknown {name}: {', '.join(unknown)}. "
+                               f"Allowed: {', '.join(allowed)}.")
+
+    return [item for item in items if item != 'id']
+
+
+def _parse_ids(value):
+    try:
+        ids = {int(i) for i in value.split(',') if i.strip()}
+    except ValueError:
+        abort(400, description="ids must be a comma separated list of integers.")
+
+    if len(ids) > MAX_IDS:
+        abort(400, description=f"At most {MAX_IDS} ids per request.")
+
+    return sorted(ids)
+
+
+def _include_authors(items, user_ids):
+    """Add each post's author to 'items', in one query."""
+
+    query = select(User.id, User.first_name, User.last_name).where(User.id.in_(set(user_ids)))
+    authors = {row.id: dict(row._mapping) for row in db.session.execute(query)}
+
+    for item, user_id in zip(items, user_ids):
+        item['author'] = authors.get(user_id)
+
+
+def _include_tags(items):
+    """Add each post's tags to 'items', in one query."""
+
+    tags = {item['id']: [] for item in items}
+    query = (select(PostTag.post_id, Tag.id, Tag.name)
+             .join(Tag, Tag.id == PostTag.tag_id)
+             .where(PostTag.post_id.in_(list(tags)))
+             .order_by(Tag.name, Tag.id))
+
+    for post_id, tag_id, name in db.session.execute(query):
+        tags[post_id].append({'id': tag_id, 'name': name})
+
+    for item in items:
+        item['tags'] = tags[item['id']]
+
+
+def _collection(kind):
+    """Stream the rows of 'kind' asked for by the request's parameters."""
+
+    model, allowed_fields = FIELDS[kind]
+    fields = _parse_list('fields', allowed_fields, allowed_fields)
+    includes = _parse_list('include', INCLUDES[kind], ())
+
+    columns = [model.id] + [getattr(model, field) for field in fields]
+    if 'author' in includes:
+        columns.append(Post.user_id.label('_author_id'))
+    query = select(*columns)
+
+    ids = request.args.get('ids')
+    if ids is not None:
+        ids = _parse_ids(ids)
+        query = query.where(model.id.in_(ids)).order_by(model.id)
+        limit = None
+    else:
+        after = request.args.get('after', type=int)
+        limit = min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+        if after is not None:
+            query = query.where(model.id > after)
+        query = query.order_by(model.id).limit(limit + 1)
+
+    def generate():
+        yield '{"data": ['
+
+        returned = 0
+        last_id = None
+        has_more = False
+        found = set()
+
+        result = db.session.execute(query.execution_options(yield_per=BATCH_SIZE))
+        for rows in result.partitions():
+            if limit is not None and returned + len(rows) > limit:
+                rows = rows[:limit - returned]
+                has_more = True
+            if not rows:
+                break
+
+            items = [{'id': row.id, **{field: row._mapping[field] for field in fields}} for row in rows]
+            if 'author' in includes:
+                _include_authors(items, [row._author_id for row in rows])
+            if 'tags' in includes:
+                _include_tags(items)
+
+            chunk = ", ".join(json.dumps(item, default=_json_default) for item in items)
+            yield (", " if returned else "") + chunk
+
+            returned += len(items)
+            last_id = items[-1]['id']
+            if ids is not None:
+                found.update(item['id'] for item in items)
+
+        result.close()
+
+        if ids is not None:
+            tail = {'missing': [i for i in ids if i not in found]}
+        else:
+            tail = {'next': last_id if has_more else None}
+        yield '], ' + json.dumps(tail)[1:]
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _stale_keys(kind, ids):
+    """The cache keys that deleting the 'kind' rows 'ids' makes stale. Call before deleting."""
+
+    # Users and tags are dropped from every fragment showing them through their stamps, so
+    # their posts aren't looked up. See cache.py.
+    if kind == 'users':
+        return stamp_keys(user_ids=ids)
+    if kind == 'tags':
+        return stamp_keys(tag_ids=ids)
+    return post_keys(ids) + post_feed_keys(ids)
+
+
+def _delete(kind):
+    """Delete the rows of 'kind' listed in the request's ids, in one transaction."""
+
+    model, _ = FIELDS[kind]
+    ids = request.args.get('ids')
+    if ids is None:
+        abort(400, description="ids is required.")
+    ids = _parse_ids(ids)
+
+    stale_keys = _stale_keys(kind, ids)
+    try:
+        deleted = model.delete_many(ids)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    current_app.extensions['fragment_cache'].delete_many(stale_keys)
+    if kind == 'tags':
+        current_app.extensions['tag_catalog'].invalidate()
+
+    found = set(deleted)
+    return jsonify(deleted=sorted(found), missing=[i for i in ids if i not in found])
+
+
+@api.route('/users')
+def list_users():
+    """Users by id, or a page of all users."""
+    return _collection('users')
+
+
+@api.route('/posts')
+def list_posts():
+    """Posts by id, or a page of all posts, optionally with their author and tags."""
+    return _collection('posts')
+
+
+@api.route('/tags')
+def list_tags():
+    """Tags by id, or a page of all tags."""
+    return _collection('tags')
+
+
+@api.route('/users', methods=['DELETE'])
+def delete_users():
+    """Delete users by id, along with their posts."""
+    return _delete('users')
+
+
+@api.route('/posts', methods=['DELETE'])
+def delete_posts():
+    """Delete posts by id."""
+    return _delete('posts')
+
+
+@api.route('/tags', methods=['DELETE'])
+def delete_tags():
+    """Delete tags by id, taking them off their posts."""
+    return _delete('tags')
@@ -1,41 +1,209 @@
 """
    Blogly application.
    Note: As we're using the create_app() workaround instead of using `flask run` to run it, run with `python3 -m app`
+   In production, run it with `python3 -m server`, see server.py.
 """
 
-from flask import Flask, request, render_template,  redirect, flash, session
-from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Post, Tag, PostTag
+from flask import Flask, request, render_template,  redirect, flash, session, jsonify, url_for
+from markupsafe import Markup
+from models import db, connect_db, User, Post, Tag, UnknownTagError
+from cache import (cache_from_config, RECENT_POSTS_KEY, post_card_key, post_page_key, post_keys,
+                   SITE_FEED_KEY, user_feed_key, tag_feed_key, feed_keys, stamp_keys, post_stamp_keys,
+                   current_stamps, get_stamped, get_stamped_many, set_stamped, stamps_for, join_stamped)
+from feeds import feed_response, post_feed_keys
+from pool import pool_settings, engine_options, pool_stats
+from admission import admission_settings, init_admission
+from replicas import replica_settings, init_replicas, primary_reads
+from tag_catalog import TagCatalog
+from view_counts import init_view_counts
+from assets import init_assets
+from streaming import StreamedRows, stream_page
+from metrics import init_metrics
+from conditional import conditional
+from api import api
+from psycopg2.errors import QueryCanceled
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+import os
 import sys
 
-def create_app(db_name, testing=False, developing=False):
+# Deep search pages cost more and more to rank, and nobody reads them.
+MAX_SEARCH_PAGE = 50
+
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+def create_app(db_name, testing=False, developing=False, pool_size=None, max_overflow=None,
+               pool_timeout=None, pool_recycle=None, pool_pre_ping=None, pgbouncer=None,
+               statement_timeout=None, async_reads=None, replica_urls=None, read_limit=None,
+               write_limit=None, queue_size=None, queue_timeout=None):
+    """Create the Blogly app. 'db_name' is a local database name or a full database URL.
+    The pool arguments default to the BLOGLY_* environment variables, see pool.py.
+    The admission control arguments default to BLOGLY_ADMISSION_*, see admission.py.
+    'async_reads' (or BLOGLY_ASYNC_READS=1) serves the read only pages through asyncpg, see aio.py.
+    'replica_urls' (or BLOGLY_REPLICA_URLS) lists read replicas for GET requests, see replicas.py."""
 
     app = Flask(__name__)
     app.testing = testing
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql:///{db_name}'
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_name if '://' in db_name else f'postgresql:///{db_name}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS']  =  False
+    app.config.update(pool_settings(DB_POOL_SIZE=pool_size, DB_MAX_OVERFLOW=max_overflow,
+                                    DB_POOL_TIMEOUT=pool_timeout, DB_POOL_RECYCLE=pool_recycle,
+                                    DB_POOL_PRE_PING=pool_pre_ping, DB_PGBOUNCER=pgbouncer,
+                                    DB_STATEMENT_TIMEOUT=statement_timeout))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    app.config.update(replica_settings(replica_urls))
+    app.config.update(admission_settings(ADMISSION_READ_LIMIT=read_limit, ADMISSION_WRITE_LIMIT=write_limit,
+                                         ADMISSION_QUEUE_SIZE=queue_size, ADMISSION_QUEUE_TIMEOUT=queue_timeout))
     app.config['SECRET_KEY'] = "chickenzarecool21837"
+    app.config['FRAGMENT_CACHE_URL'] = os.environ.get('BLOGLY_FRAGMENT_CACHE_URL', 'memory://')
+    app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('BLOGLY_FRAGMENT_CACHE_TTL', 300))
+    app.config['FRAGMENT_CACHE_MAX_ENTRIES'] = int(os.environ.get('BLOGLY_FRAGMENT_CACHE_MAX_ENTRIES', 1000))
+    if async_reads is None:
+        async_reads = os.environ.get('BLOGLY_ASYNC_READS', '').lower() in ('1', 'true', 'yes', 'on')
+    app.config['ASYNC_READS'] = async_reads
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('BLOGLY_SLOW_REQUEST_MS', 500))
+    app.config['VIEW_FLUSH_INTERVAL'] = float(os.environ.get('BLOGLY_VIEW_FLUSH_INTERVAL', 10))
+    app.config['VIEW_FLUSH_MAX_PENDING'] = int(os.environ.get('BLOGLY_VIEW_FLUSH_MAX_PENDING', 1000))
+    app.config['VIEW_FLUSH_MAX_RETAINED'] = int(os.environ.get('BLOGLY_VIEW_FLUSH_MAX_RETAINED', 10000))
 
     if developing: 
+        # Imported here so production workers don't pay for loading it.
+        from flask_debugtoolbar import DebugToolbarExtension
+
         app.config['SQLALCHEMY_ECHO'] =  True
         app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
         debug = DebugToolbarExtension(app)
 
+    fragments = cache_from_config(app.config)
+    app.extensions['fragment_cache'] = fragments
+
+    tag_catalog = TagCatalog(fragments)
+    app.extensions['tag_catalog'] = tag_catalog
+
+    metrics = init_metrics(app)
+
+    # Right after the metrics hooks, so turned away requests are still timed but do no other work.
+    admission = init_admission(app)
+
+    init_assets(app)
+
+    app.register_blueprint(api)
+
+    replicas = init_replicas(app)
+
+    init_view_counts(app)
+
+    def render_recent_posts():
+        """Render the recent posts block, reusing any post cards that are still cached.
+        Returns the block and the stamps of the users and tags it shows."""
+
+        post_ids = Post.get_recent_post_ids()
+        cards = get_stamped_many(fragments, [post_card_key(post_id) for post_id in post_ids])
+        missing_ids = [post_id for post_id, card in zip(post_ids, cards) if card is None]
+
+        if missing_ids:
+            # The stamps are read before the posts, see current_stamps().
+            stamps = current_stamps(fragments, stamp_keys(*Post.get_authors_and_tags(missing_ids)))
+            query = Post.query.options(*Post.card_options())
+            posts = {post.id: post for post in query.filter(Post.id.in_(missing_ids))}
+
+            for i, post_id in enumerate(post_ids):
+                if cards[i] is None and post_id in posts:
+                    post = posts[post_id]
+                    cards[i] = set_stamped(fragments, post_card_key(post_id),
+                                           render_template('post-card.html', post=post),
+                                           stamps_for(stamps, post_stamp_keys([post])))
+
+        return join_stamped([card for card in cards if card is not None])
+
+    def invalidate_posts(post_ids, feeds=()):
+        """Drop every cached fragment built from the given posts, and the feeds with the given keys
+        (see post_feed_keys()). Call after committing."""
+
+        fragments.delete_many(post_keys(post_ids) + list(feeds))
+
+    def invalidate_names(user_ids=(), tag_ids=()):
+        """Drop every cached fragment and feed showing the given users or tags, by deleting their
+        stamps. Call after committing."""
+
+        fragments.delete_many(stamp_keys(user_ids, tag_ids))
+
+    @app.errorhandler(OperationalError)
+    @app.errorhandler(PoolTimeoutError)
+    def handle_database_overload(e):
+        """Answer 503 when a query hits the statement timeout or no connection is free in time."""
+
+        if isinstance(e, OperationalError) and not isinstance(e.orig, QueryCanceled):
+            raise e
+
+        db.session.rollback()
+        return "The database is busy, please try again shortly.", 503, {"Retry-After": "5"}
+
+    @app.route('/status/pool')
+    def show_pool_stats():
+        """Show connection pool usage and checkout wait times as JSON."""
+
+        return jsonify(pool_stats(db.engine))
+
+    @app.route('/status/replicas')
+    def show_replica_status():
+        """Show each read replica's health and replication lag as JSON."""
+
+        return jsonify(replicas.status() if replicas else [])
+
+    @app.route('/status/admission')
+    def show_admission_stats():
+        """Show requests in flight, queued and turned away per admission budget as JSON."""
+
+        return jsonify(admission.stats())
+
+    @app.route('/metrics')
+    def show_metrics():
+        """Show per route request metrics, pool usage and admission control in the Prometheus text format."""
+
+        pool = pool_stats(db.engine)
+        gauges = {f"blogly_db_pool_{name}": value for name, value in pool.items()
+                  if isinstance(value, (int, float))}
+        for budget, stats in admission.stats().items():
+            gauges.update({f"blogly_admission_{budget}_{name}": value for name, value in stats.items()})
+
+        return metrics.render(gauges), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
     @app.route('/')
+    @conditional(lambda: Post.recent_versions())
     def home():
         """Blogly's home page. Shows the 5 latest posts."""
 
-        recent_posts = Post.get_recent_posts()
+        recent_posts = get_stamped(fragments, RECENT_POSTS_KEY)
+        if recent_posts is None:
+            with primary_reads():
+                block, stamps = render_recent_posts()
+            recent_posts = set_stamped(fragments, RECENT_POSTS_KEY, block, stamps)
         
-        return render_template('home.html', posts=recent_posts)
+        return render_template('home.html', recent_posts=Markup(recent_posts["value"]))
+
+    @app.route('/feed.xml')
+    def site_feed():
+        """Atom feed of the latest posts."""
+
+        return feed_response(SITE_FEED_KEY, lambda: {
+            "title": "Blogly",
+            "page_url": url_for('home', _external=True)})
 
     @app.route('/users')
+    @conditional(lambda: User.page_versions(after=request.args.get("after"), before=request.args.get("before")))
     def list_users():
-        """Shows list of all users in db"""
+        """Shows a page of the users in db"""
         
-        users = User.query.all()
+        users = User.get_page(after=request.args.get("after"), before=request.args.get("before"))
         return render_template('users.html', users=users)
 
+    @app.route('/users/all')
+    def list_all_users():
+        """Stream a page listing every user"""
+
+        return stream_page('users.html', users=StreamedRows(User.all_select()))
+
     @app.route('/users/new')
     def show_create_user_form():
         """Show a form that can be used to create a user"""
@@ -61,13 +229,26 @@ def create_app(db_name, testing=False, developing=False):
         return redirect(f'/users')
 
     @app.route('/users/<int:user_id>')
+    @conditional(lambda user_id: User.detail_versions(user_id, after=request.args.get("after"), before=request.args.get("before")))
     def show_user_detail_page(user_id):
         """Show a page that includes details about a specific user. 
         THe page also has an edit button and a delete button to perform actions on the user."""
         
         user = User.query.get_or_404(user_id)
+        posts = Post.get_page_for_user(user_id, after=request.args.get("after"), before=request.args.get("before"))
 
-        return render_template("user-details.html", user=user)
+        return render_template("user-details.html", user=user, posts=posts)
+
+    @app.route('/users/<int:user_id>/feed.xml')
+    def user_feed(user_id):
+        """Atom feed of a user's latest posts."""
+
+        def build():
+            user = User.query.get_or_404(user_id)
+            return {"title": f"Blogly: posts by {user.full_name}",
+                    "page_url": url_for('show_user_detail_page', user_id=user_id, _external=True)}
+
+        return feed_response(user_feed_key(user_id), build, user_id=user_id)
 
     @app.route('/users/<int:user_id>/edit')
     def show_edit_user_form(user_id):
@@ -99,6 +280,7 @@ def create_app(db_name, testing=False, developing=False):
         try: 
             # db.session.add(user) # don't think session.add() is necessary
             db.session.commit()
+            invalidate_names(user_ids=[user_id])
             flash(f"User updated!", "success")
         except:
             db.session.rollback()
@@ -112,8 +294,10 @@ def create_app(db_name, testing=False, developing=False):
         user_to_delete = User.query.get_or_404(user_id)
 
         try: 
-            db.session.delete(user_to_delete)
+            user_to_delete.delete()
             db.session.commit()
+            # Every fragment and feed showing one of the user's posts shows the user too.
+            invalidate_names(user_ids=[user_id])
             flash(f"User deleted!", "success")
         except:
             db.session.rollback()
@@ -126,9 +310,8 @@ def create_app(db_name, testing=False, developing=False):
         """Show a form that can be used to create a new post for a user"""
 
         user = User.query.get_or_404(user_id)
-        tags = Tag.query.all()
 
-        return render_template('create-post.html', user=user, tags=tags)
+        return render_template('create-post.html', user=user)
 
     @app.route('/users/<int:user_id>/posts/new', methods=["POST"])
     def create_post(user_id):
@@ -138,17 +321,16 @@ def create_app(db_name, testing=False, developing=False):
         content = request.form["content"]
         tag_ids = request.form.getlist("tags")
 
-        new_post = Post(title=title, content=content, user_id=user_id)
-        
-        for tag_id in tag_ids:
-            tag = Tag.query.get(tag_id)
-            new_post.tags.append(tag)
-        
         try: 
-            db.session.add(new_post)
+            Post.create(user_id, title, content, tag_ids)
             db.session.commit()
+            # The tag ids were all valid, or create() would have raised.
+            fragments.delete_many([RECENT_POSTS_KEY] + feed_keys([user_id], [int(tag_id) for tag_id in tag_ids]))
 
             flash(f"New post created!", "success")
+        except UnknownTagError as e:
+            db.session.rollback()
+            flash(str(e), "warning")
         except:
             db.session.rollback()
             flash(f"Something went wrong :/", "warning")
@@ -156,28 +338,39 @@ def create_app(db_name, testing=False, developing=False):
         return redirect(f'/users/{user_id}')
 
     @app.route('/posts/<int:post_id>')
+    @conditional(lambda post_id: Post.detail_versions(post_id))
     def show_post(post_id):
         """Show a post page"""
 
-        post = Post.query.get_or_404(post_id)
-        print(f"\nPost Tags: {post.tags}")
+        page = get_stamped(fragments, post_page_key(post_id))
+        if page is None:
+            with primary_reads():
+                # The stamps are read before the post, see current_stamps().
+                stamps = current_stamps(fragments, stamp_keys(*Post.get_authors_and_tags([post_id])))
+                post = Post.get_with_relations(post_id)
+                page = set_stamped(fragments, post_page_key(post_id),
+                                   {"title": post.title, "body": render_template('post-details.html', post=post)},
+                                   stamps_for(stamps, post_stamp_keys([post])))
+
+        page = page["value"]
+
+        return render_template('post.html', title=page["title"], body=Markup(page["body"]))
 
-        return render_template('post.html', post=post)
+    @app.route('/posts/most-viewed')
+    def list_most_viewed_posts():
+        """Show the most viewed posts, by their last flushed view counts."""
+
+        posts = Post.get_most_viewed()
+
+        return render_template('most-viewed.html', posts=posts)
 
     @app.route('/posts/<int:post_id>/edit')
     def show_edit_post_form(post_id):
         """Show a form that can be used to edit a user's post"""
 
-        post = Post.query.get_or_404(post_id)
-
-        #TODO: Turn this into a model function
-        post_tags_objs = post.tags
-        post_tags = [tag_obj.name for tag_obj in post_tags_objs]
-        tags = Tag.query.all()
-
-        print(f"\nEDIT POST: {post}, Post Tags: {post_tags}")
+        post = Post.get_with_relations(post_id, with_author=False)
 
-        return render_template('edit-post.html', post=post, tags=tags, post_tags=post_tags)
+        return render_template('edit-post.html', post=post)
 
     @app.route('/posts/<int:post_id>/edit', methods=["POST"])
     def edit_post(post_id):
@@ -188,31 +381,21 @@ def create_app(db_name, testing=False, developing=False):
         tag_ids = request.form.getlist("tags")
 
         post = Post.query.get_or_404(post_id)
+        feeds = post_feed_keys([post_id])
 
-        #TODO: Turn this into a model function
-        post_tags_objs = post.tags
-        post_tags = [tag_obj.name for tag_obj in post_tags_objs]
-        form_tags_objs = [Tag.query.get(tag_id) for tag_id in tag_ids]
-
-        for form_tag_obj in form_tags_objs:
-            # if post didn't have tag, append tag
-            if form_tag_obj not in post_tags_objs:
-                post.tags.append(form_tag_obj)
-
-        for tag_obj in post_tags_objs:
-            # If existing post tag not in form data, mark it for deletion
-            if tag_obj not in form_tags_objs:
-                posts_tags_obj = PostTag.query.get((post_id, tag_obj.id) )
-                db.session.delete(posts_tags_obj)
-
-        # Update other post data
         post.title = title
         post.content = content
         
         try: 
             # db.session.add(post) # don't think session.add() is necessary
+            post.set_tags(tag_ids)
             db.session.commit()
+            # The tag ids were all valid, or set_tags() would have raised.
+            invalidate_posts([post_id], feeds + feed_keys(tag_ids=[int(tag_id) for tag_id in tag_ids]))
             flash(f"Post updated!", "success")
+        except UnknownTagError as e:
+            db.session.rollback()
+            flash(str(e), "warning")
         except Exception as e:
             db.session.rollback()
             flash(f"Something went wrong: {str(e)}", "warning")
@@ -224,12 +407,13 @@ def create_app(db_name, testing=False, developing=False):
     def delete_post(post_id):
 
         post_to_delete = Post.query.get_or_404(post_id)
-        author_id = post_to_delete.user.id
-
-        db.session.delete(post_to_delete)
+        author_id = post_to_delete.user_id
+        feeds = post_feed_keys([post_id])
         
         try: 
+            post_to_delete.delete()
             db.session.commit()
+            invalidate_posts([post_id], feeds)
             flash(f"Post deleted!", "success")
         except:
             db.session.rollback()
@@ -237,22 +421,70 @@ def create_app(db_name, testing=False, developing=False):
 
         return redirect(f'/users/{author_id}')
 
+    @app.route('/search')
+    def search_posts():
+        """Show the posts matching the 'q' query string, best matches first."""
+
+        terms = request.args.get("q", "").strip()
+        page = min(max(request.args.get("page", 1, type=int), 1), MAX_SEARCH_PAGE)
+
+        results = Post.search(terms, page=page) if terms else None
+
+        return render_template('search.html', terms=terms, results=results)
+
     @app.route('/tags')
+    @conditional(lambda: Tag.page_versions(after=request.args.get("after"), before=request.args.get("before")))
     def list_tags():
-        """Shows list of all tags in db"""
+        """Shows a page of the tags in db"""
         
-        tags = Tag.query.all()
-        return render_template('tags.html', tags=tags)
+        tags = Tag.get_page(after=request.args.get("after"), before=request.args.get("before"))
+        popular_tags = Tag.get_most_popular()
+        return render_template('tags.html', tags=tags, popular_tags=popular_tags)
+
+    @app.route('/tags/all')
+    def list_all_tags():
+        """Stream a page listing every tag"""
+
+        popular_tags = Tag.get_most_popular()
+        return stream_page('tags.html', tags=StreamedRows(Tag.all_select()), popular_tags=popular_tags)
+
+    @app.route('/tags/autocomplete')
+    def autocomplete_tags():
+        """Return the tags whose names start with the 'prefix' query string as JSON, from the tag catalog."""
+
+        prefix = request.args.get("prefix", "").strip()
+        limit = min(max(request.args.get("limit", AUTOCOMPLETE_LIMIT, type=int), 1), MAX_AUTOCOMPLETE_LIMIT)
+
+        return jsonify([{"id": tag_id, "name": name} for tag_id, name in tag_catalog.lookup(prefix, limit)])
 
     @app.route('/tags/<int:tag_id>')
+    @conditional(lambda tag_id: Tag.detail_versions(tag_id, after=request.args.get("after"), before=request.args.get("before")))
     def show_tag_detail_page(tag_id):
-        """Show a page that shows all of the posts that have the provided tag."""
+        """Show a page that shows a page of the posts that have the provided tag."""
         
         tag = Tag.query.get_or_404(tag_id)
-        posts = tag.posts
+        posts = Post.get_page_for_tag(tag_id, after=request.args.get("after"), before=request.args.get("before"))
 
         return render_template("tag-details.html", tag=tag, posts=posts)
 
+    @app.route('/tags/<int:tag_id>/feed.xml')
+    def tag_feed(tag_id):
+        """Atom feed of the latest posts with a tag."""
+
+        def build():
+            tag = Tag.query.get_or_404(tag_id)
+            return {"title": f"Blogly: {tag.name}",
+                    "page_url": url_for('show_tag_detail_page', tag_id=tag_id, _external=True)}
+
+        return feed_response(tag_feed_key(tag_id), build, tag_id=tag_id)
+
+    @app.route('/tags/<int:tag_id>/all')
+    def show_all_tag_posts(tag_id):
+        """Stream a tag's page listing every post with the tag."""
+
+        tag = Tag.query.get_or_404(tag_id)
+        return stream_page("tag-details.html", tag=tag, posts=StreamedRows(Post.tag_select(tag_id)))
+
     @app.route('/tags/new')
     def show_create_tag_form():
         """Show a form that can be used to create a post tag"""
@@ -269,6 +501,7 @@ def create_app(db_name, testing=False, developing=False):
         try: 
             db.session.add(tag)
             db.session.commit()
+            tag_catalog.invalidate()
             flash(f"New tag created!", "success")
         except:
             db.session.rollback()
@@ -297,6 +530,8 @@ def create_app(db_name, testing=False, developing=False):
         try: 
             # db.session.add(tag) # don't think session.add() is necessary
             db.session.commit()
+            invalidate_names(tag_ids=[tag_id])
+            tag_catalog.invalidate()
             flash(f"Tag updated!", "success")
         except:
             db.session.rollback()
@@ -310,14 +545,21 @@ def create_app(db_name, testing=False, developing=False):
         tag_to_delete = Tag.query.get_or_404(tag_id)
 
         try: 
-            db.session.delete(tag_to_delete)
+            tag_to_delete.delete()
             db.session.commit()
+            invalidate_names(tag_ids=[tag_id])
+            tag_catalog.invalidate()
             flash(f"Tag deleted!", "success")
         except:
             db.session.rollback()
             flash(f"Something went wrong :/", "warning")
 
         return redirect(f'/tags')
+
+    if app.config['ASYNC_READS']:
+        # Imported here so the sync app doesn't need asyncpg installed.
+        from aio import install_async_views
+        install_async_views(app, fragments)
     
     return app
 
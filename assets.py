@@ -0,0 +1,185 @@
+"""Fingerprinted, precompressed static assets for Blogly.
+
+`python3 -m assets build` copies every file in static/ to static/dist/ under a
+content hashed name (style.css -> dist/style.1a2b3c4d.css), next to a gzipped
+.gz copy and, if the `brotli` package is installed, a .br copy. The names are
+recorded in static/dist/manifest.json. Run it whenever an asset changes, as
+part of a deploy.
+
+With a manifest present, `url_for('static', filename='style.css')` gives the
+hashed URL, which is served with `Cache-Control: public, max-age=31536000,
+immutable` so browsers never revalidate it, and with the .br or .gz copy when
+the request's Accept-Encoding allows. A changed file gets a new name, so pages
+pick it up straight away. Without a manifest (e.g. in development) url_for
+gives the plain static URL, served by Flask as usual. Templates should only
+reference assets through url_for.
+
+Old hashed files are left in dist/ so pages rendered before a deploy still
+load their assets. Bootstrap comes from its CDN under a versioned URL.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import sys
+
+from flask import request, send_from_directory
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 8
+
+# A year, the longest lifetime caches are expected to honor.
+IMMUTABLE_MAX_AGE = 31536000
+
+# Preferred first.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _source_files(static_folder):
+    """The asset files under 'static_folder', relative to it, skipping the build output."""
+
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST_DIR in dirs:
+            dirs.remove(DIST_DIR)
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+
+
+def _hashed_name(filename, content):
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    stem, suffix = os.path.splitext(filename)
+    return f"{stem}.{digest}{suffix}"
+
+
+def build(static_folder, log=print):
+    """Write the fingerprinted and compressed copies of every asset and the manifest.
+    Returns the manifest, a dict of asset name -> hashed name under dist/."""
+
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        log("brotli isn't installed, skipping .br files. Run `pip install brotli` to build them.")
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+
+    for filename in _source_files(static_folder):
+        with open(os.path.join(static_folder, filename), 'rb') as f:
+            content = f.read()
+
+        hashed = _hashed_name(filename, content)
+        manifest[filename] = hashed
+
+        path = os.path.join(dist, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        # mtime=0 keeps the .gz byte for byte the same across builds.
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(content))
+
+        log(f"{filename} -> {DIST_DIR}/{hashed}")
+
+    # Written last, so a build that dies halfway leaves the previous manifest in place.
+    manifest_path = os.path.join(dist, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return manifest
+
+
+def clean(static_folder):
+    """Delete the build output, old hashed files included."""
+    shutil.rmtree(os.path.join(static_folder, DIST_DIR), ignore_errors=True)
+
+
+class Assets:
+    """The app's asset manifest, and which compressed copies exist for each hashed file."""
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self.reload()
+
+    def reload(self):
+        """Read the manifest again, after a build."""
+
+        dist = os.path.join(self.static_folder, DIST_DIR)
+        try:
+            with open(os.path.join(dist, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+
+        self.urls = {filename: f"{DIST_DIR}/{hashed}" for filename, hashed in manifest.items()}
+        self.encodings = {}
+        for path in self.urls.values():
+            self.encodings[path] = [(encoding, suffix) for encoding, suffix in ENCODINGS
+                                    if os.path.exists(os.path.join(self.static_folder, path + suffix))]
+
+        # Changes whenever any asset does, for pages that are cached with their asset URLs in them.
+        self.version = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+    def serve(self, filename, send_static_file):
+        """Serve a hashed file with immutable caching, compressed if the client accepts it.
+        Anything else goes to 'send_static_file'."""
+
+        encodings = self.encodings.get(filename)
+        if encodings is None:
+            return send_static_file(filename)
+
+        encoding, suffix = next(((encoding, suffix) for encoding, suffix in encodings
+                                 if request.accept_encodings[encoding]), (None, ''))
+
+        response = send_from_directory(self.static_folder, filename + suffix,
+                                       mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                       max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+def init_assets(app):
+    """Point url_for('static', ...) at the built assets and serve them. Returns the app's Assets."""
+
+    assets = Assets(app.static_folder)
+    app.extensions['assets'] = assets
+
+    @app.url_defaults
+    def fingerprint_static_url(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in assets.urls:
+            values['filename'] = assets.urls[values['filename']]
+
+    app.view_functions['static'] = lambda filename: assets.serve(filename, app.send_static_file)
+
+    return assets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build Blogly's fingerprinted static assets.")
+    parser.add_argument('command', choices=['build', 'clean'])
+    args = parser.parse_args(argv)
+
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    if args.command == 'build':
+        build(static_folder)
+    else:
+        clean(static_folder)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
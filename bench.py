@@ -0,0 +1,351 @@
+"""Route level benchmarks for Blogly against a synthetic dataset of any size.
+
+Generate a dataset (this drops and recreates every table in the db):
+
+    python3 -m bench generate --db blogly_bench --users 100000 --posts 5000000 --tags 10000
+
+Rows are streamed into Postgres with COPY. Tag usage follows a Zipf
+distribution, so a few tags are on a large share of posts like in real data.
+
+Benchmark every route, either in process through the Flask test client or
+over real HTTP against a running server:
+
+    python3 -m bench run --db blogly_bench --requests 200 --output before.json
+    python3 -m bench run --db blogly_bench --url http://127.0.0.1:5000 --concurrency 16 --output before.json
+
+Start the server for an HTTP run with BLOGLY_ADMISSION_READ_LIMIT=0 and
+BLOGLY_ADMISSION_WRITE_LIMIT=0, or at least as high as --concurrency, so the
+run measures the routes and not the admission limits (admission.py).
+
+The JSON report has p50/p95/p99 latency, throughput and SQL queries per
+request (read from the Server-Timing header) for each route, ready to diff
+between versions. Write routes are only exercised with --writes, and never
+delete anything.
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+from bulk import copy_rows, fix_sequence
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua city streets robotaxis grass turf corn pigs rule planning "
+         "agriculture future world growing thoughts reasons travel coffee garden music").split()
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def generate(db_name, users, posts, tags, tags_per_post, zipf_s, seed):
+    from app import create_app
+    from models import db, connect_db, REPAIR_USER_POST_COUNTS_SQL, REPAIR_TAG_POST_COUNTS_SQL
+
+    rng = random.Random(seed)
+    app = create_app(db_name, statement_timeout=0)
+    connect_db(app)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        raw = db.engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            started = time.perf_counter()
+
+            copy_rows(cursor, 'users', ('id', 'first_name', 'last_name', 'image_url'),
+                      ((i, f"First{i}", rng.choice(WORDS).title() + str(i % 997), "https://example.com/u.jpg")
+                       for i in range(1, users + 1)))
+
+            copy_rows(cursor, 'tags', ('id', 'name'), ((i, f"tag-{i}") for i in range(1, tags + 1)))
+
+            newest = datetime(2024, 1, 1, tzinfo=timezone.utc)
+            copy_rows(cursor, 'posts', ('id', 'title', 'content', 'created_at', 'user_id'),
+                      ((i, _words(rng, 4).title(), _words(rng, rng.randint(20, 200)),
+                        newest - timedelta(seconds=rng.randint(0, 5 * 365 * 24 * 3600)),
+                        rng.randint(1, users))
+                       for i in range(1, posts + 1)))
+
+            # Zipf: the tag ranked r is used with weight 1 / r^s.
+            tag_ids = list(range(1, tags + 1))
+            cum_weights = []
+            total = 0.0
+            for rank in tag_ids:
+                total += 1 / rank ** zipf_s
+                cum_weights.append(total)
+
+            def post_tags():
+                for post_id in range(1, posts + 1):
+                    count = min(tags, rng.randint(0, 2 * tags_per_post))
+                    for tag_id in set(rng.choices(tag_ids, cum_weights=cum_weights, k=count)):
+                        yield post_id, tag_id
+
+            links = copy_rows(cursor, 'posts_tags', ('post_id', 'tag_id'), post_tags())
+
+            for table in ('users', 'posts', 'tags'):
+                fix_sequence(cursor, table)
+            cursor.execute(REPAIR_USER_POST_COUNTS_SQL)
+            cursor.execute(REPAIR_TAG_POST_COUNTS_SQL)
+            cursor.execute("ANALYZE")
+            raw.commit()
+        finally:
+            raw.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {users} users, {posts} posts, {tags} tags and {links} post tags in {elapsed:.1f}s")
+
+
+class RouteSampler:
+    """Builds request paths with random ids that exist in the benchmarked db."""
+
+    def __init__(self, app, seed):
+        from models import db, User, Post, Tag
+
+        self.rng = random.Random(seed)
+        with app.app_context():
+            self.max_user = db.session.query(db.func.max(User.id)).scalar() or 1
+            self.max_post = db.session.query(db.func.max(Post.id)).scalar() or 1
+            self.max_tag = db.session.query(db.func.max(Tag.id)).scalar() or 1
+            self.counts = {'users': User.query.count(), 'posts': Post.query.count(), 'tags': Tag.query.count()}
+
+    def reads(self):
+        rng = self.rng
+        return {
+            'home': lambda: '/',
+            'list_users': lambda: '/users',
+            'show_user_detail_page': lambda: f'/users/{rng.randint(1, self.max_user)}',
+            'show_edit_user_form': lambda: f'/users/{rng.randint(1, self.max_user)}/edit',
+            'show_create_user_form': lambda: '/users/new',
+            'show_create_post_form': lambda: f'/users/{rng.randint(1, self.max_user)}/posts/new',
+            'show_post': lambda: f'/posts/{rng.randint(1, self.max_post)}',
+            'show_edit_post_form': lambda: f'/posts/{rng.randint(1, self.max_post)}/edit',
+            'list_most_viewed_posts': lambda: '/posts/most-viewed',
+            'list_tags': lambda: '/tags',
+            # Low tag ids are the most popular ones under the Zipf distribution.
+            'show_tag_detail_page': lambda: f'/tags/{min(self.max_tag, int(rng.paretovariate(1)))}',
+            'show_edit_tag_form': lambda: f'/tags/{rng.randint(1, self.max_tag)}/edit',
+            'show_create_tag_form': lambda: '/tags/new',
+            'search_posts': lambda: f'/search?q={urllib.parse.quote(rng.choice(WORDS))}',
+        }
+
+    def writes(self):
+        rng = self.rng
+        return {
+            'create_user': lambda: ('/users/new', {'first_name': 'Bench', 'last_name': _words(rng, 1),
+                                                   'image_url': ''}),
+            'edit_user': lambda: (f'/users/{rng.randint(1, self.max_user)}/edit',
+                                  {'first_name': 'Bench', 'last_name': _words(rng, 1), 'image_url': ''}),
+            'create_post': lambda: (f'/users/{rng.randint(1, self.max_user)}/posts/new',
+                                    {'title': _words(rng, 4), 'content': _words(rng, 50),
+                                     'tags': [str(rng.randint(1, self.max_tag))]}),
+            'edit_post': lambda: (f'/posts/{rng.randint(1, self.max_post)}/edit',
+                                  {'title': _words(rng, 4), 'content': _words(rng, 50),
+                                   'tags': [str(rng.randint(1, self.max_tag))]}),
+            'create_tag': lambda: ('/tags/new', {'name': f"bench-{rng.getrandbits(48):x}"}),
+        }
+
+
+def _queries(server_timing):
+    # Server-Timing looks like: app;dur=1.2, db;dur=0.4;desc="3 queries", tpl;dur=0.3
+    for part in (server_timing or '').split(','):
+        if 'desc="' in part and part.strip().startswith('db;'):
+            return int(part.split('desc="')[1].split()[0])
+    return None
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _summarize(latencies, queries, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(_percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def bench_client(app, make_request, requests):
+    """Time 'requests' calls to a route through the Flask test client, one at a time."""
+
+    latencies, queries, errors = [], [], 0
+    client = app.test_client()
+    started = time.perf_counter()
+
+    for _ in range(requests):
+        request = make_request()
+        t0 = time.perf_counter()
+        if isinstance(request, tuple):
+            resp = client.post(request[0], data=request[1])
+        else:
+            resp = client.get(request)
+        elapsed = time.perf_counter() - t0
+
+        if resp.status_code >= 500:
+            errors += 1
+            continue
+        latencies.append(elapsed)
+        count = _queries(resp.headers.get('Server-Timing'))
+        if count is not None:
+            queries.append(count)
+
+    return _summarize(latencies, queries, errors, time.perf_counter() - started)
+
+
+def bench_http(base_url, make_request, requests, concurrency):
+    """Time 'requests' calls to a route over HTTP from 'concurrency' threads."""
+
+    latencies, queries, errors = [], [], [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    opener = urllib.request.build_opener(NoRedirect)
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                request = make_request()
+
+            if isinstance(request, tuple):
+                data = urllib.parse.urlencode(request[1], doseq=True).encode()
+                req = urllib.request.Request(base_url + request[0], data=data)
+            else:
+                req = urllib.request.Request(base_url + request)
+
+            t0 = time.perf_counter()
+            try:
+                with opener.open(req, timeout=60) as resp:
+                    resp.read()
+                    status, timing = resp.status, resp.headers.get('Server-Timing')
+            except urllib.error.HTTPError as e:
+                status, timing = e.code, e.headers.get('Server-Timing')
+            except OSError:
+                status, timing = None, None
+            elapsed = time.perf_counter() - t0
+
+            with lock:
+                if status is None or status >= 500:
+                    errors[0] += 1
+                    continue
+                latencies.append(elapsed)
+                count = _queries(timing)
+                if count is not None:
+                    queries.append(count)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return _summarize(latencies, queries, errors[0], time.perf_counter() - started)
+
+
+def run(db_name, url, requests, concurrency, writes, no_cache, routes, seed, output):
+    import os
+    from app import create_app
+    from models import connect_db
+
+    if no_cache:
+        os.environ['BLOGLY_FRAGMENT_CACHE_TTL'] = '0'
+
+    app = create_app(db_name)
+    connect_db(app)
+    sampler = RouteSampler(app, seed)
+
+    targets = sampler.reads()
+    if writes:
+        targets.update(sampler.writes())
+    if routes:
+        targets = {name: make_request for name, make_request in targets.items() if name in routes}
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=False).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'mode': 'http' if url else 'client',
+        'concurrency': concurrency if url else 1,
+        'requests_per_route': requests,
+        'dataset': sampler.counts,
+        'routes': {},
+    }
+
+    print(f"{'route':<24}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}")
+    for name, make_request in targets.items():
+        if url:
+            result = bench_http(url.rstrip('/'), make_request, requests, concurrency)
+        else:
+            result = bench_client(app, make_request, requests)
+        report['routes'][name] = result
+        print(f"{name:<24}{result['p50_ms']!s:>9}{result['p95_ms']!s:>9}{result['p99_ms']!s:>9}"
+              f"{result['throughput_rps']!s:>9}{result['queries_per_request']!s:>9}")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Wrote {output}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Blogly routes against a synthetic dataset.")
+    parser.add_argument('--db', default='blogly_bench', help="database name (default: blogly_bench)")
+    parser.add_argument('--seed', type=int, default=1)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help="replace the db contents with a synthetic dataset")
+    gen.add_argument('--users', type=int, default=1000)
+    gen.add_argument('--posts', type=int, default=20000)
+    gen.add_argument('--tags', type=int, default=200)
+    gen.add_argument('--tags-per-post', type=int, default=3, help="average number of tags per post")
+    gen.add_argument('--zipf', type=float, default=1.1, help="Zipf exponent of tag usage")
+
+    bench = commands.add_parser('run', help="benchmark every route")
+    bench.add_argument('--url', help="benchmark a running server over HTTP instead of the test client")
+    bench.add_argument('--requests', type=int, default=200, help="requests per route")
+    bench.add_argument('--concurrency', type=int, default=8, help="client threads in HTTP mode")
+    bench.add_argument('--writes', action='store_true', help="also benchmark the create and edit routes")
+    bench.add_argument('--no-cache', action='store_true', help="turn the fragment cache off (test client only)")
+    bench.add_argument('--route', action='append', dest='routes', help="only benchmark this route, repeatable")
+    bench.add_argument('--output', help="write the JSON report here")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        generate(args.db, args.users, args.posts, args.tags, args.tags_per_post, args.zipf, args.seed)
+    else:
+        run(args.db, args.url, args.requests, args.concurrency, args.writes, args.no_cache,
+            args.routes, args.seed, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Compare requests/sec of the sync and async (aio.py) read paths at the same concurrency.
+
+Each mode gets its own threaded HTTP server on the given db, then every read only
+route is hammered by the same number of client threads for a fixed time. The
+fragment cache is turned off so every request reaches the db, and the read
+admission limit (admission.py) is lifted so all the threads are served at once.
+
+Run with `python3 -m bench_async --db blogly --concurrency 32 --seconds 10`.
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import make_server
+
+
+def _routes(app):
+    from models import User, Post, Tag
+
+    with app.app_context():
+        user = User.query.first()
+        post = Post.query.first()
+        tag = Tag.query.first()
+
+    routes = ['/', '/users', '/tags']
+    if user:
+        routes.append(f'/users/{user.id}')
+    if post:
+        routes.append(f'/posts/{post.id}')
+    if tag:
+        routes.append(f'/tags/{tag.id}')
+    return routes
+
+
+def _hammer(url, concurrency, seconds):
+    """Request 'url' from 'concurrency' threads for 'seconds' and return (requests, errors)."""
+
+    counts = [0] * concurrency
+    errors = [0] * concurrency
+    deadline = time.perf_counter() + seconds
+
+    def worker(i):
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=30) as resp:
+                    resp.read()
+                counts[i] += 1
+            except (urllib.error.URLError, OSError):
+                errors[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return sum(counts), sum(errors)
+
+
+def run_mode(db_name, async_reads, concurrency, seconds, port):
+    from app import create_app
+    from models import connect_db
+
+    os.environ['BLOGLY_FRAGMENT_CACHE_TTL'] = '0'
+    app = create_app(db_name, async_reads=async_reads, pool_size=concurrency, read_limit=0)
+    connect_db(app)
+
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    results = {}
+    try:
+        for route in _routes(app):
+            url = f'http://127.0.0.1:{port}{route}'
+            _hammer(url, concurrency, min(1, seconds))  # warm up pools and caches
+            requests, errors = _hammer(url, concurrency, seconds)
+            results[route] = {'requests_per_sec': round(requests / seconds, 1), 'errors': errors}
+    finally:
+        server.shutdown()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync and async read paths.")
+    parser.add_argument('--db', default='blogly', help="database name (default: blogly)")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    results = {
+        'concurrency': args.concurrency,
+        'sync': run_mode(args.db, False, args.concurrency, args.seconds, args.port),
+        'async': run_mode(args.db, True, args.concurrency, args.seconds, args.port + 1),
+    }
+
+    print(f"{'route':<20}{'sync req/s':>12}{'async req/s':>13}")
+    for route, sync in results['sync'].items():
+        async_ = results['async'][route]
+        print(f"{route:<20}{sync['requests_per_sec']:>12}{async_['requests_per_sec']:>13}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
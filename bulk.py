@@ -0,0 +1,354 @@
+"""Streaming bulk import and export of Blogly users, tags and posts.
+
+    python3 -m bulk --db blogly export users --format jsonl --output users.jsonl
+    python3 -m bulk --db blogly import posts posts.csv
+    python3 -m bulk --db blogly repair-counts
+
+Files are JSON Lines (one object per line) or CSV with a header row, picked by
+--format or the file extension; `-` means stdin/stdout. Records look like:
+
+    users  {"id": 1, "first_name": "Condor", "last_name": "Smith", "image_url": "https://..."}
+    tags   {"id": 1, "name": "City Planning"}
+    posts  {"id": 1, "title": "...", "content": "...", "created_at": "2023-05-01T10:30:00+00:00",
+            "user_id": 1, "tags": ["City Planning", "Agriculture"]}
+
+In CSV, a post's tags are joined with "|". Ids are optional. A created_at
+without a UTC offset is read in the db session's time zone.
+Posts refer to tags by name. Tag names are resolved to ids one batch at a time,
+and missing tags are created. Rows go in with COPY, one batch per transaction,
+so memory use stays flat and a failed import keeps the batches before it. The
+id sequences are moved past the imported ids at the end, and the users' and
+tags' post counts are bumped batch by batch. `repair-counts` recounts them all.
+
+Imports bypass the app, so cached pages catch up when their TTL runs out.
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import islice
+
+COPY_BATCH_ROWS = 50000
+DEFAULT_BATCH_SIZE = 10000
+CSV_TAG_SEPARATOR = "|"
+
+# A post's tag names, looked up per row through the posts_tags primary key so the
+# export streams instead of aggregating the whole table first.
+POST_TAG_NAMES_SQL = ("ARRAY(SELECT t.name FROM posts_tags pt JOIN tags t ON t.id = pt.tag_id "
+                      "WHERE pt.post_id = p.id ORDER BY t.name)")
+
+EXPORT_COLUMNS = {
+    'users': ('id', 'first_name', 'last_name', 'image_url'),
+    'tags': ('id', 'name'),
+    'posts': ('id', 'title', 'content', 'created_at', 'user_id', 'tags'),
+}
+
+
+def export_query(table, fmt):
+    """The SELECT that export_table() streams for 'table'."""
+
+    if table == 'users':
+        return "SELECT id, first_name, last_name, image_url FROM users ORDER BY id"
+    if table == 'tags':
+        return "SELECT id, name FROM tags ORDER BY id"
+
+    tags = POST_TAG_NAMES_SQL
+    if fmt == 'csv':
+        tags = f"array_to_string({tags}, '{CSV_TAG_SEPARATOR}')"
+    return f"SELECT p.id, p.title, p.content, p.created_at, p.user_id, {tags} AS tags FROM posts p ORDER BY p.id"
+
+
+def _copy_escape(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream 'rows' (an iterable of tuples) into 'table' with COPY, COPY_BATCH_ROWS at a time.
+    Returns the number of rows copied."""
+
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    buffer = io.StringIO()
+    count = 0
+
+    for row in rows:
+        buffer.write("\t".join(_copy_escape(value) for value in row))
+        buffer.write("\n")
+        count += 1
+        if count % COPY_BATCH_ROWS == 0:
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+            buffer = io.StringIO()
+
+    if buffer.tell():
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+    return count
+
+
+class Progress:
+    """Prints rows/sec to stderr every few seconds and at the end."""
+
+    def __init__(self, label, every=5.0):
+        self.label = label
+        self.every = every
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.last_report = self.started
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.last_report >= self.every:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.rows / elapsed if elapsed else 0
+        print(f"{self.label}: {self.rows} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec)", file=sys.stderr)
+
+
+# Reading and writing records
+
+def _detect_format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def read_records(stream, fmt):
+    """Yield one dict per record in 'stream'."""
+
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            if 'tags' in row:
+                row['tags'] = [name for name in (row['tags'] or '').split(CSV_TAG_SEPARATOR) if name]
+            yield {key: (value if value != '' else None) for key, value in row.items()}
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# Export
+
+def export_table(raw, table, fmt, stream, progress):
+    query = export_query(table, fmt)
+    cursor = raw.cursor()
+
+    if fmt == 'csv':
+        # COPY streams the rows straight from the server.
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", stream)
+        cursor.execute(f"SELECT count(*) FROM {table}")
+        progress.add(cursor.fetchone()[0])
+        return
+
+    # A named (server side) cursor fetches the rows a batch at a time.
+    cursor = raw.cursor(name=f"export_{table}")
+    cursor.itersize = DEFAULT_BATCH_SIZE
+    cursor.execute(query)
+    for row in cursor:
+        record = dict(zip(EXPORT_COLUMNS[table], row))
+        if isinstance(record.get('created_at'), datetime):
+            record['created_at'] = record['created_at'].isoformat()
+        stream.write(json.dumps(record) + "\n")
+        progress.add(1)
+
+
+# Import
+
+def fix_sequence(cursor, table):
+    """Move the table's id sequence past the highest id in it."""
+
+    cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                   f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table}")
+
+
+def assign_ids(cursor, table, batch):
+    """Give records without an id one from the table's id sequence, in one round trip."""
+
+    missing = [record for record in batch if record.get('id') is None]
+    if not missing:
+        return
+
+    cursor.execute(f"SELECT nextval(pg_get_serial_sequence('{table}', 'id')) FROM generate_series(1, %s)",
+                   (len(missing),))
+    for record, (new_id,) in zip(missing, cursor.fetchall()):
+        record['id'] = new_id
+
+
+def import_users(cursor, batch):
+    from models import User
+
+    assign_ids(cursor, 'users', batch)
+    default_image = User.get_default_image()
+    return copy_rows(cursor, 'users', ('id', 'first_name', 'last_name', 'image_url'),
+                     ((r['id'], r['first_name'], r['last_name'], r.get('image_url') or default_image)
+                      for r in batch))
+
+
+def import_tags(cursor, batch):
+    assign_ids(cursor, 'tags', batch)
+    return copy_rows(cursor, 'tags', ('id', 'name'), ((r['id'], r['name']) for r in batch))
+
+
+class TagResolver:
+    """Maps tag names to ids a batch at a time, creating tags that don't exist yet."""
+
+    def __init__(self, max_cached=100000):
+        self.ids = {}
+        self.max_cached = max_cached
+
+    def resolve(self, cursor, names):
+        """Return a dict from lowercased name to tag id that covers every name in 'names'."""
+
+        if len(self.ids) > self.max_cached:
+            self.ids.clear()
+
+        wanted = {name.lower(): name for name in names if name.lower() not in self.ids}
+
+        if wanted:
+            cursor.execute("INSERT INTO tags (name) SELECT unnest(%s::text[]) "
+                           "ON CONFLICT ((lower(name))) DO NOTHING", (list(wanted.values()),))
+            cursor.execute("SELECT lower(name), id FROM tags WHERE lower(name) = ANY(%s)", (list(wanted),))
+            self.ids.update(cursor.fetchall())
+
+        return self.ids
+
+
+def add_post_counts(cursor, table, counts):
+    """Add 'counts' (a dict from id to number of new posts) to the rows' post_count in one statement."""
+
+    if counts:
+        cursor.execute(f"UPDATE {table} SET post_count = post_count + c.n, "
+                       f"updated_at = now(), version = version + 1 "
+                       f"FROM unnest(%s::int[], %s::int[]) AS c(id, n) WHERE {table}.id = c.id",
+                       (list(counts), list(counts.values())))
+
+
+def import_posts(cursor, batch, resolver):
+    assign_ids(cursor, 'posts', batch)
+    names = {name for r in batch for name in (r.get('tags') or [])}
+    tag_ids = resolver.resolve(cursor, names) if names else {}
+
+    now = datetime.now(timezone.utc)
+    count = copy_rows(cursor, 'posts', ('id', 'title', 'content', 'created_at', 'user_id'),
+                      ((r['id'], r['title'], r['content'], r.get('created_at') or now, r['user_id'])
+                       for r in batch))
+
+    links = [(r['id'], tag_id) for r in batch
+             for tag_id in {tag_ids[name.lower()] for name in (r.get('tags') or [])}]
+    copy_rows(cursor, 'posts_tags', ('post_id', 'tag_id'), links)
+
+    # COPY skips the app's write methods, so keep the post counts right here, in the same transaction.
+    add_post_counts(cursor, 'users', Counter(int(r['user_id']) for r in batch))
+    add_post_counts(cursor, 'tags', Counter(tag_id for _, tag_id in links))
+
+    return count
+
+
+def import_table(raw, table, records, batch_size, progress):
+    cursor = raw.cursor()
+    resolver = TagResolver()
+
+    for batch in _batches(records, batch_size):
+        if table == 'users':
+            count = import_users(cursor, batch)
+        elif table == 'tags':
+            count = import_tags(cursor, batch)
+        else:
+            count = import_posts(cursor, batch, resolver)
+        raw.commit()
+        progress.add(count)
+
+    fix_sequence(cursor, table)
+    if table == 'posts':
+        fix_sequence(cursor, 'tags')
+    cursor.execute(f"ANALYZE {table}")
+    raw.commit()
+
+
+def main(argv=None):
+    from app import create_app
+    from models import db, connect_db, User, Tag
+
+    parser = argparse.ArgumentParser(description="Bulk import or export Blogly users, tags and posts.")
+    parser.add_argument('--db', default='blogly', help="database name (default: blogly)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help="write a table to a file")
+    export.add_argument('table', choices=['users', 'tags', 'posts'])
+    export.add_argument('--output', default='-', help="file to write, - for stdout (default)")
+    export.add_argument('--format', choices=['jsonl', 'csv'])
+
+    load = commands.add_parser('import', help="load a file into a table")
+    load.add_argument('table', choices=['users', 'tags', 'posts'])
+    load.add_argument('input', help="file to read, - for stdin")
+    load.add_argument('--format', choices=['jsonl', 'csv'])
+    load.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    commands.add_parser('repair-counts', help="recount every user's and tag's posts")
+
+    args = parser.parse_args(argv)
+
+    app = create_app(args.db, statement_timeout=0)
+    connect_db(app)
+
+    with app.app_context():
+        if args.command == 'repair-counts':
+            users, tags = User.repair_post_counts(), Tag.repair_post_counts()
+            db.session.commit()
+            print(f"Fixed the post counts of {users} users and {tags} tags")
+            return
+
+        raw = db.engine.raw_connection()
+        try:
+            if args.command == 'export':
+                fmt = _detect_format(args.output, args.format)
+                progress = Progress(f"export {args.table}")
+                stream = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+                try:
+                    export_table(raw, args.table, fmt, stream, progress)
+                finally:
+                    if stream is not sys.stdout:
+                        stream.close()
+                raw.rollback()
+            else:
+                fmt = _detect_format(args.input, args.format)
+                progress = Progress(f"import {args.table}")
+                stream = sys.stdin if args.input == '-' else open(args.input, newline='')
+                try:
+                    import_table(raw, args.table, read_records(stream, fmt), args.batch_size, progress)
+                finally:
+                    if stream is not sys.stdin:
+                        stream.close()
+        finally:
+            raw.close()
+
+    progress.report()
+
+
+if __name__ == '__main__':
+    main()
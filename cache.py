@@ -0,0 +1,267 @@
+"""Rendered fragment cache for Blogly pages.
+
+Fragments (post cards, the recent posts block, post pages) are cached as
+strings and deleted by the routes that change the data they were built from.
+Entries also expire after a TTL as a safety net for writes made outside the
+app, e.g. by seed.py. With both backends a TTL of 0 caches nothing (bench.py's
+--no-cache relies on that) and a TTL of None never expires entries.
+
+A user's name or a tag's name can show up in any number of fragments, so
+those aren't found and deleted one by one. Instead each user and tag has a
+stamp (a random token) in the cache, and a fragment that shows them is cached
+with the stamps it was built with, see set_stamped(). get_stamped_many()
+treats an entry whose stamps have changed or gone as missing, so renaming or
+deleting a user or tag only deletes its stamp key. That costs one more cache
+lookup per read, for the stamps. On a miss the stamps are read before the rows
+(see current_stamps()), which takes one small query for the ids of the users
+and tags the fragment will show.
+
+Two backends are available, picked with the FRAGMENT_CACHE_URL setting:
+- `memory://` (default): an LRU dict local to the process. Only for a single
+  process: server.py refuses it with more than one worker.
+- `redis://host:port/db`: any Redis-compatible server, shared by all workers.
+  Needs the `redis` package; configure the server with an LRU maxmemory-policy.
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """In-process cache with LRU eviction and a per-entry TTL."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        if self.ttl == 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """Cache kept in a Redis-compatible server. Eviction is left to the server."""
+
+    def __init__(self, url, ttl=300, prefix="blogly:fragment:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("FRAGMENT_CACHE_URL points at redis but the redis package isn't installed. "
+                               "Run `pip install redis`.") from e
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        return self._client.get(self.prefix + key)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self._client.mget([self.prefix + key for key in keys])
+
+    def set(self, key, value):
+        # Redis rejects an expire time of 0, so a TTL of 0 stores nothing, like MemoryCache.
+        if self.ttl == 0:
+            return
+        self._client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete_many(self, keys):
+        if keys:
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self._client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self._client.delete(*keys)
+
+
+def cache_from_config(config):
+    """Build the cache backend described by the app's FRAGMENT_CACHE_* settings."""
+
+    url = config.get('FRAGMENT_CACHE_URL', 'memory://')
+    ttl = config.get('FRAGMENT_CACHE_TTL', 300)
+
+    if url.startswith('memory://'):
+        return MemoryCache(max_entries=config.get('FRAGMENT_CACHE_MAX_ENTRIES', 1000), ttl=ttl)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url, ttl=ttl)
+
+    raise ValueError(f"Unsupported FRAGMENT_CACHE_URL: {url}")
+
+
+# Cache keys. Every fragment built from a post is listed in post_keys() so
+# invalidating a post can't miss one.
+
+RECENT_POSTS_KEY = "recent-posts"
+
+
+def post_card_key(post_id):
+    return f"post-card:{post_id}"
+
+
+def post_page_key(post_id):
+    return f"post-page:{post_id}"
+
+
+def post_keys(post_ids):
+    """Return every fragment key that depends on the given posts, plus the recent posts block."""
+
+    keys = [RECENT_POSTS_KEY]
+    for post_id in post_ids:
+        keys.append(post_card_key(post_id))
+        keys.append(post_page_key(post_id))
+    return keys
+
+
+# Feeds are cached in the same backend, see feeds.py.
+
+SITE_FEED_KEY = "feed"
+
+
+def user_feed_key(user_id):
+    return f"feed:user:{user_id}"
+
+
+def tag_feed_key(tag_id):
+    return f"feed:tag:{tag_id}"
+
+
+def feed_keys(user_ids=(), tag_ids=()):
+    """Return the keys of the site feed and of the given users' and tags' feeds."""
+
+    return ([SITE_FEED_KEY] + [user_feed_key(user_id) for user_id in user_ids]
+            + [tag_feed_key(tag_id) for tag_id in tag_ids])
+
+
+# Stamps of the users and tags a fragment shows.
+
+def user_stamp_key(user_id):
+    return f"stamp:user:{user_id}"
+
+
+def tag_stamp_key(tag_id):
+    return f"stamp:tag:{tag_id}"
+
+
+def stamp_keys(user_ids=(), tag_ids=()):
+    """Return the stamp keys of the given users and tags. Deleting them invalidates every
+    fragment that shows those users or tags."""
+
+    return [user_stamp_key(user_id) for user_id in user_ids] + [tag_stamp_key(tag_id) for tag_id in tag_ids]
+
+
+def post_stamp_keys(posts):
+    """Return the stamp keys of the posts' authors and tags, which need to be loaded."""
+
+    return stamp_keys({post.user.id for post in posts}, {tag.id for post in posts for tag in post.tags})
+
+
+def current_stamps(cache, keys):
+    """Return {key: stamp} for the given stamp keys, creating the stamps that don't exist yet.
+
+    Call it before loading the rows a fragment is built from. A rename or delete committed
+    after that point deletes the stamp, so a fragment built from the old rows is cached under
+    a stamp that's already gone. Read after the rows, a stamp deleted in between would be
+    created again and the stale fragment would pass as current."""
+
+    keys = list(dict.fromkeys(keys))
+    stamps = dict(zip(keys, cache.get_many(keys)))
+    for key, stamp in stamps.items():
+        if stamp is None:
+            stamps[key] = uuid.uuid4().hex
+            cache.set(key, stamps[key])
+    return stamps
+
+
+def stamps_for(stamps, keys):
+    """Return the stamps of 'keys' out of 'stamps', the current_stamps() read before the rows
+    were loaded. Returns None if any of them wasn't read then, e.g. a tag added to a post in
+    between, since the fragment can't safely be cached."""
+
+    if not set(keys) <= stamps.keys():
+        return None
+    return {key: stamps[key] for key in keys}
+
+
+def set_stamped(cache, key, value, stamps):
+    """Cache 'value' (anything JSON can hold) under 'key' along with 'stamps', the current_stamps()
+    of the users and tags it shows. Returns the entry, a dict with the value and stamps. With
+    'stamps' None (see stamps_for()) the entry is returned but not cached."""
+
+    entry = {"value": value, "stamps": stamps}
+    if stamps is not None:
+        cache.set(key, json.dumps(entry))
+    return entry
+
+
+def join_stamped(entries, separator="\n"):
+    """Join the string values of set_stamped() entries. Returns the joined value and the stamps of
+    all the entries, or None for the stamps if any entry wasn't cached, so neither is the whole."""
+
+    stamps = {}
+    for entry in entries:
+        if entry["stamps"] is None:
+            stamps = None
+            break
+        stamps.update(entry["stamps"])
+
+    return separator.join(entry["value"] for entry in entries), stamps
+
+
+def get_stamped_many(cache, keys):
+    """Return the set_stamped() entry under each key, or None for a key that's missing or whose
+    entry was built with stamps that have since changed. Looks up all their stamps at once."""
+
+    entries = [json.loads(value) if value is not None else None for value in cache.get_many(keys)]
+
+    needed = list({key for entry in entries if entry is not None for key in entry["stamps"]})
+    stamps = dict(zip(needed, cache.get_many(needed)))
+
+    return [entry if entry is not None and all(stamps[key] == stamp for key, stamp in entry["stamps"].items())
+            else None for entry in entries]
+
+
+def get_stamped(cache, key):
+    return get_stamped_many(cache, [key])[0]
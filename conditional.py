@@ -0,0 +1,111 @@
+"""Conditional GET (ETag, Last-Modified and 304 Not Modified) for Blogly's read only pages.
+
+Every users, posts and tags row has a `version` that goes up on each UPDATE and
+an `updated_at`. A page declares the rows it's rendered from as selects of
+(kind, id, version, updated_at), made by the models' *_versions() class methods.
+Before the view runs they're fetched together in one UNION ALL query:
+
+- the ETag is a hash of the (kind, id, version) of every row, so an edit,
+  insert or delete of any row on the page changes it, where max(updated_at)
+  alone would miss deletes;
+- Last-Modified is the newest updated_at.
+
+If the request's If-None-Match (or, without one, If-Modified-Since) still
+matches, a 304 goes back without running the page's queries or rendering it.
+
+The ETag also covers the templates and the asset manifest (see assets.py), so
+changed HTML or asset URLs aren't served as a 304.
+Responses that show flashed messages get no validators, and `Cache-Control:
+no-cache` makes browsers revalidate every time instead of guessing a lifetime
+from Last-Modified. The async views in aio.py don't do conditional GETs.
+"""
+
+import hashlib
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from sqlalchemy import select, union_all
+
+from models import db
+
+
+class Validator:
+    """The ETag and Last-Modified of a page."""
+
+    def __init__(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def matches(self, request):
+        """Whether the client's cached copy, as described by 'request', is still current."""
+
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+        if request.if_modified_since and self.last_modified:
+            # HTTP dates have whole second precision.
+            return self.last_modified.replace(microsecond=0) <= request.if_modified_since
+        return False
+
+    def apply(self, response):
+        response.set_etag(self.etag, weak=True)
+        if self.last_modified:
+            response.last_modified = self.last_modified
+        response.cache_control.no_cache = True
+
+    def __repr__(self):
+        v = self
+        return f"<Validator etag={v.etag} last_modified={v.last_modified}>"
+
+
+def _template_fingerprint(app):
+    fingerprint = app.extensions.get('template_fingerprint')
+    if fingerprint is None:
+        digest = hashlib.sha1()
+        for name in sorted(app.jinja_loader.list_templates()):
+            source, _, _ = app.jinja_loader.get_source(app.jinja_env, name)
+            digest.update(name.encode())
+            digest.update(source.encode())
+        fingerprint = app.extensions['template_fingerprint'] = digest.hexdigest()
+    return fingerprint
+
+
+def page_validator(version_selects):
+    """Build the Validator for a page from its (kind, id, version, updated_at) selects, in one query."""
+
+    query = union_all(*[select(*s.subquery().c) for s in version_selects])
+    rows = db.session.execute(query).all()
+
+    digest = hashlib.sha1(_template_fingerprint(current_app).encode())
+    digest.update(current_app.extensions['assets'].version.encode())
+    for kind, row_id, version, _ in sorted(rows):
+        digest.update(f"{kind}:{row_id}:{version};".encode())
+
+    last_modified = max((row.updated_at for row in rows), default=None)
+
+    return Validator(digest.hexdigest(), last_modified)
+
+
+def conditional(version_selects):
+    """Decorate a view to answer with a 304 when the client's copy is current.
+    'version_selects' is called with the view's arguments and returns the page's version selects."""
+
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(**kwargs):
+            if session.get('_flashes'):
+                return view(**kwargs)
+
+            validator = page_validator(version_selects(**kwargs))
+            if validator.matches(request):
+                response = current_app.response_class(status=304)
+                validator.apply(response)
+                return response
+
+            response = make_response(view(**kwargs))
+            if response.status_code == 200:
+                validator.apply(response)
+            return response
+
+        return conditional_view
+
+    return decorator
@@ -0,0 +1,90 @@
+"""Atom feeds for Blogly: /feed.xml, /users/<id>/feed.xml and /tags/<id>/feed.xml.
+
+A feed lists the FEED_LENGTH newest posts, site wide or of one user or tag,
+with their excerpts rather than their content. It's rendered once and kept in
+the fragment cache with its ETag (a hash of the XML) and Last-Modified (when it
+was built), so a poll costs a cache lookup and no db queries, and a poll whose
+If-None-Match or If-Modified-Since still matches gets a 304.
+
+A feed is dropped from the cache by the writes to what it shows: a post's
+feeds are the site feed and its author's and tags' feeds, which
+post_feed_keys() looks up, so call it before the write. A feed is also cached
+with the stamps of its user or tag and of its entries' authors and tags (see
+cache.py), so renaming or deleting a user or tag drops every feed showing it
+without looking for them. A rebuilt feed gets a new Last-Modified even when its
+XML came out the same, so clients that only send If-Modified-Since fetch it
+once more; clients sending If-None-Match don't.
+"""
+
+import hashlib
+from datetime import datetime, timezone
+
+from flask import current_app, make_response, render_template, request
+
+from cache import current_stamps, feed_keys, get_stamped, post_stamp_keys, set_stamped, stamp_keys, stamps_for
+from conditional import Validator
+from models import Post
+from replicas import primary_reads
+
+FEED_LENGTH = 20
+
+ATOM_MIMETYPE = 'application/atom+xml'
+
+
+def post_feed_keys(post_ids):
+    """Return the keys of the feeds showing the given posts."""
+
+    authors, tags = Post.get_authors_and_tags(post_ids)
+    return feed_keys(authors, tags)
+
+
+def atom_date(value):
+    """Format an aware datetime, e.g. a timestamptz from the db, as an RFC 3339 date in UTC."""
+    return value.astimezone(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z')
+
+
+def _build(context):
+    built_at = datetime.now(timezone.utc).replace(microsecond=0)
+    updated = max((post.updated_at for post in context['posts']), default=built_at)
+    body = render_template('feed.xml', updated=updated, atom_date=atom_date, **context)
+
+    return {'etag': hashlib.sha1(body.encode()).hexdigest(),
+            'last_modified': int(built_at.timestamp()),
+            'body': body}
+
+
+def feed_response(key, build_context, user_id=None, tag_id=None):
+    """Serve the feed cached under 'key', the site's or the feed of 'user_id' or 'tag_id'. On a
+    miss, 'build_context' is called for the template's title and page_url and may abort, e.g.
+    with a 404, then the feed's posts are loaded."""
+
+    fragments = current_app.extensions['fragment_cache']
+
+    entry = get_stamped(fragments, key)
+    if entry is None:
+        owner_stamp_keys = stamp_keys([user_id] if user_id is not None else [],
+                                      [tag_id] if tag_id is not None else [])
+
+        # Cached for everyone, so built from the primary rather than a lagging replica.
+        with primary_reads():
+            # The stamps are read before the user or tag and the posts, see current_stamps().
+            recent_ids = Post.recent_ids(user_id=user_id, tag_id=tag_id, limit=FEED_LENGTH)
+            stamps = current_stamps(fragments, owner_stamp_keys + stamp_keys(*Post.get_authors_and_tags(recent_ids)))
+
+            context = build_context()
+            context['posts'] = Post.get_feed_posts(user_id=user_id, tag_id=tag_id, limit=FEED_LENGTH)
+            feed = _build(context)
+
+        entry = set_stamped(fragments, key, feed,
+                            stamps_for(stamps, owner_stamp_keys + post_stamp_keys(context['posts'])))
+    feed = entry['value']
+
+    validator = Validator(feed['etag'], datetime.fromtimestamp(feed['last_modified'], timezone.utc))
+    if validator.matches(request):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(feed['body'])
+        response.mimetype = ATOM_MIMETYPE
+    validator.apply(response)
+
+    return response
@@ -0,0 +1,234 @@
+"""Per request performance instrumentation for Blogly.
+
+For every request this records the wall time, the number of SQL statements and
+the time spent in them, and the time spent rendering templates. Each response
+gets a `Server-Timing` header with those numbers, and they're aggregated per
+route into Prometheus histograms served at /metrics. Requests slower than
+SLOW_REQUEST_MS (BLOGLY_SLOW_REQUEST_MS, default 500) are logged to the
+`blogly.slow_requests` logger together with their slowest SQL statements.
+
+Histograms are kept in process, so with several worker processes each one
+reports its own numbers. Queries made by the async read path (aio.py) run on
+another thread and aren't counted. The startup time (see mark_ready()) and the
+time until the first request was answered are reported as gauges.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_request_log = logging.getLogger('blogly.slow_requests')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# How many statements each request keeps around for the slow request log.
+MAX_RECORDED_STATEMENTS = 50
+SLOW_LOG_STATEMENTS = 5
+
+
+class Histogram:
+    """A Prometheus histogram with one series per set of label values."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                labels = ",".join(f'{name}="{_escape_label(value)}"'
+                                  for name, value in zip(self.label_names, label_values))
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+
+        return "\n".join(lines)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+    """The histograms for one app."""
+
+    def __init__(self):
+        labels = ('route', 'method', 'status')
+        self.request_duration = Histogram('blogly_request_duration_seconds',
+                                          "Wall time to handle a request.", labels, DURATION_BUCKETS)
+        self.sql_queries = Histogram('blogly_request_sql_queries',
+                                     "SQL statements run per request.", labels, QUERY_COUNT_BUCKETS)
+        self.sql_duration = Histogram('blogly_request_sql_duration_seconds',
+                                      "Time spent in SQL statements per request.", labels, DURATION_BUCKETS)
+        self.template_duration = Histogram('blogly_request_template_duration_seconds',
+                                           "Time spent rendering templates per request.", labels, DURATION_BUCKETS)
+
+        # Measured from started_at, which server.py moves back to the process start.
+        self.started_at = time.perf_counter()
+        self.startup_seconds = None
+        self.first_request_seconds = None
+
+    def mark_ready(self):
+        """Record the time from started_at until now as the startup time."""
+        self.startup_seconds = time.perf_counter() - self.started_at
+
+    def startup_gauges(self):
+        gauges = {}
+        if self.startup_seconds is not None:
+            gauges['blogly_startup_seconds'] = round(self.startup_seconds, 4)
+        if self.first_request_seconds is not None:
+            gauges['blogly_time_to_first_request_seconds'] = round(self.first_request_seconds, 4)
+        return gauges
+
+    def histograms(self):
+        return [self.request_duration, self.sql_queries, self.sql_duration, self.template_duration]
+
+    def render(self, extra_gauges=None):
+        """Return all metrics in the Prometheus text format. 'extra_gauges' maps names to values."""
+
+        parts = [histogram.render() for histogram in self.histograms()]
+        for name, value in {**self.startup_gauges(), **(extra_gauges or {})}.items():
+            parts.append(f"# TYPE {name} gauge\n{name} {value}")
+
+        return "\n".join(parts) + "\n"
+
+
+class _Timings:
+    """What has been measured so far for the current request, kept on flask.g."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = []
+        self.template_seconds = 0.0
+        self.template_starts = []
+
+
+def _current_timings():
+    if not has_request_context():
+        return None
+    return g.get('blogly_timings')
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('blogly_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['blogly_query_start'].pop()
+    timings = _current_timings()
+    if timings is None:
+        return
+
+    elapsed = time.perf_counter() - started
+    timings.sql_count += 1
+    timings.sql_seconds += elapsed
+    if len(timings.statements) < MAX_RECORDED_STATEMENTS:
+        timings.statements.append((elapsed, statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('blogly_query_start'):
+        conn.info['blogly_query_start'].pop()
+
+
+def _before_render_template(app, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None:
+        timings.template_starts.append(time.perf_counter())
+
+
+def _template_rendered(app, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None and timings.template_starts:
+        started = timings.template_starts.pop()
+        # Only count the outermost render so nested render_template() calls aren't counted twice.
+        if not timings.template_starts:
+            timings.template_seconds += time.perf_counter() - started
+
+
+def init_metrics(app):
+    """Start timing the app's requests. Returns the app's RequestMetrics."""
+
+    metrics = RequestMetrics()
+    app.extensions['metrics'] = metrics
+
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    @app.before_request
+    def start_request_timer():
+        g.blogly_timings = _Timings()
+
+    @app.after_request
+    def record_request_timings(response):
+        timings = g.pop('blogly_timings', None)
+        if timings is None:
+            return response
+
+        duration = time.perf_counter() - timings.start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        if metrics.first_request_seconds is None:
+            metrics.first_request_seconds = time.perf_counter() - metrics.started_at
+        labels = (route, request.method, str(response.status_code))
+
+        metrics.request_duration.observe(labels, duration)
+        metrics.sql_queries.observe(labels, timings.sql_count)
+        metrics.sql_duration.observe(labels, timings.sql_seconds)
+        metrics.template_duration.observe(labels, timings.template_seconds)
+
+        response.headers['Server-Timing'] = (
+            f'app;dur={duration * 1000:.1f}, '
+            f'db;dur={timings.sql_seconds * 1000:.1f};desc="{timings.sql_count} queries", '
+            f'tpl;dur={timings.template_seconds * 1000:.1f}')
+
+        if duration * 1000 >= app.config['SLOW_REQUEST_MS']:
+            slowest = sorted(timings.statements, key=lambda s: s[0], reverse=True)[:SLOW_LOG_STATEMENTS]
+            slow_request_log.warning(json.dumps({
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'route': route,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 1),
+                'sql_count': timings.sql_count,
+                'sql_ms': round(timings.sql_seconds * 1000, 1),
+                'template_ms': round(timings.template_seconds * 1000, 1),
+                'slowest_sql': [{'ms': round(elapsed * 1000, 1), 'statement': statement}
+                                for elapsed, statement in slowest],
+            }))
+
+        return response
+
+    return metrics
@@ -0,0 +1,297 @@
+"""Versioned schema migrations for the Blogly db.
+
+Each migration has a version number and a list of SQL statements. The versions
+applied so far are recorded in the `schema_migrations` table.
+
+- A fresh db gets the current schema from `db.create_all()` and is then stamped
+  with the latest version, so old migrations are never replayed against it.
+- A db created before migrations existed (it has a `users` table but no
+  `schema_migrations` table) is stamped as version 1 and upgraded from there.
+
+Non-transactional migrations run in autocommit mode so they can use
+`CREATE INDEX CONCURRENTLY` and upgrade a live db without locking out writes.
+Statements should use IF NOT EXISTS so a run that died halfway can be retried.
+A failed `CREATE INDEX CONCURRENTLY` leaves an INVALID index behind, which IF
+NOT EXISTS would take as built, so an invalid index of the same name is
+dropped before each concurrent build.
+
+Run with `python3 -m migrations [--db blogly] upgrade|current|check`.
+"""
+
+import argparse
+import re
+import sys
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+# Arbitrary key for pg_advisory_lock so two processes never migrate at once.
+MIGRATION_LOCK_ID = 4180925
+
+CONCURRENT_INDEX_RE = re.compile(r'CREATE (?:UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS (\w+)', re.IGNORECASE)
+
+migrations_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations',
+    migrations_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class SchemaOutOfDateError(RuntimeError):
+    """Raised at startup when the db is behind the migrations shipped with the app."""
+
+
+class Migration:
+    """A single schema change."""
+
+    def __init__(self, version, description, statements, transactional=True):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.transactional = transactional
+
+    def __repr__(self):
+        m = self
+        return f"<Migration version={m.version} description={m.description}>"
+
+
+MIGRATIONS = [
+    Migration(1, "Baseline users, posts, tags and posts_tags tables", []),
+    Migration(2, "Indexes for recent posts, per user/tag post lists and tag names", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_created_at_id "
+        "ON posts (created_at DESC, id DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_user_id_created_at_id "
+        "ON posts (user_id, created_at DESC, id DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_tags_tag_id_post_id "
+        "ON posts_tags (tag_id, post_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_last_name_first_name_id "
+        "ON users (last_name, first_name, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tags_name_id "
+        "ON tags (name, id)",
+        # Fails if the table already holds names differing only in case; rename those first.
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_tags_lower_name "
+        "ON tags (lower(name))",
+    ], transactional=False),
+    Migration(3, "Full text search vector over post titles and content", [
+        # Rewrites the posts table while holding an exclusive lock; run it in a quiet period.
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_search_vector "
+        "ON posts USING gin (search_vector)",
+    ], transactional=False),
+    Migration(4, "Post counts on users and tags", [
+        # Backfilled in the same transaction, which holds off writes to both tables until it commits.
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS post_count integer NOT NULL DEFAULT 0",
+        "ALTER TABLE tags ADD COLUMN IF NOT EXISTS post_count integer NOT NULL DEFAULT 0",
+        "UPDATE users SET post_count = counts.post_count "
+        "FROM (SELECT user_id, count(*) AS post_count FROM posts GROUP BY user_id) AS counts "
+        "WHERE users.id = counts.user_id",
+        "UPDATE tags SET post_count = counts.post_count "
+        "FROM (SELECT tag_id, count(*) AS post_count FROM posts_tags GROUP BY tag_id) AS counts "
+        "WHERE tags.id = counts.tag_id",
+        "CREATE INDEX IF NOT EXISTS ix_tags_post_count_id ON tags (post_count DESC, id)",
+    ]),
+    Migration(5, "created_at, updated_at and version on users, posts and tags", [
+        # now() is stable, so these are added without rewriting the tables. Existing rows
+        # get the migration time as their created_at (users, tags) and updated_at.
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at timestamp NOT NULL DEFAULT now()",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT now()",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1",
+        "ALTER TABLE posts ALTER COLUMN created_at SET DEFAULT now()",
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT now()",
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1",
+        "ALTER TABLE tags ADD COLUMN IF NOT EXISTS created_at timestamp NOT NULL DEFAULT now()",
+        "ALTER TABLE tags ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT now()",
+        "ALTER TABLE tags ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1",
+    ]),
+    Migration(6, "ON DELETE CASCADE on the posts and posts_tags foreign keys", [
+        # Each constraint is swapped in one ALTER so there's never a moment without it. NOT VALID
+        # skips the full scan under the ALTER's lock; VALIDATE then scans without blocking writes.
+        "ALTER TABLE posts DROP CONSTRAINT IF EXISTS posts_user_id_fkey, "
+        "ADD CONSTRAINT posts_user_id_fkey FOREIGN KEY (user_id) "
+        "REFERENCES users (id) ON DELETE CASCADE NOT VALID",
+        "ALTER TABLE posts_tags DROP CONSTRAINT IF EXISTS posts_tags_post_id_fkey, "
+        "ADD CONSTRAINT posts_tags_post_id_fkey FOREIGN KEY (post_id) "
+        "REFERENCES posts (id) ON DELETE CASCADE NOT VALID",
+        "ALTER TABLE posts_tags DROP CONSTRAINT IF EXISTS posts_tags_tag_id_fkey, "
+        "ADD CONSTRAINT posts_tags_tag_id_fkey FOREIGN KEY (tag_id) "
+        "REFERENCES tags (id) ON DELETE CASCADE NOT VALID",
+        "ALTER TABLE posts VALIDATE CONSTRAINT posts_user_id_fkey",
+        "ALTER TABLE posts_tags VALIDATE CONSTRAINT posts_tags_post_id_fkey",
+        "ALTER TABLE posts_tags VALIDATE CONSTRAINT posts_tags_tag_id_fkey",
+    ], transactional=False),
+    Migration(7, "View counts on posts", [
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS view_count integer NOT NULL DEFAULT 0",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_view_count_id "
+        "ON posts (view_count DESC, id)",
+    ], transactional=False),
+    Migration(8, "Excerpts of post content for post lists", [
+        # Rewrites the posts table while holding an exclusive lock; run it in a quiet period.
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS excerpt varchar(283) GENERATED ALWAYS AS ("
+        "CASE WHEN char_length(content) <= 280 THEN content "
+        "ELSE left(regexp_replace(left(content, 281), '\\s+\\S*$', ''), 280) || '...' END) STORED",
+    ]),
+    Migration(9, "created_at and updated_at as timestamptz, set by the db's clock", [
+        # The old naive values are read as the db session's time zone, the one now() wrote them
+        # in. Rewrites the tables (and their created_at indexes) while holding an exclusive lock,
+        # unless that time zone is UTC; run it in a quiet period.
+        "ALTER TABLE users ALTER COLUMN created_at TYPE timestamptz, "
+        "ALTER COLUMN updated_at TYPE timestamptz",
+        "ALTER TABLE posts ALTER COLUMN created_at TYPE timestamptz, "
+        "ALTER COLUMN updated_at TYPE timestamptz",
+        "ALTER TABLE tags ALTER COLUMN created_at TYPE timestamptz, "
+        "ALTER COLUMN updated_at TYPE timestamptz",
+    ]),
+    Migration(10, "Whether a post's excerpt is shorter than its content", [
+        # Rewrites the posts table while holding an exclusive lock; run it in a quiet period.
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS is_excerpted boolean GENERATED ALWAYS AS ("
+        "char_length(content) > 280) STORED",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(conn):
+    """Return the latest applied migration version, or None if the db isn't versioned yet."""
+
+    if not inspect(conn).has_table('schema_migrations'):
+        return None
+
+    return conn.execute(select(schema_migrations.c.version)
+                        .order_by(schema_migrations.c.version.desc())
+                        .limit(1)).scalar()
+
+
+def pending_migrations(conn):
+    """Return the migrations that haven't been applied to the db yet."""
+
+    version = current_version(conn)
+    if version is None:
+        # An unversioned db with tables predates migrations and is at the baseline.
+        version = 1 if inspect(conn).has_table('users') else 0
+
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def _stamp(conn, migration):
+    conn.execute(schema_migrations.insert().values(version=migration.version,
+                                                   description=migration.description,
+                                                   applied_at=datetime.now()))
+
+
+def _drop_invalid_index(conn, statement, log):
+    match = CONCURRENT_INDEX_RE.match(statement)
+    if not match:
+        return
+
+    name = match.group(1)
+    invalid = conn.execute(text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                           {"name": name}).scalar()
+    if invalid:
+        log(f"Dropping invalid index {name} left by a failed build")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def upgrade(engine, metadata, log=print):
+    """Bring the db up to LATEST_VERSION. 'metadata' is the app's model metadata,
+    used to build a fresh db from scratch."""
+
+    with engine.connect() as lock_conn:
+        # Hold the lock outside of a transaction so CREATE INDEX CONCURRENTLY doesn't wait on us.
+        lock_conn = lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        try:
+            with engine.begin() as conn:
+                fresh = not inspect(conn).has_table('users')
+                legacy = not fresh and current_version(conn) is None
+                migrations_metadata.create_all(conn)
+
+                if fresh:
+                    log("Creating schema from models")
+                    metadata.create_all(conn)
+                    for migration in MIGRATIONS:
+                        _stamp(conn, migration)
+                    return
+
+                if legacy:
+                    _stamp(conn, MIGRATIONS[0])
+
+                pending = pending_migrations(conn)
+
+            for migration in pending:
+                log(f"Applying migration {migration.version}: {migration.description}")
+                # Index builds on big tables can easily outlast the app's statement timeout.
+                if migration.transactional:
+                    with engine.begin() as conn:
+                        conn.execute(text("SET LOCAL statement_timeout = 0"))
+                        for statement in migration.statements:
+                            conn.execute(text(statement))
+                        _stamp(conn, migration)
+                else:
+                    with engine.connect() as conn:
+                        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                        conn.execute(text("SET statement_timeout = 0"))
+                        try:
+                            for statement in migration.statements:
+                                _drop_invalid_index(conn, statement, log)
+                                conn.execute(text(statement))
+                            _stamp(conn, migration)
+                        finally:
+                            conn.execute(text("RESET statement_timeout"))
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+
+def check_schema(engine):
+    """Raise SchemaOutOfDateError if the db has migrations that haven't been applied."""
+
+    with engine.connect() as conn:
+        if not inspect(conn).has_table('users'):
+            raise SchemaOutOfDateError("Database has no Blogly schema. Run `python3 -m migrations upgrade`.")
+
+        pending = pending_migrations(conn)
+
+    if pending:
+        versions = ", ".join(str(m.version) for m in pending)
+        raise SchemaOutOfDateError(f"Database schema is behind, pending migrations: {versions}. "
+                                   f"Run `python3 -m migrations upgrade`.")
+
+
+def main(argv=None):
+    from app import create_app
+    from models import db
+
+    parser = argparse.ArgumentParser(description="Manage the Blogly db schema.")
+    parser.add_argument('--db', default='blogly', help="database name (default: blogly)")
+    parser.add_argument('command', choices=['upgrade', 'current', 'check'])
+    args = parser.parse_args(argv)
+
+    app = create_app(args.db)
+    db.init_app(app)
+
+    with app.app_context():
+        if args.command == 'upgrade':
+            upgrade(db.engine, db.metadata)
+            print(f"Database is at version {LATEST_VERSION}")
+        elif args.command == 'current':
+            with db.engine.connect() as conn:
+                print(current_version(conn))
+        else:
+            try:
+                check_schema(db.engine)
+            except SchemaOutOfDateError as e:
+                print(e, file=sys.stderr)
+                return 1
+            print("Database schema is up to date")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,69 @@
 """Models for the Blogle app"""
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-
-db = SQLAlchemy()
-
-def connect_db(app):
+from markupsafe import Markup, escape
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert as pg_insert
+from sqlalchemy.orm import deferred, joinedload, load_only, selectinload, undefer
+from pagination import keyset_select, paginate_keyset, DEFAULT_PER_PAGE
+from migrations import upgrade, check_schema
+from pool import install_statement_timeout
+from replicas import RoutingSession
+
+# Reads during GET requests may go to a replica, see replicas.py.
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Full text search config and the expression kept in posts.search_vector. Titles outrank content.
+SEARCH_CONFIG = 'english'
+SEARCH_VECTOR_SQL = (f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+                     f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(content, '')), 'B')")
+
+# The start of a post's content shown in post lists, kept in posts.excerpt. Longer content is
+# cut at the last whole word that fits and gets an ellipsis.
+EXCERPT_LENGTH = 280
+EXCERPT_ELLIPSIS = '...'
+EXCERPT_SQL = (f"CASE WHEN char_length(content) <= {EXCERPT_LENGTH} THEN content "
+               f"ELSE left(regexp_replace(left(content, {EXCERPT_LENGTH + 1}), '\\s+\\S*$', ''), "
+               f"{EXCERPT_LENGTH}) || '{EXCERPT_ELLIPSIS}' END")
+
+# ts_headline wraps matches in these control characters, which are swapped for <mark>
+# tags after the rest of the snippet has been escaped.
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+
+# Recount every user's and tag's posts, only writing the rows that are off.
+REPAIR_USER_POST_COUNTS_SQL = """
+    UPDATE users SET post_count = counts.post_count, updated_at = now(), version = users.version + 1
+    FROM (SELECT u.id, count(p.id) AS post_count
+          FROM users u LEFT JOIN posts p ON p.user_id = u.id GROUP BY u.id) AS counts
+    WHERE users.id = counts.id AND users.post_count <> counts.post_count"""
+
+REPAIR_TAG_POST_COUNTS_SQL = """
+    UPDATE tags SET post_count = counts.post_count, updated_at = now(), version = tags.version + 1
+    FROM (SELECT t.id, count(pt.post_id) AS post_count
+          FROM tags t LEFT JOIN posts_tags pt ON pt.tag_id = t.id GROUP BY t.id) AS counts
+    WHERE tags.id = counts.id AND tags.post_count <> counts.post_count"""
+
+class UnknownTagError(ValueError):
+    """Raised when a post is given tag ids that don't exist."""
+
+    def __init__(self, tag_ids):
+        self.tag_ids = sorted(tag_ids, key=str)
+        super().__init__(f"Unknown tag(s): {', '.join(str(t) for t in self.tag_ids)}")
+
+def connect_db(app, migrate=True, trust_schema=False):
+    """Connect the app to the db. With 'migrate', bring the schema up to date,
+    otherwise refuse to start if the schema is behind the migrations.
+    'trust_schema' skips both, and their round trips to the db, for a db known to be current."""
     with app.app_context():
         db.app = app
         db.init_app(app)
-        db.create_all()
+        install_statement_timeout(db.engine, app.config)
+        if trust_schema:
+            return
+        if migrate:
+            upgrade(db.engine, db.metadata)
+        else:
+            check_schema(db.engine)
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -25,8 +80,34 @@ class User(db.Model):
 
     image_url = db.Column(db.String(200), nullable=False)
 
-    # SQLA relationship to a user's post(s)
-    posts = db.relationship('Post', cascade='all, delete-orphan')
+    # Number of posts by the user, kept up to date by the Post and User write methods.
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Set by the db's clock on insert and update, see migration 9.
+    created_at = db.Column(db.DateTime(timezone=True),
+                    nullable=False,
+                    server_default=db.func.now())
+
+    updated_at = db.Column(db.DateTime(timezone=True),
+                    nullable=False,
+                    onupdate=db.func.now(),
+                    server_default=db.func.now())
+
+    # Bumped by every UPDATE of the row. See conditional.py.
+    version = db.Column(db.Integer,
+                    nullable=False,
+                    default=1,
+                    onupdate=db.text('version + 1'),
+                    server_default='1')
+
+    # SQLA relationship to a user's post(s). The db deletes them with the user (ON DELETE
+    # CASCADE), so they aren't loaded just to be deleted.
+    posts = db.relationship('Post', cascade='all, delete-orphan', passive_deletes=True)
+
+    # Index for the users list, which pages on (last_name, first_name, id). See migrations.py.
+    __table_args__ = (
+        db.Index('ix_users_last_name_first_name_id', last_name, first_name, id),
+    )
 
     def __init__(self, first_name, last_name, image_url=None, **kwargs):
         if image_url is None:
@@ -43,6 +124,57 @@ class User(db.Model):
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    @classmethod
+    def page_order(cls):
+        """Class method returning the columns the users list is sorted and paged on."""
+        return [cls.last_name, cls.first_name, cls.id]
+
+    @classmethod
+    def all_select(cls):
+        """Class method to build a select of every user, in the users list's order."""
+        return select(cls).order_by(*cls.page_order())
+
+    @classmethod
+    def get_page(cls, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to retrieve one page of users ordered by last name, first name."""
+        return paginate_keyset(cls.query, cls.page_order(),
+                               after=after, before=before, per_page=per_page)
+
+    @classmethod
+    def page_versions(cls, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to select the versions of the users on one page of the users list."""
+        query = select(*_version_columns(cls))
+        return [keyset_select(query, cls.page_order(), after=after, before=before, per_page=per_page)]
+
+    @classmethod
+    def detail_versions(cls, user_id, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to select the versions of the user and the page of their posts shown on their page."""
+        return [select(*_version_columns(cls)).where(cls.id == user_id),
+                *Post.page_versions_for_user(user_id, after=after, before=before, per_page=per_page)]
+
+    @classmethod
+    def repair_post_counts(cls):
+        """Class method to recount every user's posts in one statement.
+        Returns the number of users whose count was wrong."""
+        return db.session.execute(text(REPAIR_USER_POST_COUNTS_SQL)).rowcount
+
+    @classmethod
+    def delete_many(cls, user_ids):
+        """Class method to delete users and their posts in two statements, however many posts
+        they have, taking the posts off their tags' counts. Returns the ids of the deleted users."""
+
+        post_ids = select(Post.id).where(Post.user_id.in_(user_ids))
+        _remove_post_tags(PostTag.post_id.in_(post_ids))
+        return db.session.scalars(cls.__table__.delete().where(cls.id.in_(user_ids))
+                                  .returning(cls.id)).all()
+
+    def delete(self):
+        """Delete the user and their posts, taking their posts off their tags' counts."""
+
+        post_ids = select(Post.id).where(Post.user_id == self.id)
+        _remove_post_tags(PostTag.post_id.in_(post_ids))
+        db.session.delete(self)
+
     def __repr__(self):
         u = self
         return f"<User id={u.id} first_name={u.first_name} last_name={u.last_name}"
@@ -61,30 +193,354 @@ class Post(db.Model):
     title = db.Column(db.String(200),  
                     nullable=False)
     
-    content = db.Column(db.String(5000),  
-                    nullable=False)
+    # Only the post page and the edit form show it, and they undefer it. Anywhere else,
+    # reading it raises instead of running a query per post.
+    content = deferred(db.Column(db.String(5000),  
+                    nullable=False), raiseload=True)
+
+    # Kept up to date by the db, for post lists. See EXCERPT_SQL.
+    excerpt = db.Column(db.String(EXCERPT_LENGTH + len(EXCERPT_ELLIPSIS)),
+                    db.Computed(EXCERPT_SQL, persisted=True))
+
+    # Whether the excerpt is shorter than the content, for the "Read more" link.
+    is_excerpted = db.Column(db.Boolean,
+                    db.Computed(f"char_length(content) > {EXCERPT_LENGTH}", persisted=True))
     
-    created_at = db.Column(db.DateTime,
+    # Set by the db's clock on insert and update, see migration 9.
+    created_at = db.Column(db.DateTime(timezone=True),
                     nullable=False,
-                    default=datetime.now())
+                    server_default=db.func.now())
+
+    updated_at = db.Column(db.DateTime(timezone=True),
+                    nullable=False,
+                    onupdate=db.func.now(),
+                    server_default=db.func.now())
+
+    # Bumped by every UPDATE of the row. See conditional.py.
+    version = db.Column(db.Integer,
+                    nullable=False,
+                    default=1,
+                    onupdate=db.text('version + 1'),
+                    server_default='1')
 
     user_id = db.Column(db.Integer,
                     db.ForeignKey('users.id', ondelete='CASCADE'))
+
+    # Page views, written in batches by view_counts.py.
+    view_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Kept up to date by the db. Deferred so regular post queries don't fetch it.
+    search_vector = deferred(db.Column(TSVECTOR,
+                    db.Computed(SEARCH_VECTOR_SQL, persisted=True)))
     
     # relationship to a post's user
     user = db.relationship('User')
 
-    # relationship to the post's tags. 
-    post_tags = db.relationship('PostTag', backref='posts')
+    # relationship to the post's tags. The db deletes them with the post.
+    post_tags = db.relationship('PostTag', backref='posts', cascade='all', passive_deletes=True)
 
     tags = db.relationship('Tag',
-                            secondary='posts_tags')
+                            secondary='posts_tags',
+                            passive_deletes=True)
+
+    # Indexes for the recent posts and per user post lists. See migrations.py.
+    __table_args__ = (
+        db.Index('ix_posts_created_at_id', created_at.desc(), id.desc()),
+        db.Index('ix_posts_user_id_created_at_id', user_id, created_at.desc(), id.desc()),
+        db.Index('ix_posts_search_vector', search_vector, postgresql_using='gin'),
+        db.Index('ix_posts_view_count_id', view_count.desc(), id),
+    )
 
     @classmethod
-    def get_recent_posts(cls, limit=5):
-        """Class method to retrieve the 'limit' most recent posts."""
-        return cls.query.order_by(cls.created_at.desc()).limit(limit).all()
+    def create(cls, user_id, title, content, tag_ids=()):
+        """Class method to add a new post with the given tags and count it on its author.
+        Raises UnknownTagError (before adding anything) if a tag id doesn't exist."""
+
+        wanted = Tag.check_ids(tag_ids)
+
+        post = cls(title=title, content=content, user_id=user_id)
+        db.session.add(post)
+        db.session.flush()
+        db.session.execute(db.update(User).where(User.id == user_id)
+                           .values(post_count=User.post_count + 1))
+        post._link_tags(wanted, created=True)
+
+        return post
+
+    @classmethod
+    def with_relations(cls, with_author=False, with_tags=False):
+        """Class method to build a post query that eager loads the post's author and/or tags.
+        The author is joined in the same query, the tags are fetched in one extra query."""
+        query = cls.query
+
+        if with_author:
+            query = query.options(joinedload(cls.user))
+        if with_tags:
+            query = query.options(selectinload(cls.tags))
+
+        return query
+
+    @classmethod
+    def list_columns(cls, *columns):
+        """Class method returning a loader option that loads only the post's id and 'columns'.
+        The content stays deferred with raiseload, which load_only() on its own would undo."""
+        return load_only(cls.id, *columns).defer(cls.content, raiseload=True)
+
+    @classmethod
+    def card_options(cls):
+        """Class method returning the loader options for post cards: the excerpt instead of the
+        content, and only the author's and tags' columns the card shows."""
+        return (cls.list_columns(cls.title, cls.excerpt, cls.is_excerpted, cls.created_at),
+                joinedload(cls.user).load_only(User.id, User.first_name, User.last_name),
+                selectinload(cls.tags).load_only(Tag.id, Tag.name))
+
+    @classmethod
+    def title_options(cls):
+        """Class method returning the loader option for post lists that only show titles.
+        Also loads the columns the lists are paged on, for the cursors."""
+        return cls.list_columns(cls.title, *cls.page_order())
+
+    @classmethod
+    def recent(cls, query, user_id=None, tag_id=None, limit=5):
+        """Class method to narrow 'query' (a post query or a select) to the 'limit' most recent posts,
+        or a user's or a tag's, newest first."""
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        if tag_id is not None:
+            query = query.join(PostTag, PostTag.post_id == cls.id).filter(PostTag.tag_id == tag_id)
+
+        return query.order_by(cls.created_at.desc(), cls.id.desc()).limit(limit)
+
+    @classmethod
+    def get_recent_posts(cls, limit=5, with_author=False, with_tags=False, user_id=None, tag_id=None):
+        """Class method to retrieve the 'limit' most recent posts, or a user's or a tag's, with the
+        columns a post card or feed entry shows. 'with_author' joins in the author's name and
+        'with_tags' loads the tags in one extra query, so showing them runs no more queries."""
+        options = [cls.list_columns(cls.title, cls.excerpt, cls.is_excerpted, cls.created_at, cls.updated_at)]
+        if with_author:
+            options.append(joinedload(cls.user).load_only(User.id, User.first_name, User.last_name))
+        if with_tags:
+            options.append(selectinload(cls.tags).load_only(Tag.id, Tag.name))
+
+        return cls.recent(cls.query.options(*options), user_id=user_id, tag_id=tag_id, limit=limit).all()
+
+    @classmethod
+    def recent_ids(cls, user_id=None, tag_id=None, limit=5):
+        """Class method returning a select of the ids of the 'limit' most recent posts, or a user's or a tag's."""
+        return cls.recent(select(cls.id), user_id=user_id, tag_id=tag_id, limit=limit)
+
+    @classmethod
+    def get_recent_post_ids(cls, limit=5):
+        """Class method to retrieve the ids of the 'limit' most recent posts."""
+        return db.session.scalars(cls.recent_ids(limit=limit)).all()
+
+    @classmethod
+    def get_feed_posts(cls, user_id=None, tag_id=None, limit=20):
+        """Class method to retrieve the 'limit' most recent posts, or a user's or a tag's,
+        with the columns, author and tags a feed entry shows."""
+        return cls.get_recent_posts(limit, with_author=True, with_tags=True, user_id=user_id, tag_id=tag_id)
+
+    @classmethod
+    def authors_and_tags_select(cls, post_ids):
+        """Class method returning a select of (author id, tag id) rows for the given posts, which
+        can be a list of ids or a select of them. An untagged post has one row with a null tag id."""
+        return (select(cls.user_id, PostTag.tag_id)
+                .outerjoin(PostTag, PostTag.post_id == cls.id)
+                .where(cls.id.in_(post_ids)))
+
+    @classmethod
+    def get_authors_and_tags(cls, post_ids):
+        """Class method to retrieve the set of author ids and the set of tag ids of the given posts, in one query."""
+        rows = db.session.execute(cls.authors_and_tags_select(post_ids)).all()
+        return ({user_id for user_id, _ in rows if user_id is not None},
+                {tag_id for _, tag_id in rows if tag_id is not None})
+
+    @classmethod
+    def get_most_viewed(cls, limit=20):
+        """Class method to retrieve the 'limit' most viewed posts with their authors, skipping unviewed posts.
+        Served from ix_posts_view_count_id."""
+        return (cls.query.options(cls.list_columns(cls.title, cls.view_count),
+                                  joinedload(cls.user).load_only(User.id, User.first_name, User.last_name))
+                .filter(cls.view_count > 0)
+                .order_by(cls.view_count.desc(), cls.id)
+                .limit(limit).all())
+
+    @classmethod
+    def get_with_relations(cls, post_id, with_author=True, with_tags=True):
+        """Class method to retrieve a post with its content, and its author and tags loaded up front.
+        Aborts with a 404 if the post doesn't exist."""
+        query = cls.with_relations(with_author=with_author, with_tags=with_tags)
+        return query.options(undefer(cls.content)).filter_by(id=post_id).first_or_404()
     
+    @classmethod
+    def page_order(cls):
+        """Class method returning the columns post lists are sorted (descending) and paged on."""
+        return [cls.created_at, cls.id]
+
+    @classmethod
+    def get_page_for_user(cls, user_id, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to retrieve one page of a user's posts, newest first."""
+        query = cls.query.options(cls.title_options()).filter_by(user_id=user_id)
+        return paginate_keyset(query, cls.page_order(), descending=True,
+                               after=after, before=before, per_page=per_page)
+
+    @classmethod
+    def get_page_for_tag(cls, tag_id, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to retrieve one page of the posts with a tag, newest first."""
+        query = (cls.query.options(cls.title_options())
+                 .join(PostTag, PostTag.post_id == cls.id).filter(PostTag.tag_id == tag_id))
+        return paginate_keyset(query, cls.page_order(), descending=True,
+                               after=after, before=before, per_page=per_page)
+
+    @classmethod
+    def tag_select(cls, tag_id):
+        """Class method to build a select of every post with a tag, newest first,
+        loading only the id and title the tag page shows."""
+        return (select(cls).options(cls.list_columns(cls.title))
+                .join(PostTag, PostTag.post_id == cls.id)
+                .where(PostTag.tag_id == tag_id)
+                .order_by(*[column.desc() for column in cls.page_order()]))
+
+    @classmethod
+    def recent_versions(cls, limit=5):
+        """Class method to select the versions of the 'limit' most recent posts, their authors and tags."""
+        recent = (select(cls.id, cls.user_id).order_by(cls.created_at.desc(), cls.id.desc())
+                  .limit(limit).subquery())
+        return [select(*_version_columns(cls)).where(cls.id.in_(select(recent.c.id))),
+                select(*_version_columns(User)).where(User.id.in_(select(recent.c.user_id))),
+                select(*_version_columns(Tag)).where(Tag.id.in_(
+                    select(PostTag.tag_id).where(PostTag.post_id.in_(select(recent.c.id)))))]
+
+    @classmethod
+    def detail_versions(cls, post_id):
+        """Class method to select the versions of a post, its author and its tags."""
+        return [select(*_version_columns(cls)).where(cls.id == post_id),
+                select(*_version_columns(User)).where(
+                    User.id == select(cls.user_id).where(cls.id == post_id).scalar_subquery()),
+                select(*_version_columns(Tag)).where(
+                    Tag.id.in_(select(PostTag.tag_id).where(PostTag.post_id == post_id)))]
+
+    @classmethod
+    def page_versions_for_user(cls, user_id, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to select the versions of the posts on one page of a user's posts."""
+        query = select(*_version_columns(cls)).where(cls.user_id == user_id)
+        return [keyset_select(query, cls.page_order(), descending=True,
+                              after=after, before=before, per_page=per_page)]
+
+    @classmethod
+    def page_versions_for_tag(cls, tag_id, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to select the versions of the posts on one page of a tag's posts."""
+        query = (select(*_version_columns(cls)).join(PostTag, PostTag.post_id == cls.id)
+                 .where(PostTag.tag_id == tag_id))
+        return [keyset_select(query, cls.page_order(), descending=True,
+                              after=after, before=before, per_page=per_page)]
+
+    @classmethod
+    def search(cls, terms, page=1, per_page=10):
+        """Class method to full text search post titles and content, best matches first.
+
+        'terms' uses web search syntax ("quoted phrases", or, -excluded). Returns a
+        SearchPage of SearchResults whose highlighted title and snippet are built
+        by the db, for the requested page only."""
+
+        query = db.func.websearch_to_tsquery(SEARCH_CONFIG, terms)
+        rank = db.func.ts_rank_cd(cls.search_vector, query)
+
+        # Rank and cut the page first so ts_headline only runs on the rows shown.
+        ranked = (select(cls.id, rank.label('rank'))
+                  .where(cls.search_vector.op('@@')(query))
+                  .order_by(rank.desc(), cls.id.desc())
+                  .limit(per_page + 1)
+                  .offset((page - 1) * per_page)
+                  .subquery())
+
+        highlight = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}"
+        title_html = db.func.ts_headline(SEARCH_CONFIG, cls.title, query, f"{highlight}, HighlightAll=true")
+        snippet_html = db.func.ts_headline(SEARCH_CONFIG, cls.content, query,
+                                           f"{highlight}, MaxFragments=2, MinWords=10, MaxWords=30")
+
+        rows = db.session.execute(select(cls, ranked.c.rank, title_html, snippet_html)
+                                  .join(ranked, ranked.c.id == cls.id)
+                                  .options(cls.list_columns(cls.created_at),
+                                           joinedload(cls.user).load_only(User.id, User.first_name, User.last_name))
+                                  .order_by(ranked.c.rank.desc(), cls.id.desc())).all()
+
+        results = [SearchResult(post, rank, title, snippet) for post, rank, title, snippet in rows[:per_page]]
+        return SearchPage(terms, results, page, has_next=len(rows) > per_page)
+
+    def set_tags(self, tag_ids):
+        """Make the post's tags exactly the tags in 'tag_ids'.
+
+        Runs a fixed number of statements however many tags change: one IN lookup
+        to validate the ids, one bulk insert and one bulk delete on posts_tags, and
+        one update of the post counts of the tags that were added or removed.
+        Raises UnknownTagError (before changing anything) if an id doesn't exist."""
+
+        wanted = Tag.check_ids(tag_ids)
+
+        created = self.id is None
+        if created:
+            db.session.add(self)
+            db.session.flush()
+
+        self._link_tags(wanted, created)
+
+    def _link_tags(self, wanted, created):
+        # 'wanted' holds tag ids known to exist. A 'created' post has no tags to remove and no
+        # version to bump yet.
+        added = []
+        if wanted:
+            added = db.session.scalars(pg_insert(PostTag)
+                                       .values([{"post_id": self.id, "tag_id": tag_id} for tag_id in wanted])
+                                       .on_conflict_do_nothing()
+                                       .returning(PostTag.tag_id)).all()
+
+        removed = []
+        if not created:
+            removed = db.session.scalars(PostTag.__table__.delete()
+                                         .where(PostTag.post_id == self.id)
+                                         .where(PostTag.tag_id.not_in(wanted))
+                                         .returning(PostTag.tag_id)).all()
+
+        if added or removed:
+            db.session.execute(db.update(Tag)
+                               .where(Tag.id.in_(added + removed))
+                               .values(post_count=Tag.post_count + db.case((Tag.id.in_(added), 1), else_=-1)))
+
+            # The post's page shows its tags, so a new post version is due too.
+            if not created:
+                self.updated_at = db.func.now()
+
+        # The bulk statements bypass the ORM, so reload the relationships on next access.
+        db.session.expire(self, ['tags', 'post_tags'])
+
+    @classmethod
+    def delete_many(cls, post_ids):
+        """Class method to delete posts in two statements, taking them off their authors' and
+        their tags' post counts. Returns the ids of the deleted posts."""
+
+        _remove_post_tags(PostTag.post_id.in_(post_ids))
+
+        deleted = (cls.__table__.delete().where(cls.id.in_(post_ids))
+                   .returning(cls.id, cls.user_id).cte('deleted'))
+        counts = (select(deleted.c.user_id, db.func.count().label('removed'))
+                  .group_by(deleted.c.user_id).subquery())
+        counted = (User.__table__.update()
+                   .where(User.id == counts.c.user_id)
+                   .values(post_count=User.post_count - counts.c.removed)
+                   .returning(User.id).cte('counted'))
+
+        # Postgres runs every data modifying CTE, whether or not the outer query reads it.
+        return db.session.scalars(select(deleted.c.id).add_cte(counted)).all()
+
+    def delete(self):
+        """Delete the post, taking it off its author's and its tags' post counts."""
+
+        _remove_post_tags(PostTag.post_id == self.id)
+        db.session.execute(db.update(User).where(User.id == self.user_id)
+                           .values(post_count=User.post_count - 1))
+        db.session.delete(self)
+
     @property
     def pretty_date(self):
         """Return the post's created at in the format: May 1, 2015, 10:30 AM"""
@@ -108,29 +564,206 @@ class Tag(db.Model):
     name = db.Column(db.String(50),  
                     nullable=False)
     
-    # relationship to the tag's posts. 
-    tag_posts = db.relationship('PostTag', backref='tags')
+    # relationship to the tag's posts. The db deletes them with the tag.
+    tag_posts = db.relationship('PostTag', backref='tags', cascade='all', passive_deletes=True)
 
     posts = db.relationship('Post',
-                            secondary='posts_tags')
+                            secondary='posts_tags',
+                            passive_deletes=True)
+
+    # Number of posts with the tag, kept up to date by the Post and User write methods.
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Set by the db's clock on insert and update, see migration 9.
+    created_at = db.Column(db.DateTime(timezone=True),
+                    nullable=False,
+                    server_default=db.func.now())
+
+    updated_at = db.Column(db.DateTime(timezone=True),
+                    nullable=False,
+                    onupdate=db.func.now(),
+                    server_default=db.func.now())
+
+    # Bumped by every UPDATE of the row. See conditional.py.
+    version = db.Column(db.Integer,
+                    nullable=False,
+                    default=1,
+                    onupdate=db.text('version + 1'),
+                    server_default='1')
+
+    # Tag names are unique regardless of case. See migrations.py.
+    __table_args__ = (
+        db.Index('ix_tags_name_id', name, id),
+        db.Index('uq_tags_lower_name', db.func.lower(name), unique=True),
+        db.Index('ix_tags_post_count_id', post_count.desc(), id),
+    )
+
+    @classmethod
+    def check_ids(cls, tag_ids):
+        """Class method returning 'tag_ids' as a set of ints, after checking in one query that they
+        all exist. Raises UnknownTagError otherwise. Doesn't flush the session."""
+
+        wanted = set()
+        invalid = set()
+        for tag_id in tag_ids:
+            try:
+                wanted.add(int(tag_id))
+            except (TypeError, ValueError):
+                invalid.add(tag_id)
+
+        if wanted:
+            with db.session.no_autoflush:
+                found = set(db.session.scalars(select(cls.id).where(cls.id.in_(wanted))))
+            invalid |= wanted - found
+        if invalid:
+            raise UnknownTagError(invalid)
+
+        return wanted
+
+    @classmethod
+    def get_names(cls):
+        """Class method to retrieve every tag's (id, name) without loading Tag objects."""
+        return db.session.execute(select(cls.id, cls.name)).all()
+
+    @classmethod
+    def page_order(cls):
+        """Class method returning the columns the tags list is sorted and paged on."""
+        return [cls.name, cls.id]
+
+    @classmethod
+    def all_select(cls):
+        """Class method to build a select of every tag, in the tags list's order."""
+        return select(cls).order_by(*cls.page_order())
+
+    @classmethod
+    def get_page(cls, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to retrieve one page of tags ordered by name."""
+        return paginate_keyset(cls.query, cls.page_order(),
+                               after=after, before=before, per_page=per_page)
+
+    @classmethod
+    def most_popular_select(cls, limit=10):
+        """Class method to build a select of the 'limit' tags on the most posts, skipping unused tags.
+        Served from ix_tags_post_count_id."""
+        return select(cls).where(cls.post_count > 0).order_by(cls.post_count.desc(), cls.id).limit(limit)
+
+    @classmethod
+    def get_most_popular(cls, limit=10):
+        """Class method to retrieve the 'limit' tags on the most posts."""
+        return db.session.scalars(cls.most_popular_select(limit)).all()
+
+    @classmethod
+    def page_versions(cls, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to select the versions of the tags on one page of the tags list,
+        and of the most popular tags shown above it."""
+        query = select(*_version_columns(cls))
+        return [keyset_select(query, cls.page_order(), after=after, before=before, per_page=per_page),
+                cls.most_popular_select().with_only_columns(*_version_columns(cls))]
+
+    @classmethod
+    def detail_versions(cls, tag_id, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+        """Class method to select the versions of the tag and the page of its posts shown on its page."""
+        return [select(*_version_columns(cls)).where(cls.id == tag_id),
+                *Post.page_versions_for_tag(tag_id, after=after, before=before, per_page=per_page)]
+
+    @classmethod
+    def repair_post_counts(cls):
+        """Class method to recount every tag's posts in one statement.
+        Returns the number of tags whose count was wrong."""
+        return db.session.execute(text(REPAIR_TAG_POST_COUNTS_SQL)).rowcount
+
+    @classmethod
+    def delete_many(cls, tag_ids):
+        """Class method to delete tags in one statement. The db takes them off their posts.
+        Returns the ids of the deleted tags."""
+        return db.session.scalars(cls.__table__.delete().where(cls.id.in_(tag_ids))
+                                  .returning(cls.id)).all()
+
+    def delete(self):
+        """Delete the tag. The db takes it off its posts."""
+
+        db.session.delete(self)
 
     def __repr__(self):
         t = self
         return f"<Tag id={t.id} name={t.name}"
     
 
+def _version_columns(model):
+    """The (kind, id, version, updated_at) columns a page's validators are built from. See conditional.py."""
+    return [db.literal(model.__tablename__).label('kind'), model.id, model.version, model.updated_at]
+
+
+def _remove_post_tags(criterion):
+    """Delete the posts_tags rows matching 'criterion' and take them off their tags'
+    post counts, in one statement."""
+
+    removed = PostTag.__table__.delete().where(criterion).returning(PostTag.tag_id).cte('removed')
+    counts = (select(removed.c.tag_id, db.func.count().label('removed'))
+              .group_by(removed.c.tag_id).subquery())
+
+    db.session.execute(Tag.__table__.update()
+                       .where(Tag.id == counts.c.tag_id)
+                       .values(post_count=Tag.post_count - counts.c.removed))
+
+
+def _highlight(text):
+    """Escape a ts_headline() result and turn its match markers into <mark> tags."""
+    html = str(escape(text))
+    return Markup(html.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>'))
+
+
+class SearchResult:
+    """A post matching a search, with its title and a content snippet highlighted."""
+
+    def __init__(self, post, rank, title, snippet):
+        self.post = post
+        self.rank = rank
+        self.title_html = _highlight(title)
+        self.snippet_html = _highlight(snippet)
+
+    def __repr__(self):
+        r = self
+        return f"<SearchResult post_id={r.post.id} rank={r.rank}>"
+
+
+class SearchPage:
+    """One page of search results."""
+
+    def __init__(self, terms, items, page, has_next):
+        self.terms = terms
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+
 class PostTag(db.Model):
     """Join table for Posts to Tags."""
 
     __tablename__ = "posts_tags"
 
     post_id = db.Column(db.Integer,
-                       db.ForeignKey("posts.id"),
+                       db.ForeignKey("posts.id", ondelete='CASCADE'),
                        primary_key=True)
     
     tag_id = db.Column(db.Integer,
-                          db.ForeignKey("tags.id"),
+                          db.ForeignKey("tags.id", ondelete='CASCADE'),
                           primary_key=True)
+
+    # The primary key only covers lookups by post_id, this covers the tag detail page.
+    __table_args__ = (
+        db.Index('ix_posts_tags_tag_id_post_id', tag_id, post_id),
+    )
     
     def __repr__(self):
         pt = self
@@ -0,0 +1,169 @@
+"""Keyset (cursor based) pagination helpers for Blogly list views.
+
+Instead of OFFSET, each page remembers the sort key of its first and last row
+and the next query seeks past it with a row value comparison, e.g.
+`WHERE (last_name, first_name, id) > ('Smith', 'Condor', 12)`. That keeps the
+cost of page 1000 the same as the cost of page 1.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import DateTime, Integer, String, tuple_
+
+DEFAULT_PER_PAGE = 20
+
+
+class Page:
+    """One page of results plus the cursors needed to fetch its neighbours."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __repr__(self):
+        p = self
+        return f"<Page items={len(p.items)} next={p.next_cursor} prev={p.prev_cursor}>"
+
+
+def encode_cursor(obj, sort_columns):
+    """Encode the sort key of 'obj' as an opaque, url safe cursor string."""
+
+    values = []
+    for column in sort_columns:
+        value = getattr(obj, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        values.append(value)
+
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_value(column, value):
+    """Check a cursor value against its column's type and convert it for the query.
+    Raises ValueError if it doesn't fit."""
+
+    if value is None:
+        if not column.nullable:
+            raise ValueError(f"{column.key} can't be null")
+        return None
+
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError(f"{column.key} must be a date string")
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Integer):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"{column.key} must be an integer")
+    elif isinstance(column.type, String):
+        if not isinstance(value, str):
+            raise ValueError(f"{column.key} must be a string")
+
+    return value
+
+
+def decode_cursor(cursor, sort_columns):
+    """Decode a cursor made by encode_cursor() back into a list of sort key values.
+    Raises ValueError if the cursor is malformed or a value doesn't fit its column."""
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+    if not isinstance(values, list) or len(values) != len(sort_columns):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+    try:
+        return [_decode_value(column, value) for column, value in zip(sort_columns, values)]
+    except ValueError as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset_select(query, sort_columns, descending=False, after=None, before=None,
+                  per_page=DEFAULT_PER_PAGE):
+    """Add the seek condition, ordering and limit for one page to 'query', which can be
+    a Query or a select() statement. Aborts with a 400 on a bad cursor."""
+
+    key = tuple_(*sort_columns)
+    backwards = before is not None
+    cursor = before if backwards else after
+
+    if cursor is not None:
+        try:
+            values = decode_cursor(cursor, sort_columns)
+        except ValueError:
+            abort(400, description="Invalid page cursor.")
+
+        # Walking back through a descending list means seeking to larger keys.
+        if descending != backwards:
+            query = query.filter(key < tuple_(*values))
+        else:
+            query = query.filter(key > tuple_(*values))
+
+    if descending != backwards:
+        order_by = [column.desc() for column in sort_columns]
+    else:
+        order_by = [column.asc() for column in sort_columns]
+
+    # Fetch one extra row to find out whether there is anything beyond this page.
+    return query.order_by(*order_by).limit(per_page + 1)
+
+
+def keyset_page(rows, sort_columns, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+    """Build the Page for the rows fetched with a keyset_select() query."""
+
+    backwards = before is not None
+    has_more = len(rows) > per_page
+    items = list(rows[:per_page])
+
+    if backwards:
+        items.reverse()
+
+    if not items:
+        return Page(items)
+
+    first_cursor = encode_cursor(items[0], sort_columns)
+    last_cursor = encode_cursor(items[-1], sort_columns)
+
+    if backwards:
+        next_cursor = last_cursor
+        prev_cursor = first_cursor if has_more else None
+    else:
+        next_cursor = last_cursor if has_more else None
+        prev_cursor = first_cursor if after is not None else None
+
+    return Page(items, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def paginate_keyset(query, sort_columns, descending=False, after=None, before=None,
+                    per_page=DEFAULT_PER_PAGE):
+    """Return a Page of 'query' results ordered by 'sort_columns'.
+
+    'sort_columns' must end in a unique column (normally the primary key) so the
+    ordering is total. Pass 'after' to get the page following a cursor or
+    'before' to get the page preceding it. Aborts with a 400 on a bad cursor."""
+
+    rows = keyset_select(query, sort_columns, descending=descending, after=after, before=before,
+                         per_page=per_page).all()
+
+    return keyset_page(rows, sort_columns, after=after, before=before, per_page=per_page)
@@ -0,0 +1,173 @@
+"""Connection pool and statement timeout settings for the Blogly db.
+
+Settings come from create_app() arguments, falling back to environment
+variables, and are stored in app.config as:
+
+    DB_POOL_SIZE          BLOGLY_POOL_SIZE             (default 5)
+    DB_MAX_OVERFLOW       BLOGLY_MAX_OVERFLOW          (default 10)
+    DB_POOL_TIMEOUT       BLOGLY_POOL_TIMEOUT          seconds to wait for a connection (default 10)
+    DB_POOL_RECYCLE       BLOGLY_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+    DB_POOL_PRE_PING      BLOGLY_POOL_PRE_PING         test connections on checkout (default on)
+    DB_PGBOUNCER          BLOGLY_PGBOUNCER             behind PgBouncer transaction pooling (default off)
+    DB_STATEMENT_TIMEOUT  BLOGLY_STATEMENT_TIMEOUT_MS  milliseconds, 0 for no limit (default 5000)
+
+Behind PgBouncer in transaction pooling mode PgBouncer does the pooling, so the
+app doesn't keep its own pool, and the statement timeout is applied with
+`SET LOCAL` at the start of each transaction because session settings and
+startup options don't survive PgBouncer handing the server connection to
+another client.
+"""
+
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+
+DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_PGBOUNCER': False,
+    'DB_STATEMENT_TIMEOUT': 5000,
+}
+
+ENV_VARS = {
+    'DB_POOL_SIZE': 'BLOGLY_POOL_SIZE',
+    'DB_MAX_OVERFLOW': 'BLOGLY_MAX_OVERFLOW',
+    'DB_POOL_TIMEOUT': 'BLOGLY_POOL_TIMEOUT',
+    'DB_POOL_RECYCLE': 'BLOGLY_POOL_RECYCLE',
+    'DB_POOL_PRE_PING': 'BLOGLY_POOL_PRE_PING',
+    'DB_PGBOUNCER': 'BLOGLY_PGBOUNCER',
+    'DB_STATEMENT_TIMEOUT': 'BLOGLY_STATEMENT_TIMEOUT_MS',
+}
+
+
+def parse_setting(value, default):
+    """Convert a setting from the environment to the type of its default."""
+
+    if isinstance(default, bool):
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
+def pool_settings(**overrides):
+    """Return the DB_* settings, preferring 'overrides' that aren't None, then the environment."""
+
+    settings = {}
+    for key, default in DEFAULTS.items():
+        value = overrides.get(key)
+        if value is None:
+            value = os.environ.get(ENV_VARS[key], default)
+        settings[key] = parse_setting(value, default)
+
+    return settings
+
+
+class PoolStats:
+    """Counters for connection checkouts, kept on the pool they describe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record_wait(time.perf_counter() - start)
+        return conn
+
+
+def engine_options(settings):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings."""
+
+    options = {'pool_pre_ping': settings['DB_POOL_PRE_PING']}
+
+    if settings['DB_PGBOUNCER']:
+        options['poolclass'] = NullPool
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': settings['DB_POOL_SIZE'],
+        'max_overflow': settings['DB_MAX_OVERFLOW'],
+        'pool_timeout': settings['DB_POOL_TIMEOUT'],
+        'pool_recycle': settings['DB_POOL_RECYCLE'],
+    })
+
+    if settings['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {'options': f"-c statement_timeout={settings['DB_STATEMENT_TIMEOUT']}"}
+
+    return options
+
+
+def install_statement_timeout(engine, settings):
+    """Apply the statement timeout per transaction when the connection options can't carry it."""
+
+    timeout = settings['DB_STATEMENT_TIMEOUT']
+    if not settings['DB_PGBOUNCER'] or not timeout:
+        return
+
+    @event.listens_for(engine, "begin")
+    def set_local_statement_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+def pool_stats(engine):
+    """Return a dict describing the engine's pool: its size, connections in use and checkout waits."""
+
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+
+    pool_counters = getattr(pool, 'stats', None)
+    if pool_counters is not None:
+        with pool_counters.lock:
+            stats.update({
+                'checkouts': pool_counters.checkouts,
+                'timeouts': pool_counters.timeouts,
+                'wait_seconds_total': round(pool_counters.wait_seconds_total, 6),
+                'wait_seconds_max': round(pool_counters.wait_seconds_max, 6),
+            })
+
+    return stats
@@ -0,0 +1,248 @@
+"""Read replica routing for the Blogly db.
+
+Replica URLs come from create_app(replica_urls=[...]) or BLOGLY_REPLICA_URLS
+(comma separated). With replicas configured:
+
+- GET and HEAD requests read from a healthy replica, picked round robin once
+  per request. Every other request, every INSERT/UPDATE/DELETE and every ORM
+  flush goes to the primary, as does anything outside a request (CLI
+  commands, migrations).
+- Read your writes: after a POST (or any other non GET request) the client's
+  session is pinned to the primary for DB_READ_YOUR_WRITES seconds, so the
+  page it's redirected to shows its own change even if the replicas lag.
+- Health: each replica is checked at most every DB_REPLICA_CHECK_INTERVAL
+  seconds, from whichever request notices the check is due. It's ejected
+  while it can't be reached or replays more than DB_REPLICA_MAX_LAG seconds
+  behind, and put back once a check passes. A connection error on a replica
+  ejects it straight away. With no healthy replica, reads use the primary.
+- Shared caches: reads inside primary_reads() use the primary. Wrap the reads
+  that fill the fragment cache, the feeds and the tag catalog in it, since a
+  lagging replica's old rows would otherwise be cached and served to everyone
+  (the writer's redirect included) for the cache's TTL. Cache hits still cost
+  the primary nothing.
+
+Settings, like pool.py's, come from create_app() arguments or the environment:
+
+    DB_READ_YOUR_WRITES         BLOGLY_READ_YOUR_WRITES          seconds (default 5)
+    DB_REPLICA_MAX_LAG          BLOGLY_REPLICA_MAX_LAG           seconds (default 10)
+    DB_REPLICA_CHECK_INTERVAL   BLOGLY_REPLICA_CHECK_INTERVAL    seconds (default 5)
+
+Replicas use the same pool settings as the primary. /status/replicas shows
+their health. The async views in aio.py always read from the primary.
+"""
+
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+
+from pool import engine_options, install_statement_timeout, parse_setting
+
+DEFAULTS = {
+    'DB_READ_YOUR_WRITES': 5.0,
+    'DB_REPLICA_MAX_LAG': 10.0,
+    'DB_REPLICA_CHECK_INTERVAL': 5.0,
+}
+
+ENV_VARS = {
+    'DB_READ_YOUR_WRITES': 'BLOGLY_READ_YOUR_WRITES',
+    'DB_REPLICA_MAX_LAG': 'BLOGLY_REPLICA_MAX_LAG',
+    'DB_REPLICA_CHECK_INTERVAL': 'BLOGLY_REPLICA_CHECK_INTERVAL',
+}
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Session key holding the time until which the client reads from the primary.
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+# Replay lag in seconds. A replica that has replayed everything it received counts as
+# caught up, however long ago the last write was. A server that isn't a replica has no lag.
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END"""
+
+CONNECT_TIMEOUT = 2
+
+
+def replica_settings(replica_urls=None, **overrides):
+    """Return the replica settings, preferring arguments that aren't None, then the environment."""
+
+    if replica_urls is None:
+        replica_urls = os.environ.get('BLOGLY_REPLICA_URLS', '')
+    if isinstance(replica_urls, str):
+        replica_urls = [url.strip() for url in replica_urls.split(',') if url.strip()]
+
+    settings = {'DB_REPLICA_URLS': list(replica_urls)}
+    for key, default in DEFAULTS.items():
+        value = overrides.get(key)
+        if value is None:
+            value = os.environ.get(ENV_VARS[key], default)
+        settings[key] = parse_setting(value, default)
+
+    return settings
+
+
+class Replica:
+    """One replica's engine and what its last health check found."""
+
+    def __init__(self, url, settings):
+        options = engine_options(settings)
+        options['connect_args'] = {**options.get('connect_args', {}), 'connect_timeout': CONNECT_TIMEOUT}
+
+        self.engine = create_engine(url, **options)
+        install_statement_timeout(self.engine, settings)
+
+        self.name = self.engine.url.render_as_string(hide_password=True)
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.checked_at = None
+        self.check_lock = threading.Lock()
+
+        @event.listens_for(self.engine, "handle_error")
+        def eject_on_connection_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.eject(str(context.original_exception).strip())
+
+    def eject(self, error):
+        self.healthy = False
+        self.error = error
+
+    def check(self, max_lag):
+        """Connect and measure the replica's lag, ejecting it if it's down or too far behind."""
+
+        try:
+            with self.engine.connect() as conn:
+                lag = float(conn.execute(text(LAG_SQL)).scalar())
+        except Exception as e:
+            self.lag = None
+            self.eject(str(e).strip())
+        else:
+            self.lag = lag
+            if lag > max_lag:
+                self.eject(f"Replication lag {lag:.1f}s is over {max_lag}s")
+            else:
+                self.healthy = True
+                self.error = None
+        finally:
+            self.checked_at = time.monotonic()
+
+    def status(self):
+        return {'replica': self.name, 'healthy': self.healthy, 'lag_seconds': self.lag, 'error': self.error}
+
+
+class ReplicaSet:
+    """The app's replicas, handed out round robin among the healthy ones."""
+
+    def __init__(self, settings):
+        self.replicas = [Replica(url, settings) for url in settings['DB_REPLICA_URLS']]
+        self.max_lag = settings['DB_REPLICA_MAX_LAG']
+        self.check_interval = settings['DB_REPLICA_CHECK_INTERVAL']
+        self._turn = itertools.count()
+
+    def check_due(self):
+        """Check the replicas whose last check is older than the check interval. A replica
+        that another thread is already checking is skipped rather than waited for."""
+
+        now = time.monotonic()
+        for replica in self.replicas:
+            if replica.checked_at is not None and now - replica.checked_at < self.check_interval:
+                continue
+            if replica.check_lock.acquire(blocking=False):
+                try:
+                    replica.check(self.max_lag)
+                finally:
+                    replica.check_lock.release()
+
+    def choose(self):
+        """Return a healthy replica, or None if there isn't one."""
+
+        self.check_due()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+    def dispose(self, close=True):
+        """Drop the replicas' pooled connections. close=False, in a forked worker, forgets
+        the parent's connections without closing them under it."""
+        for replica in self.replicas:
+            replica.engine.dispose(close=close)
+
+
+def _request_replica():
+    """The replica the current request reads from, or None to use the primary. Chosen once per request."""
+
+    if not has_request_context() or g.get('blogly_primary_reads'):
+        return None
+
+    if 'blogly_replica' not in g:
+        replicas = current_app.extensions.get('replicas')
+        replica = None
+        if (replicas is not None and request.method in READ_METHODS
+                and session.get(PRIMARY_UNTIL_KEY, 0) < time.time()):
+            replica = replicas.choose()
+        g.blogly_replica = replica
+
+    return g.blogly_replica
+
+
+@contextmanager
+def primary_reads():
+    """Send the current request's reads inside the block to the primary."""
+
+    if not has_request_context():
+        yield
+        return
+
+    previous = g.get('blogly_primary_reads', False)
+    g.blogly_primary_reads = True
+    try:
+        yield
+    finally:
+        g.blogly_primary_reads = previous
+
+
+class RoutingSession(Session):
+    """A Flask-SQLAlchemy session that sends a read request's reads to its replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # A session bound to a connection, like the test harness's (testing.py), runs everything on it.
+        if bind is None and self.bind is not None:
+            return self.bind
+
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False):
+            replica = _request_replica()
+            if replica is not None:
+                return replica.engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_replicas(app):
+    """Set up the app's replicas from app.config, if there are any. Returns the ReplicaSet or None."""
+
+    if not app.config['DB_REPLICA_URLS']:
+        return None
+
+    replicas = ReplicaSet(app.config)
+    app.extensions['replicas'] = replicas
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        if request.method not in READ_METHODS:
+            session[PRIMARY_UNTIL_KEY] = time.time() + app.config['DB_READ_YOUR_WRITES']
+        return response
+
+    return replicas
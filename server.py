@@ -0,0 +1,248 @@
+"""Production entry point for Blogly: a prefork HTTP server.
+
+    python3 -m server --db blogly --port 8000 --workers 4
+
+The master process builds the app once, checks the schema, and does the work
+the first requests would otherwise do (mapper configuration, template
+compilation). Then it closes every db connection and forks the workers, which
+share that work copy-on-write and accept connections on the master's listening
+socket. Each worker drops any pooled connection it inherited and restarts the
+async read path's event loop and the view count flusher, since connections and
+threads can't be shared across a fork. A worker that dies is replaced. SIGTERM or SIGINT stops the
+workers gracefully: they finish their current requests and flush their
+pending view counts first.
+
+Schema checks at startup:
+- default: refuse to start if the db is behind the migrations (one round trip);
+- --migrate: apply pending migrations first;
+- --trust-schema (or BLOGLY_TRUST_SCHEMA=1): skip the check, for deploys that
+  migrate separately.
+
+With more than one worker, the fragment cache has to be shared (a redis://
+BLOGLY_FRAGMENT_CACHE_URL): with memory:// each worker would keep its own copy,
+and a write would only invalidate the copy of the worker that handled it.
+
+Workers handle one request at a time unless --threaded. Size --workers times
+(threads per worker) to the connection pool, see pool.py. Threaded workers cap
+the requests they take on at once, see admission.py.
+
+The startup time (process start to ready to fork) is logged. It's reported at
+/metrics as blogly_startup_seconds, next to each worker's time until it
+answered its first request, blogly_time_to_first_request_seconds.
+"""
+
+import time
+
+# Taken before the heavy imports, so the startup time includes them.
+PROCESS_STARTED = time.perf_counter()
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+log = logging.getLogger('blogly.server')
+
+# Seconds to wait before replacing a worker that died, so a worker that can't start doesn't spin.
+RESPAWN_DELAY = 1
+
+
+class SharedCacheRequiredError(RuntimeError):
+    """Raised when several workers would each keep their own fragment cache."""
+
+
+def warm_up(app):
+    """Configure the mappers and compile every template, once, before forking."""
+
+    from sqlalchemy.orm import configure_mappers
+
+    configure_mappers()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def _engines(app):
+    from models import db
+
+    with app.app_context():
+        return list(db.engines.values())
+
+
+def before_fork(app):
+    """Close every db connection, and stop the async read path's loop and the view count
+    flusher, so no worker inherits them."""
+
+    app.extensions['view_counter'].stop()
+    for engine in _engines(app):
+        engine.dispose()
+    if app.extensions.get('replicas'):
+        app.extensions['replicas'].dispose()
+    if app.extensions.get('async_db'):
+        app.extensions['async_db'].close()
+
+
+def after_fork(app):
+    """In a worker: forget any pooled connection inherited from the master, without closing
+    it under the master, and restart the async read path's loop and the view count flusher."""
+
+    for engine in _engines(app):
+        engine.dispose(close=False)
+    if app.extensions.get('replicas'):
+        app.extensions['replicas'].dispose(close=False)
+    if app.extensions.get('async_db'):
+        app.extensions['async_db'].start()
+    app.extensions['view_counter'].start(app)
+
+
+def _stop_worker(app):
+    """Write what the worker still holds in memory and close its connections."""
+
+    counter = app.extensions['view_counter']
+    counter.stop()
+    with app.app_context():
+        counter.flush()
+    if app.extensions.get('async_db'):
+        app.extensions['async_db'].close()
+    for engine in _engines(app):
+        engine.dispose()
+
+
+def run_worker(app, sock, threaded, started_at):
+    """Serve requests from 'sock' until SIGTERM or SIGINT."""
+
+    from werkzeug.serving import make_server
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    after_fork(app)
+    app.extensions['metrics'].started_at = started_at
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=threaded, fd=sock.fileno())
+    # Let in-flight requests finish on shutdown.
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    serving = threading.Thread(target=server.serve_forever, name='blogly-serve', daemon=True)
+    serving.start()
+    while not stopping.wait(1):
+        if not serving.is_alive():
+            break
+
+    server.shutdown()
+    server.server_close()
+    _stop_worker(app)
+
+
+def serve(app, host, port, workers, threaded):
+    """Fork 'workers' processes serving 'app' on host:port, and replace any that die."""
+
+    if workers > 1 and app.config['FRAGMENT_CACHE_URL'].startswith('memory://'):
+        raise SharedCacheRequiredError(
+            f"{workers} workers can't share a memory:// fragment cache, and each would serve pages "
+            f"other workers' writes left stale. Set BLOGLY_FRAGMENT_CACHE_URL to a redis:// URL, "
+            f"or run one worker with --threaded.")
+
+    sock = socket.create_server((host, port), backlog=1024)
+    sock.set_inheritable(True)
+    log.info("Listening on http://%s:%s with %s workers", host, port, workers)
+
+    before_fork(app)
+    children = set()
+    stopping = False
+
+    def spawn(started_at):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(app, sock, threaded, started_at)
+            except BaseException:
+                log.exception("Worker %s failed", os.getpid())
+                code = 1
+            finally:
+                # Never return into the master's code.
+                logging.shutdown()
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # The first workers' time to first request counts from the process start, like the startup time.
+    for _ in range(workers):
+        spawn(PROCESS_STARTED)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        children.discard(pid)
+        if not stopping:
+            log.warning("Worker %s exited (status %s), starting another", pid, status)
+            time.sleep(RESPAWN_DELAY)
+            if not stopping:
+                spawn(time.perf_counter())
+
+    sock.close()
+    log.info("Stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Blogly with a pool of worker processes.")
+    parser.add_argument('--db', default='blogly', help="database name or URL (default: blogly)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BLOGLY_WORKERS', os.cpu_count() or 1)),
+                        help="worker processes (default: BLOGLY_WORKERS or the number of CPUs)")
+    parser.add_argument('--threaded', action='store_true', help="handle each request in its own thread")
+    parser.add_argument('--access-log', action='store_true', help="log every request")
+    schema = parser.add_mutually_exclusive_group()
+    schema.add_argument('--migrate', action='store_true', help="apply pending migrations at startup")
+    schema.add_argument('--trust-schema', action='store_true',
+                        default=os.environ.get('BLOGLY_TRUST_SCHEMA', '').lower() in ('1', 'true', 'yes', 'on'),
+                        help="don't check the schema at startup")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(name)s: %(message)s")
+    if not args.access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    from app import create_app
+    from models import connect_db
+
+    app = create_app(args.db)
+    connect_db(app, migrate=args.migrate, trust_schema=args.trust_schema and not args.migrate)
+    warm_up(app)
+
+    metrics = app.extensions['metrics']
+    metrics.started_at = PROCESS_STARTED
+    metrics.mark_ready()
+    log.info("Ready in %.3fs", metrics.startup_seconds)
+
+    try:
+        serve(app, args.host, args.port, args.workers, args.threaded)
+    except SharedCacheRequiredError as e:
+        log.error("%s", e)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+// Tag picker for the post forms. Suggests tags from /tags/autocomplete as you type
+// and keeps each picked tag as a hidden "tags" input, like the old multi-select did.
+
+document.querySelectorAll('.tag-picker').forEach(function (picker) {
+    var url = picker.dataset.autocompleteUrl;
+    var search = picker.querySelector('input[type=text]');
+    var selected = picker.querySelector('.tag-picker-selected');
+    var suggestions = picker.querySelector('.tag-picker-suggestions');
+    var pending = null;
+
+    function pickedIds() {
+        return Array.from(selected.querySelectorAll('input[name=tags]')).map(function (input) {
+            return input.value;
+        });
+    }
+
+    function addTag(tag) {
+        if (pickedIds().indexOf(String(tag.id)) !== -1) {
+            return;
+        }
+
+        var badge = document.createElement('span');
+        badge.className = 'badge badge-primary tag-picker-tag';
+        badge.appendChild(document.createTextNode(tag.name));
+
+        var input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'tags';
+        input.value = tag.id;
+        badge.appendChild(input);
+
+        var remove = document.createElement('button');
+        remove.type = 'button';
+        remove.className = 'close ml-1';
+        remove.setAttribute('aria-label', 'Remove tag');
+        remove.innerHTML = '&times;';
+        badge.appendChild(remove);
+
+        selected.appendChild(badge);
+    }
+
+    function showSuggestions(tags) {
+        suggestions.innerHTML = '';
+        var picked = pickedIds();
+
+        tags.filter(function (tag) {
+            return picked.indexOf(String(tag.id)) === -1;
+        }).forEach(function (tag) {
+            var item = document.createElement('button');
+            item.type = 'button';
+            item.className = 'list-group-item list-group-item-action';
+            item.textContent = tag.name;
+            item.addEventListener('click', function () {
+                addTag(tag);
+                search.value = '';
+                suggestions.innerHTML = '';
+                search.focus();
+            });
+            suggestions.appendChild(item);
+        });
+    }
+
+    search.addEventListener('input', function () {
+        var prefix = search.value.trim();
+        if (pending) {
+            pending.abort();
+        }
+        if (!prefix) {
+            suggestions.innerHTML = '';
+            return;
+        }
+
+        pending = new AbortController();
+        fetch(url + '?prefix=' + encodeURIComponent(prefix), {signal: pending.signal})
+            .then(function (response) { return response.json(); })
+            .then(showSuggestions)
+            .catch(function () {});
+    });
+
+    // Enter picks the first suggestion rather than submitting the form.
+    search.addEventListener('keydown', function (event) {
+        if (event.key === 'Enter') {
+            event.preventDefault();
+            var first = suggestions.querySelector('button');
+            if (first) {
+                first.click();
+            }
+        }
+    });
+
+    selected.addEventListener('click', function (event) {
+        if (event.target.classList.contains('close')) {
+            event.target.parentNode.remove();
+        }
+    });
+});
@@ -0,0 +1,77 @@
+"""Streamed rendering for Blogly's full list pages (/users/all, /tags/all, /tags/<id>/all).
+
+The paged list views hold a page of rows at a time. The "all" views list every
+row, so instead of loading them into a list and rendering the page into one
+string, they render with Flask's stream_template over a StreamedRows, which
+reads its select from a server side cursor BATCH_SIZE rows at a time
+(yield_per). Memory stays flat however many rows there are.
+
+Output before the first row, i.e. the page header, is sent as soon as it's
+rendered, before the query runs. After that the rows' HTML is sent in chunks
+of about CHUNK_SIZE characters. StreamedRows stands in for a Page in the list
+templates, with no next or previous page.
+
+The rows are read after the view returns, so their SQL isn't counted in the
+request's Server-Timing header or metrics, and a query error can only cut the
+page short rather than turn into an error page.
+"""
+
+from flask import Response, stream_template
+
+from models import db
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 16 * 1024
+
+
+class StreamedRows:
+    """The results of a select, read from a server side cursor in batches while they're iterated."""
+
+    has_next = False
+    has_prev = False
+
+    def __init__(self, statement, batch_size=BATCH_SIZE):
+        self.statement = statement.execution_options(yield_per=batch_size)
+        self.started = False
+
+    def __iter__(self):
+        self.started = True
+        result = db.session.scalars(self.statement)
+        try:
+            for batch in result.partitions():
+                yield from batch
+        finally:
+            result.close()
+
+
+def _chunks(parts, rows, chunk_size):
+    """Pass the header through as it's rendered, then group the rows' output into chunks."""
+
+    buffer = []
+    size = 0
+    for part in parts:
+        if not rows.started:
+            yield part
+            continue
+
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_page(template_name, chunk_size=CHUNK_SIZE, **context):
+    """Return a streamed response rendering 'template_name' with 'context', which holds the
+    StreamedRows the template lists."""
+
+    rows = next(value for value in context.values() if isinstance(value, StreamedRows))
+    response = Response(_chunks(stream_template(template_name, **context), rows, chunk_size),
+                        mimetype='text/html')
+    # Ask proxies like nginx to pass chunks on as they come instead of buffering the page.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,75 @@
+"""In-process catalog of tag names for prefix autocomplete.
+
+Every tag's (id, name) is held in memory, sorted by lowercased name, so a
+prefix lookup is a binary search plus a short scan, with no db query. The post
+forms use it through /tags/autocomplete instead of listing every tag.
+
+The catalog is rebuilt from the db when its version stamp changes. The stamp is
+kept in the fragment cache (see cache.py) and replaced by invalidate(), which
+the routes that create, rename and delete tags call after committing. With a
+Redis fragment cache the stamp is shared, so every worker rebuilds after a tag
+changes in any of them. The stamp also expires with the cache's TTL, which
+picks up tags written outside the app, e.g. by bulk.py.
+"""
+
+import threading
+import uuid
+from bisect import bisect_left
+
+from models import Tag
+from replicas import primary_reads
+
+TAG_CATALOG_STAMP_KEY = "tag-catalog-stamp"
+
+
+class TagCatalog:
+    """Tag names sorted for prefix lookups, rebuilt when the version stamp changes."""
+
+    def __init__(self, stamps):
+        self._stamps = stamps
+        self._lock = threading.Lock()
+        # (stamp, lowercased names, (id, name) pairs), swapped in whole so readers need no lock.
+        self._state = (None, [], [])
+
+    def invalidate(self):
+        """Replace the version stamp, so every process rebuilds its catalog on its next lookup."""
+        self._stamps.set(TAG_CATALOG_STAMP_KEY, uuid.uuid4().hex)
+
+    def _current_stamp(self):
+        stamp = self._stamps.get(TAG_CATALOG_STAMP_KEY)
+        if stamp is None:
+            stamp = uuid.uuid4().hex
+            self._stamps.set(TAG_CATALOG_STAMP_KEY, stamp)
+        return stamp
+
+    def _rebuild(self, stamp):
+        with self._lock:
+            if self._state[0] == stamp:
+                return
+
+            # Kept until the stamp changes again, so read from the primary, not a lagging replica.
+            with primary_reads():
+                names = Tag.get_names()
+            tags = sorted(names, key=lambda tag: (tag.name.lower(), tag.id))
+            self._state = (stamp, [tag.name.lower() for tag in tags], [(tag.id, tag.name) for tag in tags])
+
+    def lookup(self, prefix, limit=10):
+        """Return up to 'limit' (id, name) pairs whose names start with 'prefix', ignoring case."""
+
+        stamp = self._current_stamp()
+        if self._state[0] != stamp:
+            self._rebuild(stamp)
+
+        _, names, tags = self._state
+        prefix = prefix.lower()
+        start = bisect_left(names, prefix)
+
+        matches = []
+        for i in range(start, min(start + limit, len(names))):
+            if not names[i].startswith(prefix):
+                break
+            matches.append(tags[i])
+        return matches
+
+    def __len__(self):
+        return len(self._state[1])
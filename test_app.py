@@ -1,9 +1,28 @@
-from unittest import TestCase
+import base64
+import gzip
+import io
+import json
+import os
+import threading
+import time
 
 from app import create_app
-from models import db, connect_db, User, Post
+from models import db, connect_db, User, Post, Tag, PostTag
+from migrations import check_schema, upgrade
+from bulk import export_table, import_table, read_records, Progress
+from assets import build, clean
+from cache import (MemoryCache, RedisCache, get_stamped, post_card_key, post_page_key, stamp_keys,
+                   tag_feed_key)
+from view_counts import ViewCounter
+from server import warm_up, before_fork, after_fork, serve, SharedCacheRequiredError
+from testing import TransactionalTestCase, committed, create_test_database
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError, InvalidRequestError, OperationalError
 
-app = create_app("blogly_test", testing=True)
+# Each test process gets a fresh copy of the template db, see testing.py.
+TEST_DB_URL = create_test_database("blogly_test")
+
+app = create_app(TEST_DB_URL, testing=True)
 connect_db(app)
 
 # Use test database and don't clutter tests with SQL
@@ -16,21 +35,21 @@ connect_db(app)
 # # Don't use Flask DebugToolbar when testing
 # app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-
 
-class BloglyViewsTests(TestCase):
+class BloglyViewsTests(TransactionalTestCase):
     """Tests for views for Users."""
 
+    app = app
+
     def setUp(self):
+        # The tables start out empty, see TransactionalTestCase.
+        super().setUp()
 
         with app.app_context():
             
-            # Delete all data in the tables to start fresh.
-            User.query.delete()
-            Post.query.delete()
+            # Clear cached pages and pending view counts to start fresh.
+            app.extensions['fragment_cache'].clear()
+            app.extensions['view_counter'].clear()
 
             user1 = User(first_name="User", last_name="One", image_url="https://images.unsplash.com/photo-1620336655052-b57986f5a26a")
             user2 = User(first_name="User", last_name="Two")
@@ -46,9 +65,21 @@ class BloglyViewsTests(TestCase):
             db.session.add_all([p1, p2, p3, p4])
             db.session.commit()
 
+            tag1 = Tag(name='Tag 1', tag_posts=[PostTag(post_id=p3.id)])
+
+            db.session.add(tag1)
+            db.session.commit()
+
+            # The rows above were added directly, so bring the post counts in line with them.
+            User.repair_post_counts()
+            Tag.repair_post_counts()
+            db.session.commit()
+
             self.user1 = User.query.filter_by(first_name="User", last_name="One").first()
             self.user2 = User.query.filter_by(first_name="User", last_name="Two").first()
             self.post1 = Post.query.filter_by(title="Post 1").first()
+            self.post3 = Post.query.filter_by(title="Post 3").first()
+            self.tag1 = Tag.query.filter_by(name="Tag 1").first()
 
 
     def tearDown(self):
@@ -65,7 +96,47 @@ class BloglyViewsTests(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<h1>Recent Posts</h1>', html)
+            self.assertIn(f'By <a href="/users/{self.user2.id}">{self.user2.full_name}</a>', html)
+            self.assertIn(f'<a href="/tags/{self.tag1.id}" class="badge badge-warning">Tag 1</a>', html)
     
+    def test_home_query_count(self):
+        with app.app_context():
+            tag2 = Tag(name='Tag 2')
+            for i in range(6):
+                user = User(first_name="Author", last_name=str(i))
+                db.session.add(Post(title=f"Extra {i}", content="x", user=user, tags=[self.tag1, tag2]))
+            db.session.commit()
+
+        with app.test_client() as client:
+            # The page's versions, the latest post ids, their author and tag ids for the stamps, then
+            # the posts with their authors and their tags, one query each.
+            with self.assertQueryCount(5):
+                resp = client.get("/")
+            self.assertIn("Extra 5", resp.get_data(as_text=True))
+
+            # The rendered posts are cached, so only the versions are read.
+            with self.assertQueryCount(1):
+                client.get("/")
+
+    def test_get_recent_posts(self):
+        with app.app_context():
+            for i in range(6):
+                user = User(first_name="Author", last_name=str(i))
+                db.session.add(Post(title=f"Extra {i}", content="x", user=user, tags=[self.tag1]))
+            db.session.commit()
+
+            # The posts with their authors, then their tags, however many posts there are.
+            with self.assertQueryCount(2):
+                posts = Post.get_recent_posts(limit=8, with_author=True, with_tags=True)
+                shown = [(post.title, post.user.full_name, [tag.name for tag in post.tags]) for post in posts]
+
+            self.assertEqual(len(shown), 8)
+            self.assertEqual(shown[0], ("Extra 5", "Author 5", ["Tag 1"]))
+
+            # Narrowed to a tag's posts, still bounded by 'limit'.
+            posts = Post.get_recent_posts(limit=3, tag_id=self.tag1.id)
+            self.assertEqual([post.title for post in posts], ["Extra 5", "Extra 4", "Extra 3"])
+
     def test_list_users(self):
         with app.test_client() as client:
             resp = client.get("/users")
@@ -168,6 +239,54 @@ class BloglyViewsTests(TestCase):
             self.assertIn(f'<h1>{self.post1.title}</h1>', html)
             self.assertIn(f'By <a href="/users/{author.id}">{author.full_name}</a>', html) 
             
+    def test_post_excerpts(self):
+        long_content = " ".join(f"word{i}" for i in range(100))
+
+        with app.app_context():
+            post = Post(title='Long', content=long_content, user_id=self.user1.id)
+            db.session.add(post)
+            db.session.commit()
+            post_id = post.id
+
+            # Cut at a word boundary, with an ellipsis.
+            self.assertTrue(post.is_excerpted)
+            self.assertTrue(post.excerpt.endswith(" word40..."))
+            self.assertTrue(long_content.startswith(post.excerpt[:-3] + " "))
+
+            # Short content is its own excerpt, and edits keep the excerpt current.
+            post1 = db.session.get(Post, self.post1.id)
+            self.assertEqual(post1.excerpt, "Content 1 ipsum dolor sit amet, consectetur adipiscing elit, "
+                                            "sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.")
+            self.assertFalse(post1.is_excerpted)
+            post1.content = "Short, and trailing off..."
+            db.session.commit()
+            self.assertFalse(post1.is_excerpted)
+            post1.content = "Edited"
+            db.session.commit()
+            self.assertEqual(post1.excerpt, "Edited")
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn(f'word40... <a href="/posts/{post_id}">Read more</a>', html)
+            self.assertNotIn("word41", html)
+
+            html = client.get(f"/posts/{post_id}").get_data(as_text=True)
+            self.assertIn("word99", html)
+
+    def test_post_lists_defer_content(self):
+        with app.test_client() as client:
+            for url in ("/", f"/users/{self.user1.id}", f"/tags/{self.tag1.id}", "/posts/most-viewed"):
+                with self.subTest(url=url), self.recordQueries() as statements:
+                    self.assertEqual(client.get(url).status_code, 200)
+                    self.assertFalse([s for s in statements if "posts.content" in s])
+
+        with app.app_context():
+            # Reading it anyway raises, rather than running a query per post.
+            for post in (Post.get_page_for_user(self.user1.id).items[0],
+                         db.session.scalars(Post.tag_select(self.tag1.id)).first()):
+                with self.assertRaises(InvalidRequestError):
+                    post.content
+
     def test_show_edit_post_form(self):
         with app.test_client() as client:
             resp = client.get(f"/posts/{self.post1.id}/edit")
@@ -195,7 +314,974 @@ class BloglyViewsTests(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f'Post deleted!', html)
-            self.assertNotIn(f'{self.post1.title}', html) 
+            self.assertNotIn(f'{self.post1.title}', html)
 
+    def test_show_tag_detail_page(self):
+        with app.test_client() as client:
+            resp = client.get(f"/tags/{self.tag1.id}")
+            html = resp.get_data(as_text=True)
 
-    
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<h1>Tag: Tag 1</h1>', html)
+            self.assertIn(f'<a href="/posts/{self.post3.id}">{self.post3.title}</a>', html)
+
+    def test_show_tag_detail_page_query_count(self):
+        with app.app_context():
+            tag = db.session.get(Tag, self.tag1.id)
+            for i in range(10):
+                user = User(first_name="Author", last_name=str(i))
+                db.session.add(Post(title=f"Extra {i}", content="x", user=user, tags=[tag]))
+            db.session.commit()
+
+        # The page's versions, the tag and its page of posts, with no query per post.
+        with app.test_client() as client, self.assertQueryCount(3):
+            resp = client.get(f"/tags/{self.tag1.id}")
+
+        self.assertIn("Extra 9", resp.get_data(as_text=True))
+
+    def test_show_tag_detail_page_missing(self):
+        with app.test_client() as client:
+            resp = client.get("/tags/0")
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_page_cursors(self):
+        with app.app_context():
+            first = User.get_page(per_page=1)
+            second = User.get_page(after=first.next_cursor, per_page=1)
+            back = User.get_page(before=second.prev_cursor, per_page=1)
+
+            self.assertEqual([u.id for u in first], [self.user1.id])
+            self.assertEqual([u.id for u in second], [self.user2.id])
+            self.assertEqual([u.id for u in back], [self.user1.id])
+            self.assertFalse(first.has_prev)
+            self.assertFalse(second.has_next)
+            self.assertFalse(back.has_prev)
+
+    def test_user_post_page_cursors(self):
+        with app.app_context():
+            first = Post.get_page_for_user(self.user1.id, per_page=1)
+            second = Post.get_page_for_user(self.user1.id, after=first.next_cursor, per_page=1)
+
+            self.assertEqual(len(first), 1)
+            self.assertEqual(len(second), 1)
+            self.assertNotEqual(first.items[0].id, second.items[0].id)
+            self.assertFalse(second.has_next)
+
+    def test_list_users_bad_cursor(self):
+        with app.test_client() as client:
+            resp = client.get("/users?after=not-a-cursor")
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_wrongly_typed_cursor(self):
+        def cursor(values):
+            return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+        with app.test_client() as client:
+            # Valid JSON of the right length, but not the types the sort columns hold.
+            for url in [f"/users/{self.user1.id}?after={cursor([5, 1])}",
+                        f"/users/{self.user1.id}?before={cursor(['2020-01-01', {'a': 1}])}",
+                        f"/users/{self.user1.id}?after={cursor(['2020-01-01', True])}",
+                        f"/users?after={cursor([1, 'One', 1])}",
+                        f"/users?after={cursor(['One', 'User', None])}",
+                        f"/tags?after={cursor([['Tag'], 1])}"]:
+                with self.subTest(url=url):
+                    self.assertEqual(client.get(url).status_code, 400)
+
+            resp = client.get(f"/users/{self.user1.id}?after={cursor(['2020-01-01T00:00:00+00:00', 1])}")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_schema_is_current(self):
+        with app.app_context():
+            check_schema(db.engine)
+
+    def test_migration_retry_rebuilds_invalid_index(self):
+        engine = db.create_engine(create_test_database("blogly_test_migrations"))
+        index_valid = text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('uq_tags_lower_name')")
+        try:
+            # Back to version 1, with tag names the unique index can't be built over.
+            with engine.begin() as conn:
+                conn.execute(text("DROP INDEX uq_tags_lower_name"))
+                conn.execute(text("DELETE FROM schema_migrations WHERE version > 1"))
+                conn.execute(text("INSERT INTO tags (name) VALUES ('Dup'), ('DUP')"))
+
+            with self.assertRaises(IntegrityError):
+                upgrade(engine, db.metadata, log=lambda message: None)
+            with engine.connect() as conn:
+                self.assertIs(conn.execute(index_valid).scalar(), False)
+
+            # Once the names are fixed, the retry builds the index again rather than keeping the invalid one.
+            with engine.begin() as conn:
+                conn.execute(text("DELETE FROM tags WHERE name = 'DUP'"))
+            upgrade(engine, db.metadata, log=lambda message: None)
+            with engine.connect() as conn:
+                self.assertIs(conn.execute(index_valid).scalar(), True)
+                check_schema(engine)
+        finally:
+            engine.dispose()
+
+    def test_create_tag_duplicate_name(self):
+        with app.test_client() as client:
+            resp = client.post("/tags/new", data={"name": "TAG 1"}, follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Something went wrong :/', html)
+            self.assertEqual(Tag.query.filter(db.func.lower(Tag.name) == 'tag 1').count(), 1)
+
+    def test_create_post_with_tags(self):
+        with app.test_client() as client:
+            d = {"title": "Tagged Post", "content": "New Content", "tags": [self.tag1.id]}
+            resp = client.post(f"/users/{self.user1.id}/posts/new", data=d, follow_redirects=True)
+
+            new_post = Post.query.filter_by(title='Tagged Post').one()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([tag.id for tag in new_post.tags], [self.tag1.id])
+            # A new post's tags don't count as an edit.
+            self.assertEqual(new_post.version, 1)
+
+    def test_create_post_unknown_tag(self):
+        with app.test_client() as client, self.recordQueries() as statements:
+            d = {"title": "Bad Tag Post", "content": "New Content", "tags": ["0"]}
+            resp = client.post(f"/users/{self.user1.id}/posts/new", data=d, follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unknown tag(s): 0', html)
+            self.assertEqual(Post.query.filter_by(title='Bad Tag Post').count(), 0)
+            # Turned away before anything was written.
+            self.assertFalse([s for s in statements if s.startswith(("INSERT", "UPDATE"))])
+
+    def test_edit_post_tags(self):
+        with app.app_context():
+            tag2 = Tag(name='Tag 2')
+            db.session.add(tag2)
+            db.session.commit()
+            tag2_id = tag2.id
+
+        with app.test_client() as client:
+            d = {"title": "Post 3", "content": "Content 3", "tags": [tag2_id]}
+            resp = client.post(f"/posts/{self.post3.id}/edit", data=d, follow_redirects=True)
+
+            post = db.session.get(Post, self.post3.id)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([tag.name for tag in post.tags], ['Tag 2'])
+
+    def test_edit_post_invalidates_cached_pages(self):
+        with app.test_client() as client:
+            client.get("/")
+            client.get(f"/posts/{self.post1.id}")
+
+            d = {"title": "Fresh Title", "content": "Fresh Content"}
+            client.post(f"/posts/{self.post1.id}/edit", data=d)
+
+            post_html = client.get(f"/posts/{self.post1.id}").get_data(as_text=True)
+            home_html = client.get("/").get_data(as_text=True)
+
+            self.assertIn('<h1>Fresh Title</h1>', post_html)
+            self.assertIn('<h2>Fresh Title</h2>', home_html)
+
+    def test_edit_tag_invalidates_cached_pages(self):
+        with app.test_client() as client:
+            client.get(f"/posts/{self.post3.id}")
+
+            client.post(f"/tags/{self.tag1.id}/edit", data={"name": "Renamed Tag"})
+
+            html = client.get(f"/posts/{self.post3.id}").get_data(as_text=True)
+
+            self.assertIn('>Renamed Tag</a>', html)
+
+    def test_cache_ttl(self):
+        # A TTL of 0 caches nothing and None never expires, with either backend.
+        off, forever = MemoryCache(ttl=0), MemoryCache(ttl=None)
+        off.set("key", "value")
+        forever.set("key", "value")
+        self.assertIsNone(off.get("key"))
+        self.assertEqual(forever.get("key"), "value")
+
+        class Client:
+            def __init__(self):
+                self.sets = []
+
+            def set(self, key, value, ex=None):
+                self.sets.append((key, value, ex))
+
+        # Redis rejects ex=0, so it must never be sent.
+        for ttl, sets in [(0, []), (None, [("p:key", "value", None)]), (60, [("p:key", "value", 60)])]:
+            cache = RedisCache.__new__(RedisCache)
+            cache.ttl, cache.prefix, cache._client = ttl, "p:", Client()
+            cache.set("key", "value")
+            self.assertEqual(cache._client.sets, sets)
+
+    @committed
+    def test_pool_stats(self):
+        with app.test_client() as client:
+            client.get("/")
+            resp = client.get("/status/pool")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["pool"], "TimedQueuePool")
+            self.assertGreater(resp.json["checkouts"], 0)
+
+    @committed
+    def test_statement_timeout(self):
+        for pgbouncer in (False, True):
+            slow_app = create_app(TEST_DB_URL, testing=True, statement_timeout=50, pgbouncer=pgbouncer)
+            # Skip the schema check, which can outlast the timeout on a busy machine.
+            connect_db(slow_app, trust_schema=True)
+
+            with slow_app.app_context():
+                with self.assertRaises(OperationalError):
+                    db.session.execute(text("SELECT pg_sleep(1)"))
+                db.session.rollback()
+                db.engine.dispose()
+
+    @committed
+    def test_async_read_views(self):
+        async_app = create_app(TEST_DB_URL, testing=True, async_reads=True)
+        connect_db(async_app)
+
+        try:
+            with async_app.test_client() as client:
+                home_html = client.get("/").get_data(as_text=True)
+                user_html = client.get(f"/users/{self.user1.id}").get_data(as_text=True)
+                tag_resp = client.get(f"/tags/{self.tag1.id}")
+                missing_resp = client.get("/posts/0")
+
+            self.assertIn('<h2>Post 1</h2>', home_html)
+            self.assertIn(f'<a href="/posts/{self.post1.id}">Post 1</a>', user_html)
+            self.assertIn(f'<a href="/posts/{self.post3.id}">Post 3</a>', tag_resp.get_data(as_text=True))
+            self.assertEqual(missing_resp.status_code, 404)
+        finally:
+            async_app.extensions['async_db'].close()
+
+    def test_search_posts(self):
+        with app.test_client() as client:
+            resp = client.get("/search?q=content 3")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<a href="/posts/{self.post3.id}">Post <mark>3</mark></a>', html)
+            self.assertIn('<mark>Content</mark> <mark>3</mark>', html)
+            self.assertNotIn(f'<a href="/posts/{self.post1.id}">', html)
+
+    def test_search_escapes_content(self):
+        with app.app_context():
+            db.session.add(Post(title='Scripted', content='Beware 1 < 2 & danger ahead', user_id=self.user1.id))
+            db.session.commit()
+
+            results = Post.search('danger')
+
+            self.assertEqual(len(results), 1)
+            self.assertIn('1 &lt; 2 &amp;', results.items[0].snippet_html)
+            self.assertIn('<mark>danger</mark>', results.items[0].snippet_html)
+
+    def test_server_timing_header(self):
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.user1.id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertRegex(resp.headers["Server-Timing"], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="[1-9]\d* queries", tpl;dur=[\d.]+$')
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            client.get(f"/users/{self.user1.id}")
+            resp = client.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('blogly_request_duration_seconds_count{route="/users/<int:user_id>",method="GET",status="200"}', text)
+            self.assertIn('blogly_request_sql_queries_bucket{route="/users/<int:user_id>",method="GET",status="200",le="+Inf"}', text)
+            self.assertIn('blogly_db_pool_checked_out', text)
+
+    @committed
+    def test_startup_metrics_and_fork_hooks(self):
+        server_app = create_app(TEST_DB_URL, testing=True)
+        connect_db(server_app, trust_schema=True)
+        warm_up(server_app)
+        server_app.extensions['metrics'].mark_ready()
+        before_fork(server_app)
+        after_fork(server_app)
+
+        with server_app.test_client() as client:
+            self.assertEqual(client.get("/users").status_code, 200)
+            text = client.get("/metrics").get_data(as_text=True)
+
+        self.assertRegex(text, r'blogly_startup_seconds [\d.]+')
+        self.assertRegex(text, r'blogly_time_to_first_request_seconds [\d.]+')
+
+        # Workers each holding their own cache would serve each other's stale pages.
+        with self.assertRaises(SharedCacheRequiredError):
+            serve(server_app, "127.0.0.1", 0, workers=2, threaded=False)
+
+    def test_admission_control(self):
+        admission = app.extensions['admission']
+        read, write = admission.read, admission.write
+        settings = [(budget, budget.limit, budget.queue_size, budget.queue_timeout) for budget in (read, write)]
+        rejected = read.stats()
+
+        # A request already holds the only read slot.
+        read.limit, read.queue_size, read.queue_timeout = 1, 1, 0.05
+        read.acquire()
+        try:
+            with app.test_client() as client:
+                # Waits in the queue until its deadline.
+                resp = client.get("/users/new")
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers["Retry-After"], "2")
+
+                # No room in the queue: turned away at once.
+                read.queue_size = 0
+                self.assertEqual(client.get("/users/new").status_code, 503)
+
+                # Writes have a budget of their own, and monitoring is always let in.
+                resp = client.post("/users/new", data={"first_name": "Busy", "last_name": "Reader", "image_url": ""})
+                self.assertEqual(resp.status_code, 302)
+                stats = client.get("/status/admission").json["read"]
+                self.assertEqual(stats["active"], 1)
+                self.assertEqual(stats["rejected_timeout"], rejected["rejected_timeout"] + 1)
+                self.assertEqual(stats["rejected_queue_full"], rejected["rejected_queue_full"] + 1)
+                self.assertIn("blogly_admission_read_waiting 0", client.get("/metrics").get_data(as_text=True))
+
+                # A queued request gets the slot when it's freed.
+                read.queue_size, read.queue_timeout = 1, 5
+                threading.Timer(0.1, read.release).start()
+                self.assertEqual(client.get("/users/new").status_code, 200)
+                self.assertEqual(read.queued, rejected["queued"] + 1)
+
+                # And reads get in while the writes are full.
+                write.limit, write.queue_size = 1, 0
+                write.acquire()
+                try:
+                    self.assertEqual(client.post(f"/users/{self.user1.id}/delete").status_code, 503)
+                    self.assertEqual(client.get("/users/new").status_code, 200)
+                finally:
+                    write.release()
+        finally:
+            for budget, limit, queue_size, queue_timeout in settings:
+                budget.limit, budget.queue_size, budget.queue_timeout = limit, queue_size, queue_timeout
+
+        self.assertEqual((read.active, write.active), (0, 0))
+
+    def test_slow_request_log(self):
+        app.config['SLOW_REQUEST_MS'] = 0
+        try:
+            with app.test_client() as client, self.assertLogs('blogly.slow_requests', level='WARNING') as logs:
+                client.get(f"/users/{self.user1.id}")
+
+            self.assertIn('"route": "/users/<int:user_id>"', logs.output[0])
+            self.assertIn('FROM users', logs.output[0])
+        finally:
+            app.config['SLOW_REQUEST_MS'] = 500
+
+    @committed
+    def test_bulk_export(self):
+        with app.app_context():
+            raw = db.engine.raw_connection()
+            try:
+                jsonl, csv_out = io.StringIO(), io.StringIO()
+                export_table(raw, 'posts', 'jsonl', jsonl, Progress('export'))
+                export_table(raw, 'posts', 'csv', csv_out, Progress('export'))
+                raw.rollback()
+            finally:
+                raw.close()
+
+        records = list(read_records(io.StringIO(jsonl.getvalue()), 'jsonl'))
+        self.assertEqual(len(records), 4)
+        self.assertEqual([r for r in records if r['title'] == 'Post 3'][0]['tags'], ['Tag 1'])
+
+        rows = list(read_records(io.StringIO(csv_out.getvalue()), 'csv'))
+        self.assertEqual(sorted(r['title'] for r in rows), ['Post 1', 'Post 2', 'Post 3', 'Post 4'])
+        self.assertEqual([r for r in rows if r['title'] == 'Post 3'][0]['tags'], ['Tag 1'])
+
+    @committed
+    def test_bulk_import_posts(self):
+        lines = "\n".join(json.dumps({"title": f"Imported {i}", "content": "Imported content",
+                                      "user_id": self.user2.id, "tags": ["tag 1", "Imported Tag"]})
+                          for i in range(3))
+
+        with app.app_context():
+            raw = db.engine.raw_connection()
+            try:
+                import_table(raw, 'posts', read_records(io.StringIO(lines), 'jsonl'), 2, Progress('import'))
+            finally:
+                raw.close()
+
+            imported = Post.query.filter(Post.title.like('Imported %')).all()
+            self.assertEqual(len(imported), 3)
+            self.assertEqual(sorted(tag.name for tag in imported[0].tags), ['Imported Tag', 'Tag 1'])
+            self.assertEqual(Tag.query.count(), 2)
+
+            # The id sequences were moved past the imported rows.
+            post = Post(title='After import', content='x', user_id=self.user2.id)
+            db.session.add(post)
+            db.session.commit()
+            self.assertGreater(post.id, max(p.id for p in imported))
+
+    def test_post_counts(self):
+        with app.test_client() as client:
+            client.post(f"/users/{self.user1.id}/posts/new",
+                        data={"title": "Counted", "content": "x", "tags": [str(self.tag1.id)]})
+            counted = Post.query.filter_by(title='Counted').one()
+
+            self.assertEqual(db.session.get(User, self.user1.id).post_count, 3)
+            self.assertEqual(db.session.get(Tag, self.tag1.id).post_count, 2)
+
+            client.post(f"/posts/{counted.id}/edit", data={"title": "Counted", "content": "x"})
+            db.session.expire_all()
+            self.assertEqual(db.session.get(Tag, self.tag1.id).post_count, 1)
+
+            # Deleting a tagged post takes it off its author and its tags.
+            client.post(f"/posts/{self.post3.id}/delete")
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, self.user2.id).post_count, 1)
+            self.assertEqual(db.session.get(Tag, self.tag1.id).post_count, 0)
+
+            with app.app_context():
+                self.assertEqual(User.repair_post_counts(), 0)
+                self.assertEqual(Tag.repair_post_counts(), 0)
+
+    def test_delete_user_updates_tag_counts(self):
+        with app.test_client() as client:
+            resp = client.post(f"/users/{self.user2.id}/delete", follow_redirects=True)
+
+            self.assertIn('User deleted!', resp.get_data(as_text=True))
+            self.assertEqual(db.session.get(Tag, self.tag1.id).post_count, 0)
+            self.assertEqual(Tag.repair_post_counts(), 0)
+
+    def test_most_popular_tags(self):
+        with app.app_context():
+            tag2 = Tag(name='Tag 2')
+            db.session.add(tag2)
+            db.session.flush()
+            db.session.get(Post, self.post1.id).set_tags([tag2.id])
+            db.session.get(Post, self.post3.id).set_tags([self.tag1.id, tag2.id])
+            db.session.commit()
+
+            self.assertEqual([tag.name for tag in Tag.get_most_popular()], ['Tag 2', 'Tag 1'])
+
+        with app.test_client() as client:
+            html = client.get("/tags").get_data(as_text=True)
+            self.assertIn('Tag 2 (2)', html)
+            self.assertIn('(1 posts)', html)
+
+    def test_conditional_get(self):
+        with app.test_client() as client:
+            resp = client.get(f"/posts/{self.post3.id}")
+            etag, last_modified = resp.headers["ETag"], resp.headers["Last-Modified"]
+
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+
+            # A current copy costs one query and no rendering.
+            with self.assertQueryCount(1):
+                resp = client.get(f"/posts/{self.post3.id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+            self.assertIn('tpl;dur=0.0', resp.headers["Server-Timing"])
+
+            resp = client.get(f"/posts/{self.post3.id}",
+                              headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+            # Renaming a tag shown on the post changes the post page's ETag.
+            client.post(f"/tags/{self.tag1.id}/edit", data={"name": "Renamed"})
+            client.get("/tags")  # consume the flash
+            resp = client.get(f"/posts/{self.post3.id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_feeds(self):
+        with app.test_client() as client:
+            resp = client.get("/feed.xml")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "application/atom+xml")
+            self.assertIn("<title>Post 3</title>", resp.get_data(as_text=True))
+            self.assertIn('<category term="Tag 1"/>', resp.get_data(as_text=True))
+
+            html = client.get(f"/users/{self.user1.id}/feed.xml").get_data(as_text=True)
+            self.assertIn("<title>Blogly: posts by User One</title>", html)
+            self.assertIn("<title>Post 1</title>", html)
+            self.assertNotIn("<title>Post 3</title>", html)
+
+            html = client.get(f"/tags/{self.tag1.id}/feed.xml").get_data(as_text=True)
+            self.assertIn("<title>Post 3</title>", html)
+            self.assertNotIn("<title>Post 1</title>", html)
+
+            self.assertEqual(client.get("/users/0/feed.xml").status_code, 404)
+
+            # Polls are served from the cache, and answered with a 304 when the client's copy is current.
+            with self.assertQueryCount(0):
+                self.assertEqual(client.get("/feed.xml").get_data(), resp.get_data())
+                since = client.get("/feed.xml", headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+                match = client.get("/feed.xml", headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(since.status_code, 304)
+            self.assertEqual(match.status_code, 304)
+
+    def test_user_and_tag_writes_invalidate_by_stamp(self):
+        with app.test_client() as client:
+            for url in ("/", f"/posts/{self.post3.id}", "/feed.xml", f"/tags/{self.tag1.id}/feed.xml"):
+                client.get(url)
+
+            # Renames reach every cached page and feed showing the user or tag.
+            client.post(f"/users/{self.user2.id}/edit", data={"first_name": "Renamed", "last_name": "Author", "image_url": ""})
+            client.post(f"/tags/{self.tag1.id}/edit", data={"name": "Retagged"})
+            for url in ("/", f"/posts/{self.post3.id}", "/feed.xml", f"/tags/{self.tag1.id}/feed.xml"):
+                html = client.get(url).get_data(as_text=True)
+                self.assertIn("Renamed Author", html)
+                self.assertIn("Retagged", html)
+
+            # Deleting a user runs the same statements however many posts they wrote.
+            deletes = []
+            for post_count in (1, 25):
+                with app.app_context():
+                    user = User(first_name="Prolific", last_name=str(post_count))
+                    db.session.add(user)
+                    db.session.flush()
+                    for i in range(post_count):
+                        Post.create(user.id, f"Post {i}", "Content", [self.tag1.id])
+                    db.session.commit()
+                    user_id = user.id
+
+                with self.recordQueries() as statements:
+                    client.post(f"/users/{user_id}/delete")
+                deletes.append(statements)
+            self.assertEqual(deletes[0], deletes[1])
+
+            self.assertNotIn("Prolific", client.get("/").get_data(as_text=True))
+
+    def test_stamps_read_before_rows(self):
+        fragments = app.extensions['fragment_cache']
+        names = stamp_keys([self.user2.id], [self.tag1.id])
+
+        # A rename committed by another request while the rows load deletes the stamps in between.
+        def rename_meanwhile(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("SELECT"):
+                fragments.delete_many(names)
+
+        with app.app_context():
+            engine = db.engine
+        for url, key in [(f"/posts/{self.post3.id}", post_page_key(self.post3.id)),
+                         ("/", post_card_key(self.post3.id)),
+                         (f"/tags/{self.tag1.id}/feed.xml", tag_feed_key(self.tag1.id))]:
+            with self.subTest(url=url), app.test_client() as client:
+                event.listen(engine, "after_cursor_execute", rename_meanwhile)
+                try:
+                    client.get(url)
+                finally:
+                    event.remove(engine, "after_cursor_execute", rename_meanwhile)
+
+                # What was built from the old rows may be cached, but never passes as current.
+                self.assertIsNone(get_stamped(fragments, key))
+
+    def test_feed_invalidation(self):
+        user1_feed, user2_feed = f"/users/{self.user1.id}/feed.xml", f"/users/{self.user2.id}/feed.xml"
+        tag_feed = f"/tags/{self.tag1.id}/feed.xml"
+
+        with app.test_client() as client:
+            for url in ("/feed.xml", user1_feed, user2_feed, tag_feed):
+                client.get(url)
+
+            # Editing one of user one's untagged posts leaves the other feeds cached.
+            client.post(f"/posts/{self.post1.id}/edit", data={"title": "Retitled", "content": "x"})
+            self.assertIn("Retitled", client.get(user1_feed).get_data(as_text=True))
+            self.assertIn("Retitled", client.get("/feed.xml").get_data(as_text=True))
+            with self.assertQueryCount(0):
+                client.get(user2_feed)
+                client.get(tag_feed)
+
+            # Renaming the tag drops the feeds of its posts.
+            client.post(f"/tags/{self.tag1.id}/edit", data={"name": "Renamed"})
+            self.assertIn("<title>Blogly: Renamed</title>", client.get(tag_feed).get_data(as_text=True))
+            self.assertIn('<category term="Renamed"/>', client.get(user2_feed).get_data(as_text=True))
+
+            # So does a new post with the tag.
+            client.post(f"/users/{self.user1.id}/posts/new",
+                        data={"title": "Tagged", "content": "x", "tags": [str(self.tag1.id)]})
+            self.assertIn("<title>Tagged</title>", client.get(tag_feed).get_data(as_text=True))
+
+            # And deleting a post.
+            client.post(f"/posts/{self.post3.id}/delete")
+            self.assertNotIn("<title>Post 3</title>", client.get(tag_feed).get_data(as_text=True))
+            self.assertNotIn("<title>Post 3</title>", client.get(user2_feed).get_data(as_text=True))
+
+    def test_conditional_get_list_deletes(self):
+        with app.test_client() as client:
+            etag = client.get("/users").headers["ETag"]
+            self.assertEqual(client.get("/users", headers={"If-None-Match": etag}).status_code, 304)
+
+            # Deleting a row leaves max(updated_at) as it was, but still changes the ETag.
+            resp = client.post(f"/users/{self.user2.id}/delete", follow_redirects=True)
+            self.assertNotIn("ETag", resp.headers)
+
+            resp = client.get("/users", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("User Two", resp.get_data(as_text=True))
+
+    @committed
+    def test_timestamps(self):
+        with app.app_context():
+            post = db.session.get(Post, self.post1.id)
+            created_at, version = post.created_at, post.version
+
+            post.title = "Retitled"
+            db.session.commit()
+
+            self.assertEqual(post.created_at, created_at)
+            self.assertGreaterEqual(post.updated_at, created_at)
+            self.assertEqual(post.version, version + 1)
+
+            # One clock, the db's, for inserts and updates, with the time zone kept.
+            self.assertIsNone(Post.__table__.c.created_at.default)
+            self.assertIsNotNone(post.updated_at.tzinfo)
+            updated_at = post.updated_at
+
+        with app.test_client() as client:
+            resp = client.get(f"/posts/{self.post1.id}")
+            self.assertEqual(resp.last_modified, updated_at.replace(microsecond=0))
+
+    def test_api_multi_get(self):
+        with app.test_client() as client:
+            ids = f"{self.post1.id},{self.post3.id},999999"
+
+            # Posts, then one query each for the authors and the tags.
+            with self.assertQueryCount(3):
+                resp = client.get(f"/api/v1/posts?ids={ids}&fields=title&include=author,tags")
+                body = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(body["missing"], [999999])
+            self.assertEqual([post["title"] for post in body["data"]], ["Post 1", "Post 3"])
+            self.assertNotIn("content", body["data"][0])
+            self.assertEqual(body["data"][0]["author"]["last_name"], "One")
+            self.assertEqual(body["data"][0]["tags"], [])
+            self.assertEqual(body["data"][1]["tags"], [{"id": self.tag1.id, "name": "Tag 1"}])
+
+    def test_api_list_pages(self):
+        with app.test_client() as client:
+            first = client.get("/api/v1/users?limit=1&fields=last_name").get_json()
+            second = client.get(f"/api/v1/users?limit=1&after={first['next']}").get_json()
+
+            self.assertEqual(len(first["data"]), 1)
+            self.assertEqual(len(second["data"]), 1)
+            self.assertIsNone(second["next"])
+            self.assertNotEqual(first["data"][0]["id"], second["data"][0]["id"])
+
+    def test_api_bad_params(self):
+        with app.test_client() as client:
+            resp = client.get("/api/v1/tags?fields=nope")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("Unknown fields: nope", resp.get_json()["error"])
+
+            self.assertEqual(client.get("/api/v1/users?include=tags").status_code, 400)
+            self.assertEqual(client.get("/api/v1/posts?ids=1,x").status_code, 400)
+
+    def test_tag_autocomplete(self):
+        with app.app_context():
+            engine = db.engine
+
+        with app.test_client() as client:
+            client.post("/tags/new", data={"name": "Travel"})
+            client.post("/tags/new", data={"name": "tea"})
+
+            resp = client.get("/tags/autocomplete?prefix=T")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([tag["name"] for tag in resp.get_json()], ["Tag 1", "tea", "Travel"])
+
+            statements = []
+            count = lambda *args: statements.append(args[2])
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                resp = client.get("/tags/autocomplete?prefix=tr")
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+
+            # Answered from the catalog built by the previous lookup.
+            self.assertEqual(statements, [])
+            self.assertEqual(resp.get_json()[0]["name"], "Travel")
+
+            client.post(f"/tags/{self.tag1.id}/edit", data={"name": "Renamed"})
+            names = [tag["name"] for tag in client.get("/tags/autocomplete?prefix=t").get_json()]
+            self.assertEqual(names, ["tea", "Travel"])
+
+            client.post(f"/tags/{self.tag1.id}/delete")
+            self.assertEqual(client.get("/tags/autocomplete?prefix=ren").get_json(), [])
+
+    def test_post_forms_use_tag_autocomplete(self):
+        with app.test_client() as client:
+            html = client.get(f"/users/{self.user1.id}/posts/new").get_data(as_text=True)
+            self.assertIn('data-autocomplete-url="/tags/autocomplete"', html)
+            self.assertNotIn('Tag 1', html)
+
+            html = client.get(f"/posts/{self.post3.id}/edit").get_data(as_text=True)
+            self.assertIn(f'<input type="hidden" name="tags" value="{self.tag1.id}">', html)
+
+    def test_delete_user_leaves_posts_to_the_db(self):
+        with app.app_context():
+            engine = db.engine
+
+        statements = []
+        count = lambda *args: statements.append(args[2])
+
+        with app.test_client() as client:
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                client.post(f"/users/{self.user2.id}/delete")
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+
+        # The user's posts and their posts_tags rows are never loaded, ON DELETE CASCADE removes them.
+        self.assertFalse([s for s in statements if s.startswith("SELECT posts.id AS posts_id")])
+        with app.app_context():
+            self.assertEqual(Post.query.filter_by(user_id=self.user2.id).count(), 0)
+            self.assertEqual(PostTag.query.count(), 0)
+            self.assertEqual(db.session.get(Tag, self.tag1.id).post_count, 0)
+
+    def test_api_bulk_delete(self):
+        with app.test_client() as client:
+            resp = client.delete(f"/api/v1/posts?ids={self.post1.id},{self.post3.id},999999")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {"deleted": sorted([self.post1.id, self.post3.id]),
+                                               "missing": [999999]})
+
+            self.assertEqual(db.session.get(User, self.user1.id).post_count, 1)
+            self.assertEqual(db.session.get(User, self.user2.id).post_count, 1)
+            self.assertEqual(db.session.get(Tag, self.tag1.id).post_count, 0)
+
+            resp = client.delete(f"/api/v1/users?ids={self.user1.id},{self.user2.id}")
+            self.assertEqual(len(resp.get_json()["deleted"]), 2)
+            self.assertEqual(Post.query.count(), 0)
+
+            resp = client.delete(f"/api/v1/tags?ids={self.tag1.id}")
+            self.assertEqual(resp.get_json()["deleted"], [self.tag1.id])
+            self.assertEqual(client.get("/tags/autocomplete?prefix=tag").get_json(), [])
+
+            self.assertEqual(client.delete("/api/v1/tags").status_code, 400)
+
+    def test_delete_many_tags_cascades(self):
+        with app.app_context():
+            post_ids = [self.post1.id, self.post3.id]
+            tag2 = Tag(name='Tag 2', tag_posts=[PostTag(post_id=post_id) for post_id in post_ids])
+            db.session.add(tag2)
+            db.session.commit()
+
+            self.assertEqual(sorted(Tag.delete_many([self.tag1.id, tag2.id])), sorted([self.tag1.id, tag2.id]))
+            db.session.commit()
+
+            self.assertEqual(PostTag.query.count(), 0)
+            self.assertEqual(Post.query.count(), 4)
+
+    @committed
+    def test_view_counts(self):
+        counter = app.extensions['view_counter']
+
+        with app.test_client() as client:
+            resp = client.get(f"/posts/{self.post1.id}")
+            client.get(f"/posts/{self.post1.id}", headers={"If-None-Match": resp.headers["ETag"]})
+            client.get(f"/posts/{self.post3.id}")
+            client.get("/posts/999999")
+
+            # Counted in memory until a flush, 304s included and 404s not.
+            self.assertEqual(len(counter), 3)
+            with app.app_context():
+                self.assertEqual(db.session.get(Post, self.post1.id).view_count, 0)
+                self.assertEqual(counter.flush(), 3)
+
+                post = db.session.get(Post, self.post1.id)
+                self.assertEqual(post.view_count, 2)
+                self.assertEqual(post.version, 1)
+                self.assertEqual(db.session.get(Post, self.post3.id).view_count, 1)
+
+            # The flush isn't an edit, so the cached copy is still current.
+            resp = client.get(f"/posts/{self.post1.id}", headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+            with app.app_context():
+                counter.flush()
+
+            html = client.get("/posts/most-viewed").get_data(as_text=True)
+            self.assertLess(html.index("Post 1</a>"), html.index("Post 3</a>"))
+            self.assertIn("(3 views)", html)
+            self.assertNotIn("Post 2", html)
+
+    @committed
+    def test_view_counts_flush_when_due(self):
+        counter = app.extensions['view_counter']
+        max_pending = counter.max_pending
+        counter.max_pending = 2
+
+        flush_threads = []
+
+        def record_flush(conn, cursor, statement, parameters, context, executemany):
+            if "increments" in statement:
+                flush_threads.append(threading.current_thread().name)
+
+        event.listen(self.engine, "before_cursor_execute", record_flush)
+        try:
+            with app.test_client() as client:
+                client.get(f"/posts/{self.post1.id}")
+                client.get(f"/posts/{self.post1.id}")
+
+            with app.app_context():
+                for _ in range(100):
+                    if db.session.get(Post, self.post1.id).view_count == 2:
+                        break
+                    db.session.rollback()
+                    time.sleep(0.05)
+                self.assertEqual(db.session.get(Post, self.post1.id).view_count, 2)
+            self.assertEqual(len(counter), 0)
+            # Written by the background thread, not by the request that hit the limit.
+            self.assertEqual(flush_threads, ["blogly-view-flush"])
+        finally:
+            event.remove(self.engine, "before_cursor_execute", record_flush)
+            counter.max_pending = max_pending
+
+    def test_view_counts_back_off_after_a_failed_flush(self):
+        counter = ViewCounter(flush_interval=60, max_pending=3, max_retained=4)
+        counter.record(self.post1.id)
+        counter.record("not-a-post-id")
+
+        with app.app_context(), self.assertLogs('blogly.view_counts', 'ERROR'):
+            self.assertEqual(counter.flush(), 0)
+        self.assertEqual(len(counter), 2)
+
+        # Until the interval is up, reaching max_pending doesn't start another flush...
+        counter.record(self.post1.id)
+        self.assertFalse(counter._wake.is_set())
+
+        # ...and past max_retained views are dropped rather than kept.
+        for _ in range(3):
+            counter.record(self.post1.id)
+        self.assertEqual(len(counter), 4)
+        self.assertEqual(counter.dropped, 2)
+
+    def test_fingerprinted_assets(self):
+        assets = app.extensions['assets']
+        manifest = build(app.static_folder, log=lambda message: None)
+        assets.reload()
+
+        try:
+            with app.test_client() as client:
+                html = client.get("/users").get_data(as_text=True)
+                url = f"/static/dist/{manifest['style.css']}"
+                self.assertIn(f'href="{url}"', html)
+                self.assertNotIn('href="/static/style.css"', html)
+
+                with open(os.path.join(app.static_folder, 'style.css'), 'rb') as f:
+                    source = f.read()
+
+                resp = client.get(url, headers={"Accept-Encoding": "gzip, deflate"})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertEqual(resp.mimetype, "text/css")
+                self.assertIn("Accept-Encoding", resp.headers["Vary"])
+                self.assertIn("immutable", resp.headers["Cache-Control"])
+                self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+                self.assertEqual(gzip.decompress(resp.get_data()), source)
+                resp.close()
+
+                resp = client.get(url)
+                self.assertNotIn("Content-Encoding", resp.headers)
+                self.assertEqual(resp.get_data(), source)
+                resp.close()
+
+                # Unbuilt names are still served the usual way.
+                resp = client.get("/static/style.css")
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("immutable", resp.headers.get("Cache-Control", ""))
+                resp.close()
+        finally:
+            clean(app.static_folder)
+            assets.reload()
+
+    def test_streamed_list_pages(self):
+        with app.test_client() as client:
+            resp = client.get("/users/all")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<a href="/users/{self.user1.id}">User One</a>', html)
+            self.assertIn(f'<a href="/users/{self.user2.id}">User Two</a>', html)
+            self.assertNotIn('Show all', html)
+
+            html = client.get("/tags/all").get_data(as_text=True)
+            self.assertIn(f'<a href="/tags/{self.tag1.id}">Tag 1</a> (1 posts)', html)
+
+            self.assertEqual(client.get("/tags/999999/all").status_code, 404)
+
+    def test_streamed_page_sends_header_first(self):
+        with app.app_context():
+            engine = db.engine
+            for i in range(30):
+                Post.create(self.user1.id, f"Streamed {i}", "Content", [self.tag1.id])
+            db.session.commit()
+
+        statements = []
+        count = lambda *args: statements.append(args[2])
+
+        with app.test_client() as client:
+            resp = client.get(f"/tags/{self.tag1.id}/all", buffered=False)
+            chunks = iter(resp.response)
+
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                header = ""
+                while "<h1>" not in header:
+                    header += next(chunks).decode()
+                # The page header goes out before the posts are queried.
+                self.assertEqual(statements, [])
+
+                rest = b"".join(chunks).decode()
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+                resp.close()
+
+        self.assertEqual(len(statements), 1)
+        self.assertIn("Tag: Tag 1", header)
+        self.assertLess(rest.index("Streamed 29"), rest.index("Streamed 0"))
+        self.assertIn(f'<a href="/posts/{self.post3.id}">Post 3</a>', rest)
+
+    @committed
+    def test_read_replica_routing(self):
+        replica_app = create_app(TEST_DB_URL, testing=True, replica_urls=[create_test_database("blogly_test_replica")])
+        connect_db(replica_app)
+
+        with replica_app.test_client() as client:
+            # Reads come from the (empty) replica.
+            self.assertNotIn("User One", client.get("/users").get_data(as_text=True))
+            self.assertTrue(client.get("/status/replicas").get_json()[0]["healthy"])
+
+            # Writes go to the primary, and the redirect after them reads from it too.
+            d = {"first_name": "Replica", "last_name": "Check", "image_url": ""}
+            html = client.post("/users/new", data=d, follow_redirects=True).get_data(as_text=True)
+            self.assertIn("Replica Check", html)
+            self.assertIn("User One", html)
+
+        with replica_app.test_client() as client:
+            # What's cached for everyone is read from the primary, never the replica.
+            self.assertIn("Post 1", client.get(f"/posts/{self.post1.id}").get_data(as_text=True))
+            self.assertIn("Post 3", client.get("/").get_data(as_text=True))
+            self.assertIn("<title>Post 3</title>", client.get("/feed.xml").get_data(as_text=True))
+            self.assertEqual(client.get("/tags/autocomplete?prefix=tag").get_json(),
+                             [{"id": self.tag1.id, "name": "Tag 1"}])
+            # Other reads still use the replica.
+            self.assertNotIn("User One", client.get("/users").get_data(as_text=True))
+
+        with replica_app.app_context():
+            replica_app.extensions['replicas'].dispose()
+
+    @committed
+    def test_read_replica_ejection(self):
+        replica_app = create_app(TEST_DB_URL, testing=True,
+                                 replica_urls=["postgresql:///blogly_test?host=/nonexistent"])
+        connect_db(replica_app)
+
+        with replica_app.test_client() as client:
+            # The unreachable replica is ejected and reads fall back to the primary.
+            self.assertIn("User One", client.get("/users").get_data(as_text=True))
+
+            status = client.get("/status/replicas").get_json()[0]
+            self.assertFalse(status["healthy"])
+            self.assertIsNotNone(status["error"])
@@ -0,0 +1,159 @@
+"""Test harness for Blogly's test suite, see test_app.py.
+
+Each test process gets a database of its own, a copy of a template database
+built once from the migrations (CREATE DATABASE ... TEMPLATE only copies files,
+so it takes a fraction of a second). Under pytest-xdist the worker id is
+appended to the database name, so `pytest -n 4` runs four processes against
+four databases. The template's name includes the schema version, so a new
+migration gets a new template.
+
+TransactionalTestCase runs each test on one connection inside a transaction
+that's rolled back afterwards. The app's sessions are bound to that connection
+and their commits only release SAVEPOINTs in it, so a test sees its own writes
+and leaves nothing behind, without deleting rows or dropping tables. A test
+whose data has to be seen from other connections (asyncpg, COPY, a second app),
+or that relies on real transaction boundaries (now() is the transaction's start
+time), is marked @committed: it commits for real and the tables are emptied
+after it.
+
+assertQueryCount() fails a test when a block runs more or fewer SQL statements
+than expected, so an N+1 query in a route breaks the build.
+"""
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+from migrations import LATEST_VERSION, upgrade
+from models import db
+
+# The database to connect to while creating and dropping the others.
+MAINTENANCE_DB = 'postgres'
+
+# Any constant, as long as it's different from migrations.MIGRATION_LOCK_ID.
+TEMPLATE_LOCK_ID = 7431953377
+
+# The statements the savepoints add, which aren't counted so counts are the same in @committed tests.
+SAVEPOINT_STATEMENTS = ('SAVEPOINT ', 'RELEASE SAVEPOINT ', 'ROLLBACK TO SAVEPOINT ')
+
+
+def worker_database(name):
+    """The name of this test process's database: 'name', with the pytest-xdist worker id if any."""
+
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    return f"{name}_{worker}" if worker else name
+
+
+def create_test_database(name):
+    """Create a fresh database for this test process from the template for 'name', building the
+    template first if needed. Returns the new database's URL."""
+
+    url = make_url(name if '://' in name else f'postgresql:///{name}')
+    database = worker_database(url.database)
+    template = f"{url.database}_template_v{LATEST_VERSION}"
+
+    engine = create_engine(url.set(database=MAINTENANCE_DB), isolation_level='AUTOCOMMIT', poolclass=NullPool)
+    try:
+        with engine.connect() as conn:
+            # Workers starting together would otherwise race to build the template, and cloning
+            # fails while anyone else is connected to it.
+            conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": TEMPLATE_LOCK_ID})
+            try:
+                if not conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                                    {"name": template}).scalar():
+                    _build_template(conn, url, template)
+
+                conn.execute(text(f'DROP DATABASE IF EXISTS "{database}" WITH (FORCE)'))
+                conn.execute(text(f'CREATE DATABASE "{database}" TEMPLATE "{template}"'))
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": TEMPLATE_LOCK_ID})
+    finally:
+        engine.dispose()
+
+    return url.set(database=database).render_as_string(hide_password=False)
+
+
+def _build_template(conn, url, template):
+    # Built under another name and renamed when done, so a build that dies halfway is never cloned.
+    building = f"{template}_building"
+    conn.execute(text(f'DROP DATABASE IF EXISTS "{building}" WITH (FORCE)'))
+    conn.execute(text(f'CREATE DATABASE "{building}"'))
+
+    engine = create_engine(url.set(database=building), poolclass=NullPool)
+    try:
+        upgrade(engine, db.metadata, log=lambda message: None)
+    finally:
+        engine.dispose()
+
+    conn.execute(text(f'ALTER DATABASE "{building}" RENAME TO "{template}"'))
+
+
+def committed(test):
+    """Run 'test' outside the rolled back transaction, and empty the tables after it."""
+    test.committed = True
+    return test
+
+
+class TransactionalTestCase(TestCase):
+    """Runs each test in a transaction that's rolled back afterwards. Subclasses set 'app', and call
+    super().setUp() before adding their fixtures."""
+
+    app = None
+
+    def setUp(self):
+        with self.app.app_context():
+            self.engine = db.engine
+
+        if getattr(getattr(self, self._testMethodName), 'committed', False):
+            self.addCleanup(self._empty_tables)
+            return
+
+        connection = self.engine.connect()
+        transaction = connection.begin()
+        db.session.session_factory.configure(bind=connection, join_transaction_mode='create_savepoint')
+        self.addCleanup(self._roll_back, connection, transaction)
+
+    def _roll_back(self, connection, transaction):
+        with self.app.app_context():
+            db.session.remove()
+        for option in ('bind', 'join_transaction_mode'):
+            db.session.session_factory.kw.pop(option)
+        transaction.rollback()
+        connection.close()
+
+    def _empty_tables(self):
+        with self.app.app_context():
+            db.session.remove()
+        tables = ", ".join(table.name for table in db.metadata.sorted_tables)
+        with self.engine.begin() as conn:
+            conn.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+
+    @contextmanager
+    def recordQueries(self):
+        """Yield a list that collects the SQL statements the block runs, savepoints aside."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith(SAVEPOINT_STATEMENTS):
+                statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(self.engine, "before_cursor_execute", record)
+
+    @contextmanager
+    def assertQueryCount(self, expected):
+        """Fail unless the block runs exactly 'expected' SQL statements. Yields the list of statements."""
+
+        with self.recordQueries() as statements:
+            yield statements
+
+        self.assertEqual(len(statements), expected,
+                         f"Expected {expected} queries, ran {len(statements)}:\n" + "\n".join(statements))
@@ -0,0 +1,201 @@
+"""Write-behind view counts for Blogly posts.
+
+Each view of a post page (a 200 or a 304 from show_post, sync or async) adds
+one to a per-process dict instead of updating the post's row. The pending
+counts are written in one statement, sorted by post id so workers flushing at
+the same time can't deadlock:
+
+    UPDATE posts SET view_count = posts.view_count + v.views
+    FROM (VALUES (1, 12), (7, 3), ...) AS v (id, views) WHERE posts.id = v.id
+
+A background thread in each process flushes every VIEW_FLUSH_INTERVAL
+seconds (BLOGLY_VIEW_FLUSH_INTERVAL, default 10), or as soon as
+VIEW_FLUSH_MAX_PENDING views are waiting (BLOGLY_VIEW_FLUSH_MAX_PENDING,
+default 1000), and once more when the process exits. No request waits for a
+flush. server.py stops the thread before forking and starts one in each
+worker, since threads don't survive a fork. A worker that crashes loses the
+views since its last flush, so at most VIEW_FLUSH_MAX_PENDING views, or
+VIEW_FLUSH_INTERVAL seconds' worth under steady traffic. A flush that fails
+keeps its counts for the next one, which waits a full VIEW_FLUSH_INTERVAL
+however many views pile up meanwhile, so a db outage costs one failed UPDATE
+per interval rather than one per view. Up to VIEW_FLUSH_MAX_RETAINED views
+(BLOGLY_VIEW_FLUSH_MAX_RETAINED, default 10000) are kept while flushes fail;
+views past that are dropped and counted in 'dropped'.
+
+View counts aren't edits, so flushes leave the posts' updated_at and version
+alone and cached pages stay valid. The most viewed list reads the flushed
+counts, so it trails the live numbers by up to a flush interval.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from flask import request
+from sqlalchemy import Integer, column, values
+
+from models import db, Post
+
+view_count_log = logging.getLogger('blogly.view_counts')
+
+# The routes whose views are counted, and the view argument holding the post id.
+COUNTED_ENDPOINTS = {'show_post': 'post_id'}
+
+
+class ViewCounter:
+    """Post views counted in memory and flushed to the db in batches."""
+
+    def __init__(self, flush_interval=10, max_pending=1000, max_retained=10000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retained = max_retained
+        self.dropped = 0
+        self._counts = {}
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def record(self, post_id):
+        with self._lock:
+            if self._pending >= self.max_retained:
+                self.dropped += 1
+                return
+
+            self._counts[post_id] = self._counts.get(post_id, 0) + 1
+            self._pending += 1
+            # After a failed flush the next one waits out its interval, see flush().
+            if self._pending >= self.max_pending and time.monotonic() >= self._retry_at:
+                self._wake.set()
+
+    def start(self, app):
+        """Start the thread flushing the counts in the background. server.py calls it again in
+        each forked worker, after stop() in the parent."""
+
+        self._stopping = False
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._run, args=(app,), name='blogly-view-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, letting a flush in progress finish. Doesn't flush."""
+
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(max(self._flushed_at + self.flush_interval - time.monotonic(), 0))
+            self._wake.clear()
+            if self._stopping:
+                return
+            if time.monotonic() < self._retry_at:
+                continue
+
+            if self._pending:
+                with app.app_context():
+                    self.flush()
+            else:
+                self._flushed_at = time.monotonic()
+
+    def flush(self):
+        """Write the pending counts in one statement. Returns the number of views written.
+        Another thread's flush in progress is left to finish rather than waited for."""
+
+        if not self._flush_lock.acquire(blocking=False):
+            return 0
+
+        try:
+            with self._lock:
+                counts, self._counts = self._counts, {}
+                pending, self._pending = self._pending, 0
+                self._flushed_at = time.monotonic()
+
+            if not counts:
+                return 0
+
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(_increments_update(sorted(counts.items())))
+            except Exception:
+                with self._lock:
+                    self._retry_at = time.monotonic() + self.flush_interval
+                    keep = self._pending + pending <= self.max_retained
+                    if keep:
+                        for post_id, views in counts.items():
+                            self._counts[post_id] = self._counts.get(post_id, 0) + views
+                        self._pending += pending
+                    else:
+                        self.dropped += pending
+
+                if keep:
+                    view_count_log.exception("Couldn't flush %s post views, keeping them for the next flush "
+                                             "in %ss", pending, self.flush_interval)
+                else:
+                    view_count_log.exception("Couldn't flush %s post views, dropping them: more than %s "
+                                             "are waiting", pending, self.max_retained)
+                return 0
+
+            self._retry_at = 0.0
+            return pending
+        finally:
+            self._flush_lock.release()
+
+    def clear(self):
+        """Drop the pending counts without writing them, and restart the flush interval."""
+        with self._lock:
+            self._counts.clear()
+            self._pending = 0
+            self._flushed_at = time.monotonic()
+
+    def __len__(self):
+        return self._pending
+
+
+def _increments_update(rows):
+    """The UPDATE adding each (post_id, views) row to its post's view_count."""
+
+    posts = Post.__table__
+    increments = values(column('id', Integer), column('views', Integer), name='increments').data(rows)
+
+    # Setting updated_at and version to themselves stops their onupdate defaults from firing.
+    return (posts.update()
+            .where(posts.c.id == increments.c.id)
+            .values(view_count=posts.c.view_count + increments.c.views,
+                    updated_at=posts.c.updated_at,
+                    version=posts.c.version))
+
+
+def init_view_counts(app):
+    """Start counting post views. Returns the app's ViewCounter."""
+
+    counter = ViewCounter(flush_interval=app.config['VIEW_FLUSH_INTERVAL'],
+                          max_pending=app.config['VIEW_FLUSH_MAX_PENDING'],
+                          max_retained=app.config['VIEW_FLUSH_MAX_RETAINED'])
+    app.extensions['view_counter'] = counter
+
+    @app.after_request
+    def count_view(response):
+        arg = COUNTED_ENDPOINTS.get(request.endpoint)
+        if arg and request.method == 'GET' and response.status_code in (200, 304):
+            counter.record(request.view_args[arg])
+        return response
+
+    counter.start(app)
+
+    @atexit.register
+    def flush_views_at_exit():
+        counter.stop()
+        with app.app_context():
+            counter.flush()
+
+    return counter